@@ -1,6 +1,8 @@
 import streamlit as st
 import os
 
+from capuchin.backends import start_model_warmup
+
 
 # 1. PAGE CONFIG - MUST BE THE FIRST STREAMLIT COMMAND
 st.set_page_config(
@@ -74,6 +76,10 @@ section[data-testid="stSidebarUserContent"] > div:nth-child(2) {
 """
 st.markdown(custom_css, unsafe_allow_html=True)
 
+# Load and warm up the default detection model in the background once per server process,
+# so the first "Count Capuchin Calls" does not wait for TensorFlow
+start_model_warmup('keras')
+
 # Add sidebar image and description
 with st.sidebar:
     st.markdown("<h3 style='text-align: center; color: white; margin-top: 0;'>Capuchin Bird Project</h3>", unsafe_allow_html=True)
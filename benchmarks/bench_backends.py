@@ -0,0 +1,119 @@
+"""
+Inference backend benchmark: accuracy parity with the Keras model and CPU throughput.
+
+Exports the classifier to TFLite (float32, dynamic-range and int8 quantized) and, when
+tf2onnx and onnxruntime are installed, to ONNX. Every backend is then run on the same
+Stage-1 window inputs and Stage-2 chunk inputs (cut from --audio recordings, or random
+dB spectrograms) and compared with the Keras model. For each input kind it reports the
+maximum and mean absolute probability difference and the share of inputs where the
+stage's decision (THRESHOLD_STAGE1 or THRESHOLD_STAGE2) agrees. Throughput is reported
+in inputs per second at MAX_BATCH_SIZE. With --audio, the call counts of a full
+detection run are compared as well.
+
+Usage:
+    python benchmarks/bench_backends.py [--audio rec1.wav rec2.wav] [--threads 4] [--windows 256] [--chunks 1024]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.backends import (
+    OnnxModel,
+    TFLiteModel,
+    export_onnx,
+    export_tflite,
+    model_file_for,
+    representative_inputs,
+)
+from capuchin.detection import (
+    MAX_BATCH_SIZE,
+    THRESHOLD_STAGE1,
+    THRESHOLD_STAGE2,
+    detect_capuchin_calls,
+    predict_in_batches,
+)
+from capuchin.model import INPUT_SHAPES, MODEL_WEIGHTS_FILE, load_capuchin_model
+
+# Decision threshold of the stage that scores each input kind
+THRESHOLDS = {'window': THRESHOLD_STAGE1, 'chunk': THRESHOLD_STAGE2}
+
+
+# Probabilities for all inputs and the throughput (inputs per second) of the best of `repeats` runs
+def time_predictions(model, inputs, repeats):
+    predict_in_batches(model, inputs[:MAX_BATCH_SIZE])  # warm-up
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        probs = predict_in_batches(model, inputs)
+        best = min(best, time.perf_counter() - start)
+    return probs, len(inputs) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--audio", nargs="*", default=[], help="Recordings for inputs, calibration and detection")
+    parser.add_argument("--windows", type=int, default=256, help="Number of Stage-1 windows to score")
+    parser.add_argument("--chunks", type=int, default=1024, help="Number of Stage-2 chunks to score")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Backend runtime threads")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    keras_model = load_capuchin_model(args.weights)
+    n_inputs = {'window': args.windows, 'chunk': args.chunks}
+    inputs = {kind: representative_inputs(args.audio, n_inputs[kind], kind=kind) for kind in INPUT_SHAPES}
+    reference = {kind: time_predictions(keras_model, inputs[kind], args.repeats) for kind in INPUT_SHAPES}
+    models = {"keras": keras_model}
+
+    export_dir = tempfile.mkdtemp(prefix="capuchin_backends_")
+    for quantization in ("none", "dynamic", "int8"):
+        path = os.path.join(export_dir, f"model_{quantization}.tflite")
+        export_tflite(keras_model, path, quantization, representative_data=inputs)
+        models[f"tflite_{quantization}"] = TFLiteModel(path, num_threads=args.threads)
+    try:
+        path = export_onnx(keras_model, os.path.join(export_dir, "model.onnx"))
+        models["onnx"] = OnnxModel(path, num_threads=args.threads)
+    except ImportError as e:
+        print(f"Skipping ONNX: {e}")
+
+    results = {}
+    for name, model in models.items():
+        results[name] = {
+            "model_mb": (sum(os.path.getsize(model_file_for(model.model_path, kind)) for kind in INPUT_SHAPES) / 1e6
+                         if hasattr(model, "model_path") else None),
+        }
+        for kind in INPUT_SHAPES:
+            reference_probs = reference[kind][0]
+            probs, rate = reference[kind] if name == "keras" else time_predictions(model, inputs[kind], args.repeats)
+            diff = np.abs(probs - reference_probs)
+            results[name][kind] = {
+                "inputs_per_second": rate,
+                "max_abs_diff": float(diff.max()),
+                "mean_abs_diff": float(diff.mean()),
+                "decision_agreement": float(np.mean((probs > THRESHOLDS[kind]) == (reference_probs > THRESHOLDS[kind]))),
+            }
+        if args.audio:
+            results[name]["call_counts"] = [detect_capuchin_calls(path, model)["call_count"] for path in args.audio]
+
+    for name, row in results.items():
+        for kind in INPUT_SHAPES:
+            stats = row[kind]
+            print(f"{name:16s} {kind:6s} {stats['inputs_per_second']:9.1f} inputs/s  max |dp| {stats['max_abs_diff']:.4f}  "
+                  f"mean |dp| {stats['mean_abs_diff']:.4f}  agreement {stats['decision_agreement']:.3f}"
+                  + (f"  counts {row['call_counts']}" if args.audio and kind == 'window' else ""))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"threads": args.threads, "inputs": {kind: len(inputs[kind]) for kind in INPUT_SHAPES},
+                       "backends": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
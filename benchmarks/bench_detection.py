@@ -0,0 +1,284 @@
+"""
+Detection benchmark: throughput, memory and accuracy of the full detector on fixed fixtures.
+
+Fixtures are synthetic recordings of the given --lengths (noise with tone bursts at
+known times, written once at --sample-rate so loading includes resampling, and reused
+from --fixture-dir afterwards) plus, optionally, real recordings listed in a labels CSV
+with a 'file' column and a 'call_times' column holding a JSON list of call times in
+seconds (as for calibrate_gate.py).
+
+Every fixture is run through detect_capuchin_calls (the engine behind
+count_capuchin_calls_two_stage_sliding_window) in a fresh process, so the peak RSS is
+that of one detection. With --workers above 1 the fixture is split into shards run by
+that many worker processes (capuchin.parallel); their start-up is timed separately, the
+report also has the peak RSS of the largest worker, and model calls are not counted
+(inputs come from the instrumentation counters). The report has the wall time, the
+real-time factor (processing time / audio duration), peak RSS, the number of model calls
+and scored inputs, the time split into decoding, resampling, mel features (the
+detector's 'mel' timer), inference and the rest (Stage-0 gate and bookkeeping), and
+precision/recall against the labelled call times. A call counts as found when a
+detection covers its time (within --tolerance seconds). The time of
+extract_mel_spectrogram per Stage-1 window is measured separately.
+
+Results are written as JSON together with the current git commit; pass an earlier file
+with --compare to print the change of every case's real-time factor.
+
+Usage:
+    python benchmarks/bench_detection.py [--lengths 1m 1h 8h] [--labels labels.csv] [--output bench.json]
+"""
+import argparse
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.backends import BACKENDS, load_inference_model
+from capuchin.detection import TARGET_SR, WINDOW_DURATION_OUTER, detect_capuchin_calls, extract_mel_spectrogram
+from capuchin.model import MODEL_WEIGHTS_FILE
+from capuchin.parallel import ShardedDetector, default_threads
+
+LENGTH_UNITS = {"s": 1, "m": 60, "h": 3600}
+# Synthetic tone bursts per minute of audio
+CALLS_PER_MINUTE = 4
+CALL_DURATION = 1.2
+
+
+class CountingModel:
+    """Forwards to a model and counts its calls, scored inputs and time."""
+    def __init__(self, model):
+        self.model = model
+        self.calls = 0
+        self.inputs = 0
+        self.seconds = 0.0
+
+    def __call__(self, inputs, training=False):
+        start = time.perf_counter()
+        probs = self.model(inputs, training=training)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        self.inputs += len(inputs)
+        return probs
+
+
+def parse_length(text):
+    return float(text[:-1]) * LENGTH_UNITS[text[-1]] if text[-1] in LENGTH_UNITS else float(text)
+
+
+# Write a synthetic fixture block by block (8 hours do not fit in memory as float32) and return its call times
+def write_synthetic_fixture(path, seconds, sr, seed=0):
+    rng = np.random.default_rng(seed)
+    n_samples = int(seconds * sr)
+    call_samples = int(CALL_DURATION * sr)
+    n_calls = max(1, int(seconds / 60 * CALLS_PER_MINUTE))
+    call_starts = np.sort(rng.choice(max(1, (n_samples - call_samples) // call_samples), size=n_calls,
+                                     replace=False)) * call_samples
+    tone = (0.3 * np.sin(2 * np.pi * 900 * np.arange(call_samples) / sr)).astype(np.float32)
+    block_samples = 600 * sr
+    with sf.SoundFile(path, "w", samplerate=sr, channels=1, subtype="PCM_16") as f:
+        for block_start in range(0, n_samples, block_samples):
+            block = 0.01 * rng.standard_normal(min(block_samples, n_samples - block_start)).astype(np.float32)
+            for start in call_starts[(call_starts >= block_start) & (call_starts < block_start + len(block))]:
+                offset = start - block_start
+                end = min(offset + call_samples, len(block))
+                block[offset:end] += tone[:end - offset]
+            f.write(block)
+    return (call_starts + call_samples / 2) / sr
+
+
+# Match detections to labelled call times; each call and each detection is used at most once
+def precision_recall(call_timestamps, call_times, tolerance):
+    call_times = np.sort(np.asarray(call_times, dtype=float))
+    matched = np.zeros(len(call_times), dtype=bool)
+    true_positives = 0
+    for call in sorted(call_timestamps, key=lambda c: c["start_time"]):
+        inside = np.flatnonzero(~matched & (call_times >= call["start_time"] - tolerance)
+                                & (call_times <= call["end_time"] + tolerance))
+        if len(inside):
+            matched[inside[0]] = True
+            true_positives += 1
+    return {
+        "precision": true_positives / len(call_timestamps) if call_timestamps else None,
+        "recall": float(matched.mean()) if len(call_times) else None,
+    }
+
+
+# One benchmark case, run in its own process
+def run_case(case, model_options, options, tolerance, workers=1):
+    start = time.perf_counter()
+    if workers == 1:
+        model = CountingModel(load_inference_model(**model_options))
+    else:
+        model = None
+        detector = ShardedDetector(model_options, workers)
+        detector.wait_ready()
+    startup_seconds = time.perf_counter() - start
+    rss_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if model is not None:
+        result = detect_capuchin_calls(case["path"], model, **options)
+    else:
+        result = detector.detect(case["path"], **options)
+    wall_seconds = time.perf_counter() - start
+    if model is None:
+        # Terminated workers count towards RUSAGE_CHILDREN
+        detector.close()
+    timings = result["load_timings"]
+    instrumentation = result["instrumentation"]
+    mel_seconds = instrumentation["timings"]["mel"]
+    inference_seconds = model.seconds if model is not None else (
+        instrumentation["timings"]["stage1_inference"] + instrumentation["timings"]["stage2_inference"])
+    record = {
+        "name": case["name"],
+        "file": case["path"],
+        "audio_seconds": result["duration"],
+        "wall_seconds": wall_seconds,
+        "startup_seconds": startup_seconds,
+        "real_time_factor": wall_seconds / result["duration"],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_before_detection_mb": rss_before_kb / 1024,
+        "peak_worker_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 if model is None else None,
+        "workers": workers,
+        "model_calls": model.calls if model is not None else None,
+        "model_inputs": model.inputs if model is not None else (
+            instrumentation["counters"].get("windows_screened", 0)
+            + instrumentation["counters"].get("stage2_chunks_scored", 0)),
+        "decode_seconds": timings["decode_seconds"],
+        "resample_seconds": timings["resample_seconds"],
+        # Summed over the workers with --workers, so they can exceed the wall time
+        "mel_seconds": mel_seconds,
+        "inference_seconds": inference_seconds,
+        "other_seconds": (wall_seconds - timings["decode_seconds"] - timings["resample_seconds"] - mel_seconds
+                          - inference_seconds) if model is not None else None,
+        "call_count": result["call_count"],
+        "labelled_calls": None,
+        "precision": None,
+        "recall": None,
+    }
+    if case["call_times"] is not None:
+        record["labelled_calls"] = len(case["call_times"])
+        record.update(precision_recall(result["call_timestamps"], case["call_times"], tolerance))
+    return record
+
+
+# Seconds per Stage-1 window spent in extract_mel_spectrogram
+def time_mel_extraction(n_windows=50, seed=0):
+    rng = np.random.default_rng(seed)
+    windows = 0.1 * rng.standard_normal((n_windows, int(WINDOW_DURATION_OUTER * TARGET_SR))).astype(np.float32)
+    start = time.perf_counter()
+    for window in windows:
+        extract_mel_spectrogram(y=window, sr=TARGET_SR, target_time_frames=157)
+    return (time.perf_counter() - start) / n_windows
+
+
+def format_score(value):
+    return "-" if value is None else f"{value:.3f}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", nargs="*", default=["1m", "1h", "8h"],
+                        help="Synthetic fixture lengths, e.g. 30s, 1m, 1h (empty for none)")
+    parser.add_argument("--labels", help="CSV with 'file' and 'call_times' columns for real fixtures")
+    parser.add_argument("--fixture-dir", default=os.path.join(tempfile.gettempdir(), "capuchin_bench_fixtures"))
+    parser.add_argument("--sample-rate", type=int, default=44100, help="Sample rate of the synthetic fixtures")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--backend", default="keras", choices=BACKENDS)
+    parser.add_argument("--backend-model", default=None)
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads per model (default: CPU count / workers)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes splitting each fixture into shards")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--spectrogram-cache", action="store_true")
+    parser.add_argument("--gate-threshold", type=float, default=None)
+    parser.add_argument("--window-hop", type=float, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Seconds a detection may miss a call by")
+    parser.add_argument("--output", default="bench_detection.json")
+    parser.add_argument("--compare", help="Earlier results file to compare real-time factors with")
+    args = parser.parse_args()
+
+    cases = []
+    os.makedirs(args.fixture_dir, exist_ok=True)
+    for length in args.lengths:
+        seconds = parse_length(length)
+        path = os.path.join(args.fixture_dir, f"synthetic_{length}_{args.sample_rate}.wav")
+        labels_path = path + ".json"
+        if not (os.path.exists(path) and os.path.exists(labels_path)):
+            print(f"Writing {length} fixture to {path}")
+            with open(labels_path, "w") as f:
+                json.dump(write_synthetic_fixture(path, seconds, args.sample_rate).tolist(), f)
+        with open(labels_path) as f:
+            cases.append({"name": f"synthetic_{length}", "path": path, "call_times": json.load(f)})
+    if args.labels:
+        labels = pd.read_csv(args.labels)
+        base_dir = os.path.dirname(os.path.abspath(args.labels))
+        for _, row in labels.iterrows():
+            path = row["file"] if os.path.isabs(row["file"]) else os.path.join(base_dir, row["file"])
+            call_times = json.loads(row["call_times"]) if isinstance(row.get("call_times"), str) else None
+            cases.append({"name": os.path.basename(path), "path": path, "call_times": call_times})
+
+    model_options = {"backend": args.backend, "model_path": args.backend_model, "weights_file": args.weights,
+                     "num_threads": args.threads or default_threads(args.workers),
+                     "inter_op_threads": 1 if args.workers > 1 else None}
+    options = {"streaming": args.streaming, "spectrogram_cache": args.spectrogram_cache,
+               "gate_threshold": args.gate_threshold, "window_hop_outer": args.window_hop}
+
+    # 'spawn' gives every case a fresh process, so ru_maxrss is the peak of that case alone;
+    # the case process is not a daemon, so it can start the shard workers
+    context = multiprocessing.get_context("spawn")
+    records = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            record = pool.submit(run_case, case, model_options, options, args.tolerance, args.workers).result()
+        records.append(record)
+        print(f"{record['name']:24s} RTF {record['real_time_factor']:.4f}  wall {record['wall_seconds']:8.1f}s  "
+              f"RSS {record['peak_rss_mb']:7.0f} MB  model inputs {record['model_inputs']:6d}  "
+              f"calls {record['call_count']}"
+              + (f"  precision {format_score(record['precision'])} recall {format_score(record['recall'])}"
+                 if record['labelled_calls'] is not None else ""))
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": model_options,
+        "options": options,
+        "mel_seconds_per_window": time_mel_extraction(),
+        "cases": records,
+    }
+    print(f"extract_mel_spectrogram: {report['mel_seconds_per_window'] * 1000:.2f} ms per Stage-1 window")
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {case["name"]: case for case in json.load(f)["cases"]}
+        for record in records:
+            if record["name"] in previous:
+                before = previous[record["name"]]["real_time_factor"]
+                print(f"{record['name']:24s} RTF {before:.4f} -> {record['real_time_factor']:.4f} "
+                      f"({record['real_time_factor'] / before - 1:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Model-input benchmark: 3-channel copies vs. single-channel batches.
+
+Builds one Stage-1 batch (max_batch_size outer windows) and the Stage-2 batch of their
+inner chunks from random dB spectrograms and scores them in two ways with the same
+weights: by copying each spectrogram into 3 channels and calling the 3-channel
+classifier (the model before it took one channel), and with to_model_input on the
+extractor's (N, n_mels, frames) output and the single-channel model, which copies the
+channel inside the graph. Reports the peak memory allocated in Python while building the
+batch (tracemalloc), the size of the batch handed to the model, and the time per call of
+the whole path, input building plus model(batch).
+
+Usage:
+    python benchmarks/bench_model_input.py [--weights file.weights.h5] [--batch-size 64] [--repeats 5]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.detection import MAX_BATCH_SIZE, to_model_input
+from capuchin.model import CHUNK_INPUT_SHAPE, INPUT_SHAPE, MODEL_WEIGHTS_FILE, load_capuchin_model
+
+# 0.3 s Stage-2 chunks per 6 s outer window
+CHUNKS_PER_WINDOW = 20
+
+
+# The model input before the model took one channel
+def three_channel_input(mel_specs):
+    return np.stack([np.stack([mel_spec] * 3, axis=-1) for mel_spec in mel_specs])
+
+
+# Peak traced allocation (MB) and batch size (MB) of build(mel_specs), and seconds per model(build(mel_specs))
+def measure(build, model, mel_specs, repeats):
+    tracemalloc.start()
+    batch = build(mel_specs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    model(batch, training=False)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        np.asarray(model(build(mel_specs), training=False))
+    return peak / 1e6, batch.nbytes / 1e6, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="Outer windows per Stage-1 batch")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    model = load_capuchin_model(args.weights)
+    rng = np.random.default_rng(0)
+    stages = {
+        'stage1': ('window', (args.batch_size,) + INPUT_SHAPE[:2]),
+        'stage2': ('chunk', (args.batch_size * CHUNKS_PER_WINDOW,) + CHUNK_INPUT_SHAPE[:2]),
+    }
+    results = {}
+    for stage, (kind, shape) in stages.items():
+        mel_specs = rng.uniform(-80.0, 0.0, size=shape).astype(np.float32)
+        single_channel = model.models[kind]
+        # The single-channel model's last layer is the 3-channel classifier it copies the channel into
+        paths = (('three_channel', three_channel_input, single_channel.layers[-1]),
+                 ('single_channel', to_model_input, single_channel))
+        for name, build, keras_model in paths:
+            peak_mb, batch_mb, seconds = measure(build, keras_model, mel_specs, args.repeats)
+            results[f"{stage}_{name}"] = {'peak_alloc_mb': peak_mb, 'batch_mb': batch_mb, 'ms': seconds * 1000}
+    for key, value in results.items():
+        print(f"{key:24s} peak alloc {value['peak_alloc_mb']:8.2f} MB  batch {value['batch_mb']:7.2f} MB  "
+              f"{value['ms']:9.2f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
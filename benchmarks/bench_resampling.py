@@ -0,0 +1,83 @@
+"""
+Resampler benchmark: load time and detection counts for each resampling backend.
+
+The reference set is a CSV with a 'file' column and an 'expected_calls' column holding
+the labelled number of call windows per recording. For every resampler the script
+reports the mean load time per file and the detection counts against the labels and
+against 'kaiser_best' (the resampler used before RESAMPLE_TYPE was introduced), and
+recommends the fastest resampler whose counts stay within --tolerance of the labels'
+error under kaiser_best.
+
+Usage:
+    python benchmarks/bench_resampling.py labels.csv [--weights path] [--res-types soxr_hq polyphase]
+"""
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.detection import RESAMPLE_TYPES, detect_capuchin_calls
+from capuchin.model import MODEL_WEIGHTS_FILE, load_capuchin_model
+
+REFERENCE_RES_TYPE = "kaiser_best"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("labels", help="CSV with 'file' and 'expected_calls' columns")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--res-types", nargs="+", default=list(RESAMPLE_TYPES), choices=RESAMPLE_TYPES)
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="Allowed increase of the mean absolute count error over kaiser_best")
+    parser.add_argument("--output", help="Optional JSON file for the per-file results")
+    args = parser.parse_args()
+
+    labels = pd.read_csv(args.labels)
+    base_dir = os.path.dirname(os.path.abspath(args.labels))
+    files = [path if os.path.isabs(path) else os.path.join(base_dir, path) for path in labels["file"]]
+    model = load_capuchin_model(args.weights)
+
+    res_types = list(dict.fromkeys([REFERENCE_RES_TYPE] + args.res_types))
+    rows = []
+    for res_type in res_types:
+        for path, expected in zip(files, labels["expected_calls"]):
+            result = detect_capuchin_calls(path, model, res_type=res_type)
+            timings = result["load_timings"]
+            rows.append({
+                "res_type": res_type,
+                "file": path,
+                "expected_calls": int(expected),
+                "detected_calls": result["call_count"],
+                "decode_seconds": timings["decode_seconds"],
+                "resample_seconds": timings["resample_seconds"],
+            })
+    df = pd.DataFrame(rows)
+    reference = df[df["res_type"] == REFERENCE_RES_TYPE].set_index("file")["detected_calls"]
+    df["load_seconds"] = df["decode_seconds"] + df["resample_seconds"]
+    df["count_error"] = (df["detected_calls"] - df["expected_calls"]).abs()
+    df["differs_from_reference"] = df["detected_calls"].values != reference.loc[df["file"]].values
+
+    summary = df.groupby("res_type").agg(
+        load_seconds=("load_seconds", "mean"),
+        resample_seconds=("resample_seconds", "mean"),
+        mean_count_error=("count_error", "mean"),
+        files_differing_from_reference=("differs_from_reference", "sum"),
+    ).sort_values("load_seconds")
+    print(summary.to_string())
+
+    allowed_error = summary.loc[REFERENCE_RES_TYPE, "mean_count_error"] + args.tolerance
+    candidates = summary[summary["mean_count_error"] <= allowed_error]
+    print(f"\nRecommended RESAMPLE_TYPE: {candidates.index[0]}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"summary": json.loads(summary.to_json(orient="index")),
+                       "files": df.to_dict(orient="records")}, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Feature-extraction benchmark: per-window mel spectrograms vs. the full-file MelSpectrogramCache.
+
+Reports the time spent building Stage-1 and Stage-2 inputs for every window of a
+recording (as if Stage 1 flagged all of them), scaled to seconds per hour of audio,
+and the dB deviation of the cached slices from per-window extraction.
+
+Usage:
+    python benchmarks/bench_spectrogram_cache.py [--audio path.wav] [--minutes 10]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import librosa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.detection import (
+    STEP_DURATION_INNER,
+    TARGET_SR,
+    WINDOW_DURATION_OUTER,
+    MelSpectrogramCache,
+    extract_mel_spectrogram,
+    extract_mel_spectrogram_batch,
+)
+
+
+def synthetic_audio(minutes, sr, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(minutes * 60 * sr)
+    y = 0.01 * rng.standard_normal(n).astype(np.float32)
+    t = np.arange(int(1.2 * sr)) / sr
+    tone = (0.3 * np.sin(2 * np.pi * 900 * t)).astype(np.float32)
+    for start in rng.integers(0, n - len(tone), size=max(1, int(minutes * 4))):
+        y[start:start + len(tone)] += tone
+    return y
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--audio", help="Recording to benchmark (default: synthetic noise with tones)")
+    parser.add_argument("--minutes", type=float, default=10.0, help="Length of the synthetic recording")
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    sr = TARGET_SR
+    if args.audio:
+        y, _ = librosa.load(args.audio, sr=sr, res_type="kaiser_best")
+    else:
+        y = synthetic_audio(args.minutes, sr)
+    hours = len(y) / sr / 3600.0
+
+    window_samples = int(WINDOW_DURATION_OUTER * sr)
+    chunk_samples = int(STEP_DURATION_INNER * sr)
+    window_starts = np.arange(0, len(y) - window_samples + 1, window_samples)
+    chunk_starts = np.arange(0, len(y) - chunk_samples + 1, chunk_samples)
+
+    # Per-window extraction, as done by the two-pass detector without the cache
+    start = time.perf_counter()
+    stage1_ref = extract_mel_spectrogram_batch(
+        np.stack([y[s:s + window_samples] for s in window_starts]), sr, target_time_frames=157)
+    stage1_time = time.perf_counter() - start
+    start = time.perf_counter()
+    stage2_ref = np.stack([extract_mel_spectrogram(y=y[s:s + chunk_samples], sr=sr) for s in chunk_starts])
+    stage2_time = time.perf_counter() - start
+
+    # Cached extraction: one pass over the file, then frame slicing
+    start = time.perf_counter()
+    cache = MelSpectrogramCache(y, sr)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    stage1_cached = cache.mel_db_batch(window_starts, window_samples, target_time_frames=157)
+    stage2_cached = cache.mel_db_batch(chunk_starts, chunk_samples)
+    slice_time = time.perf_counter() - start
+
+    stage1_diff = np.abs(stage1_cached - stage1_ref)
+    stage2_diff = np.abs(stage2_cached - stage2_ref)
+    results = {
+        "audio_hours": hours,
+        "per_window_stage1_s_per_hour": stage1_time / hours,
+        "per_window_stage2_s_per_hour": stage2_time / hours,
+        "cache_build_s_per_hour": build_time / hours,
+        "cache_slice_s_per_hour": slice_time / hours,
+        "saved_s_per_hour": (stage1_time + stage2_time - build_time - slice_time) / hours,
+        "stage1_max_abs_db": float(stage1_diff.max()),
+        "stage1_interior_max_abs_db": float(stage1_diff[..., 2:-2].max()),
+        "stage1_mean_abs_db": float(stage1_diff.mean()),
+        "stage2_max_abs_db": float(stage2_diff.max()),
+        "stage2_mean_abs_db": float(stage2_diff.mean()),
+    }
+    for key, value in results.items():
+        print(f"{key:32s} {value:10.4f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Start-up benchmark: cold and warm latency of the first detection with the Keras model.
+
+Every case runs in a fresh process on a short synthetic recording, with Stage 1
+escalating every window so both the Stage-1 and the Stage-2 input shapes run. It reports
+the time to load the model, to warm it up (warm_up_model), and to run the first and a
+second detection:
+
+- build: the architecture is built and the weights loaded (load_capuchin_model)
+- savedmodel: the pre-traced SavedModel is loaded (load_saved_model)
+- build_prewarmed / savedmodel_prewarmed: the same, with the warm-up before the first
+  detection, as the app does in the background at start
+
+The SavedModel is exported to --saved-model first if it is missing or stale. The time to
+import the modules of the Upload Audio page, which no longer import TensorFlow, is
+reported next to the time of importing TensorFlow.
+
+Usage:
+    python benchmarks/bench_startup.py [--weights path.weights.h5] [--length 1m] [--output bench_startup.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_detection import parse_length, write_synthetic_fixture
+from capuchin.detection import TARGET_SR
+from capuchin.model import MODEL_WEIGHTS_FILE
+
+CASES = ('build', 'savedmodel', 'build_prewarmed', 'savedmodel_prewarmed')
+# Modules imported by pages/Upload_Audio.py
+PAGE_MODULES = ('capuchin.analysis', 'capuchin.backends', 'capuchin.cache', 'capuchin.detection', 'capuchin.jobs',
+                'capuchin.rendering', 'capuchin.server', 'capuchin.store')
+
+
+# Seconds to import the page's modules and then TensorFlow, in a fresh process
+def time_imports():
+    import importlib
+
+    start = time.perf_counter()
+    for name in PAGE_MODULES:
+        importlib.import_module(name)
+    page_seconds = time.perf_counter() - start
+    page_imports_tensorflow = 'tensorflow' in sys.modules
+    start = time.perf_counter()
+    import tensorflow  # noqa: F401
+    return {'page_import_seconds': page_seconds, 'page_imports_tensorflow': page_imports_tensorflow,
+            'tensorflow_import_seconds': time.perf_counter() - start}
+
+
+# One case, run in its own process
+def run_case(case, audio_path, weights_file, saved_model_dir):
+    from capuchin.detection import detect_capuchin_calls
+    from capuchin.model import load_capuchin_model, load_saved_model, warm_up_model
+
+    start = time.perf_counter()
+    import tensorflow  # noqa: F401
+    import_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    if case.startswith('savedmodel'):
+        model = load_saved_model(weights_file, saved_model_dir)
+    else:
+        model = load_capuchin_model(weights_file)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    if case.endswith('prewarmed'):
+        warm_up_model(model)
+    warmup_seconds = time.perf_counter() - start
+    detections = []
+    for _ in range(2):
+        start = time.perf_counter()
+        detect_capuchin_calls(audio_path, model, threshold_stage1=0.0)
+        detections.append(time.perf_counter() - start)
+    return {
+        'case': case,
+        'tensorflow_import_seconds': import_seconds,
+        'load_seconds': load_seconds,
+        'warmup_seconds': warmup_seconds,
+        'first_detection_seconds': detections[0],
+        'second_detection_seconds': detections[1],
+        # From process start to the first result, without the warm-up a background thread hides
+        'cold_latency_seconds': import_seconds + load_seconds + detections[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--saved-model", default=os.path.join(tempfile.gettempdir(), "capuchin_bench_savedmodel"))
+    parser.add_argument("--length", default="1m", help="Length of the synthetic recording, e.g. 30s, 1m")
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_path = os.path.join(tmp_dir, "startup.wav")
+        write_synthetic_fixture(audio_path, parse_length(args.length), TARGET_SR)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            imports = pool.submit(time_imports).result()
+        print(f"Upload page imports: {imports['page_import_seconds']:.2f} s "
+              f"(TensorFlow imported: {imports['page_imports_tensorflow']}); "
+              f"import tensorflow: {imports['tensorflow_import_seconds']:.2f} s")
+
+        from capuchin.model import export_saved_model, load_saved_model
+        if load_saved_model(args.weights, args.saved_model) is None:
+            start = time.perf_counter()
+            export_saved_model(args.weights, args.saved_model)
+            print(f"Exported the SavedModel to {args.saved_model} in {time.perf_counter() - start:.1f} s")
+
+        records = []
+        for case in CASES:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                record = pool.submit(run_case, case, audio_path, args.weights, args.saved_model).result()
+            records.append(record)
+            print(f"{case:22s} load {record['load_seconds']:6.2f} s  warm-up {record['warmup_seconds']:6.2f} s  "
+                  f"first detection {record['first_detection_seconds']:6.2f} s  "
+                  f"second {record['second_detection_seconds']:6.2f} s  cold {record['cold_latency_seconds']:6.2f} s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({'imports': imports, 'cases': records}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Stage-0 gate calibration: fraction of windows skipped and recall for a range of gate thresholds.
+
+The labelled set is a CSV with a 'file' column and an 'expected_calls' column (as for
+bench_resampling.py), plus an optional 'call_times' column holding a JSON list of call
+times in seconds. Windows containing a labelled call are the positives; without
+'call_times' the positives are the windows in which the ungated detector reports a call,
+so recall then measures how many of its detections the gate keeps.
+
+The detector runs once per file without the gate. Since the gate only removes windows,
+the gated result for every threshold follows from the band_energy_scores of the windows
+without running the model again. The script recommends the highest threshold whose
+recall stays at or above --min-recall.
+
+Usage:
+    python benchmarks/calibrate_gate.py labels.csv [--min-recall 0.99] [--backend tflite]
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capuchin.backends import BACKENDS, load_inference_model
+from capuchin.detection import (
+    GATE_BAND_HZ,
+    MAX_BATCH_SIZE,
+    WINDOW_DURATION_OUTER,
+    band_energy_scores,
+    detect_capuchin_calls,
+    load_audio,
+    outer_window_starts,
+)
+from capuchin.model import MODEL_WEIGHTS_FILE
+
+
+# Stage-0 score of every outer window of a recording, computed block by block
+def window_scores(y, sr, band):
+    window_samples = int(WINDOW_DURATION_OUTER * sr)
+    bounds = [(start, min(start + window_samples, len(y)))
+              for _, start in outer_window_starts(len(y) / sr, WINDOW_DURATION_OUTER, sr)]
+    scores = np.zeros(len(bounds))
+    for block_start in range(0, len(bounds), MAX_BATCH_SIZE):
+        block = np.arange(block_start, min(block_start + MAX_BATCH_SIZE, len(bounds)))
+        lengths = np.array([bounds[i][1] - bounds[i][0] for i in block])
+        for length in np.unique(lengths):
+            indices = block[lengths == length]
+            scores[indices] = band_energy_scores(np.stack([y[bounds[i][0]:bounds[i][1]] for i in indices]), sr, band)
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("labels", help="CSV with 'file', 'expected_calls' and optionally 'call_times' columns")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE)
+    parser.add_argument("--backend", default="keras", choices=BACKENDS)
+    parser.add_argument("--backend-model", default=None)
+    parser.add_argument("--band", nargs=2, type=float, default=GATE_BAND_HZ, metavar=("LOW_HZ", "HIGH_HZ"))
+    parser.add_argument("--thresholds", nargs=3, type=float, default=(-90.0, -20.0, 2.5),
+                        metavar=("FIRST", "LAST", "STEP"), help="Gate thresholds to evaluate, in dBFS")
+    parser.add_argument("--min-recall", type=float, default=0.99)
+    parser.add_argument("--output", help="Optional JSON file for the results")
+    args = parser.parse_args()
+
+    labels = pd.read_csv(args.labels)
+    base_dir = os.path.dirname(os.path.abspath(args.labels))
+    model = load_inference_model(args.backend, args.backend_model, args.weights)
+
+    files = []
+    for _, row in labels.iterrows():
+        path = row["file"] if os.path.isabs(row["file"]) else os.path.join(base_dir, row["file"])
+        y, sr, _ = load_audio(path)
+        scores = window_scores(y, sr, args.band)
+        result = detect_capuchin_calls(path, model)
+        detected = np.zeros(len(scores), dtype=bool)
+        detected[[int(round(call["start_time"] / WINDOW_DURATION_OUTER)) for call in result["call_timestamps"]]] = True
+        if "call_times" in labels.columns and isinstance(row["call_times"], str):
+            positives = np.zeros(len(scores), dtype=bool)
+            positives[[min(int(t // WINDOW_DURATION_OUTER), len(scores) - 1) for t in json.loads(row["call_times"])]] = True
+        else:
+            positives = detected
+        files.append({"file": path, "expected_calls": int(row["expected_calls"]),
+                      "scores": scores, "detected": detected, "positives": positives})
+
+    first, last, step = args.thresholds
+    rows = []
+    for threshold in np.arange(first, last + step / 2, step):
+        kept = [f["scores"] >= threshold for f in files]
+        n_windows = sum(len(k) for k in kept)
+        n_positives = sum(int(f["positives"].sum()) for f in files)
+        rows.append({
+            "threshold_db": float(threshold),
+            "skipped_fraction": 1.0 - sum(int(k.sum()) for k in kept) / max(n_windows, 1),
+            "recall": sum(int((f["positives"] & k).sum()) for f, k in zip(files, kept)) / n_positives
+            if n_positives else 1.0,
+            "mean_count_error": float(np.mean([abs(int((f["detected"] & k).sum()) - f["expected_calls"])
+                                               for f, k in zip(files, kept)])),
+        })
+    table = pd.DataFrame(rows)
+    ungated_error = float(np.mean([abs(int(f["detected"].sum()) - f["expected_calls"]) for f in files]))
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    print(f"\nUngated mean count error: {ungated_error:.3f}")
+
+    candidates = table[table["recall"] >= args.min_recall]
+    recommended = None
+    if len(candidates):
+        recommended = candidates.iloc[-1]
+        print(f"Recommended gate threshold: {recommended['threshold_db']:.1f} dBFS "
+              f"(skips {recommended['skipped_fraction']:.0%} of windows, recall {recommended['recall']:.3f})")
+    else:
+        print(f"No threshold reaches recall {args.min_recall}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"band_hz": list(args.band), "ungated_mean_count_error": ungated_error,
+                       "recommended_threshold_db": None if recommended is None else recommended["threshold_db"],
+                       "thresholds": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
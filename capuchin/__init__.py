@@ -0,0 +1,26 @@
+"""
+Capuchin bird call detection, usable outside the Streamlit app.
+
+The detector names below are imported from capuchin.detection on first use, so light
+submodules such as capuchin.knowledge can be imported without librosa.
+"""
+_DETECTION_EXPORTS = (
+    'TARGET_SR',
+    'THRESHOLD_STAGE1',
+    'THRESHOLD_STAGE2',
+    'WINDOW_DURATION_OUTER',
+    'STEP_DURATION_INNER',
+    'count_capuchin_calls_two_stage_sliding_window',
+    'detect_capuchin_calls',
+    'extract_mel_spectrogram',
+    'run_two_pass_detection',
+    'stream_capuchin_detections',
+)
+__all__ = list(_DETECTION_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _DETECTION_EXPORTS:
+        from capuchin import detection
+        return getattr(detection, name)
+    raise AttributeError(f"module 'capuchin' has no attribute {name!r}")
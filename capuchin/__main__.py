@@ -0,0 +1,5 @@
+import sys
+
+from capuchin.cli import main
+
+sys.exit(main())
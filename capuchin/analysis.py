@@ -0,0 +1,166 @@
+"""
+General audio analysis features (spectrogram, tempo, HPSS, RMS, ZCR, mel, MFCC), computed
+lazily per recording.
+"""
+import logging
+from collections.abc import MutableMapping
+
+import numpy as np
+import librosa
+
+logger = logging.getLogger(__name__)
+
+
+def compute_spectrogram(y, sr):
+    return {'spectrogram': librosa.amplitude_to_db(np.abs(librosa.stft(y)), ref=np.max)}
+
+
+def compute_tempo(y, sr):
+    try:
+        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        return {'tempo': float(np.atleast_1d(tempo)[0])}
+    except Exception as e:
+        logger.warning("Could not extract tempo: %s", e)
+        return {'tempo': 0.0}
+
+
+# Harmonic and percussive components come from the same separation, so both are stored together
+def compute_hpss(y, sr):
+    harmonic, percussive = librosa.effects.hpss(y)
+    return {'harmonic': harmonic, 'percussive': percussive}
+
+
+def compute_rms(y, sr):
+    return {'rms': librosa.feature.rms(y=y)[0]}
+
+
+def compute_zcr(y, sr):
+    return {'zcr': librosa.feature.zero_crossing_rate(y)[0]}
+
+
+def compute_mel(y, sr):
+    return {'mel': librosa.feature.melspectrogram(y=y, sr=sr)}
+
+
+def compute_mfccs(y, sr):
+    return {'mfccs': librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)}
+
+
+# Sums of values over frames of frame_length starting every hop_length samples, for each row
+def _frame_sums(values, frame_length, hop_length, n_frames):
+    cumulative = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(values, axis=1, out=cumulative[:, 1:])
+    starts = np.arange(n_frames) * hop_length
+    return cumulative[:, starts + frame_length] - cumulative[:, starts]
+
+
+# Mean RMS energy and zero crossing rate of consecutive fixed-length segments
+def segment_energy_zcr(y, sr, segment_length, frame_length=2048, hop_length=512,
+                       zcr_threshold=1e-10, block_segments=64):
+    """
+    Returns (rms, zcr) arrays with one value per full segment_length-second segment,
+    matching the mean of librosa.feature.rms / zero_crossing_rate run on each segment
+    separately (same framing, centering and padding). The segments are a reshaped view
+    of the waveform, and frame sums come from cumulative sums instead of framed copies,
+    so the cost is a few passes over the signal regardless of the segment count.
+    """
+    samples_per_segment = int(segment_length * sr)
+    num_segments = len(y) // samples_per_segment if samples_per_segment > 0 else 0
+    rms = np.zeros(num_segments)
+    zcr = np.zeros(num_segments)
+    segments = np.asarray(y)[:num_segments * samples_per_segment].reshape(num_segments, samples_per_segment)
+    n_frames = 1 + samples_per_segment // hop_length
+    pad = frame_length // 2
+    for start in range(0, num_segments, block_segments):
+        block = segments[start:start + block_segments].astype(np.float64)
+        # RMS frames: zero padding (librosa's default for rms with center=True)
+        power = np.pad(block ** 2, ((0, 0), (pad, pad)))
+        frame_rms = np.sqrt(_frame_sums(power, frame_length, hop_length, n_frames) / frame_length)
+        rms[start:start + len(block)] = frame_rms.mean(axis=1)
+        # ZCR frames: edge padding; samples within the threshold of zero count as positive,
+        # and the first sample of a frame never counts as a crossing
+        negative = np.pad(block, ((0, 0), (pad, pad)), mode='edge') < -zcr_threshold
+        crossings = np.zeros(negative.shape)
+        crossings[:, 1:] = negative[:, 1:] != negative[:, :-1]
+        frame_crossings = _frame_sums(crossings[:, 1:], frame_length - 1, hop_length, n_frames)
+        zcr[start:start + len(block)] = (frame_crossings / frame_length).mean(axis=1)
+    return rms, zcr
+
+
+# Feature name -> function computing it (and any features produced alongside it)
+FEATURES = {
+    'spectrogram': compute_spectrogram,
+    'tempo': compute_tempo,
+    'harmonic': compute_hpss,
+    'percussive': compute_hpss,
+    'rms': compute_rms,
+    'zcr': compute_zcr,
+    'mel': compute_mel,
+    'mfccs': compute_mfccs,
+}
+
+
+class LazyAnalysis(MutableMapping):
+    """
+    Analysis results for one recording, used like the plain results dict it replaces.
+
+    The basic entries (filename, duration, sample_rate, waveform) are stored when the
+    object is created. Entries listed in FEATURES are computed from the waveform the
+    first time they are read and then kept. Membership tests (``'tempo' in results``)
+    and iteration only see entries that exist already, so checking for a feature never
+    triggers its computation; use is_computed / available_features to inspect them.
+    Other entries, such as detection results, are set and read like in a dict.
+
+    With a store (capuchin.store.FeatureStore), features are computed into its files
+    and kept as read-only memory maps, and the waveform should be the store's own.
+    """
+    def __init__(self, filename, waveform, sample_rate, duration=None, store=None, **entries):
+        self._entries = {
+            'filename': filename,
+            'duration': duration if duration is not None else librosa.get_duration(y=waveform, sr=sample_rate),
+            'sample_rate': sample_rate,
+            'waveform': waveform,
+        }
+        self._entries.update(entries)
+        self.store = store
+        self._segment_tables = {}
+
+    def __getitem__(self, key):
+        if key not in self._entries:
+            if key not in FEATURES:
+                raise KeyError(key)
+            y, sr = self._entries['waveform'], self._entries['sample_rate']
+            if self.store is None:
+                self._entries.update(FEATURES[key](y, sr))
+            else:
+                self._entries.update(self.store.feature(key, y, sr))
+        return self._entries[key]
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def is_computed(self, key):
+        return key in self._entries
+
+    # Per-segment (rms, zcr) arrays, computed once per segment length
+    def segment_stats(self, segment_length):
+        if segment_length not in self._segment_tables:
+            self._segment_tables[segment_length] = segment_energy_zcr(
+                self._entries['waveform'], self._entries['sample_rate'], segment_length)
+        return self._segment_tables[segment_length]
+
+    @staticmethod
+    def available_features():
+        return list(FEATURES)
@@ -0,0 +1,22 @@
+"""
+Process-wide resources of the Streamlit pages.
+
+Each resource is created once per app process with st.cache_resource and shared by all
+sessions and pages, so every page sees the same job queue and result cache.
+"""
+import streamlit as st
+
+from capuchin.cache import ResultCache
+from capuchin.jobs import JobQueue
+
+
+# Detection result cache and upload storage shared by all sessions
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
+
+
+# Background detection jobs shared by all sessions; finished results go to the result cache
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(result_cache=get_result_cache())
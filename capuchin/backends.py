@@ -0,0 +1,312 @@
+"""
+Inference backends for the capuchin classifier: export the Keras model to TFLite
+(float32, dynamic-range or int8 quantized) or ONNX, and run the exported file on CPU
+with a configurable number of threads.
+
+Backend models are called like the Keras model (``model(batch, training=False)``) and
+return a (N, 1) array of probabilities, so they can be passed anywhere a model is
+expected in capuchin.detection.
+
+Like the Keras model, an export has one model per detector input width (INPUT_SHAPES):
+the Stage-1 window model is written to the export path and the Stage-2 chunk model
+next to it (model_file_for), each with a fixed width. Backend models keep one
+interpreter or session per input kind in ``models`` and only ever resize the batch
+dimension.
+
+Export example:
+    python -m capuchin.backends --format tflite --quantization int8 --calibration-audio recordings/
+
+The TFLite runtime comes from ai_edge_litert or tflite_runtime when installed, and
+from TensorFlow otherwise. ONNX export needs tf2onnx and ONNX inference onnxruntime.
+The Keras backend loads the pre-traced SavedModel (--format savedmodel) when it was
+exported from the current weights, and builds the model from the weights otherwise.
+"""
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from capuchin.model import INPUT_SHAPES, MODEL_WEIGHTS_FILE, SAVED_MODEL_DIR, input_kind
+
+BACKENDS = ('keras', 'tflite', 'onnx')
+QUANTIZATIONS = ('none', 'dynamic', 'int8')
+# Default locations of exported models, next to the Keras weights
+EXPORT_PATHS = {
+    'tflite': 'weights/capuchin_bird_classifier.tflite',
+    'onnx': 'weights/capuchin_bird_classifier.onnx',
+}
+
+
+# TFLite Interpreter class from the lightest runtime available
+def _tflite_interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+# Path of the exported model for one input kind: the window model at model_path, the others next to it
+def model_file_for(model_path, kind='window'):
+    if kind == 'window':
+        return model_path
+    root, ext = os.path.splitext(model_path)
+    return f"{root}.{kind}{ext}"
+
+
+# Model inputs of one kind from calibration recordings (or random dB spectrograms without any)
+def representative_inputs(audio_paths=(), n_samples=100, seed=0, kind='window'):
+    """
+    Windows are cut from the recordings back to back, 6 s long for 'window' inputs and
+    0.3 s for 'chunk' inputs, and transformed like the detector's inputs of that kind.
+    """
+    from capuchin.detection import (
+        STEP_DURATION_INNER,
+        TARGET_SR,
+        WINDOW_DURATION_OUTER,
+        extract_mel_spectrogram_batch,
+        load_audio,
+        to_model_input,
+    )
+    input_shape = INPUT_SHAPES[kind]
+    duration = WINDOW_DURATION_OUTER if kind == 'window' else STEP_DURATION_INNER
+    segment_samples = int(duration * TARGET_SR)
+    mel_specs = []
+    for path in audio_paths:
+        y, sr, _ = load_audio(path)
+        segments = [y[start:start + segment_samples] for start in range(0, len(y) - segment_samples + 1, segment_samples)]
+        if segments:
+            mel_specs.extend(extract_mel_spectrogram_batch(np.stack(segments[:n_samples]), sr,
+                                                           target_time_frames=input_shape[1]))
+        if len(mel_specs) >= n_samples:
+            break
+    if not mel_specs:
+        rng = np.random.default_rng(seed)
+        mel_specs = list(rng.uniform(-80.0, 0.0, size=(n_samples,) + input_shape[:2]).astype(np.float32))
+    return to_model_input(mel_specs[:n_samples])
+
+
+# Convert the classifier's Keras models to TFLite flatbuffers; int8 needs representative inputs for calibration
+def export_tflite(model, output_path, quantization='none', representative_data=None):
+    """
+    model is a capuchin.model.CapuchinClassifier; every input kind is converted with its
+    fixed width to model_file_for(output_path, kind). quantization is 'none' (float32),
+    'dynamic' (int8 weights, float activations) or 'int8' (int8 weights and activations,
+    calibrated on representative_data[kind], or on random inputs). The models keep
+    float32 inputs and outputs in every case.
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    for kind, keras_model in model.models.items():
+        converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+        if quantization != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'int8':
+            samples = (representative_data or {}).get(kind)
+            if samples is None:
+                samples = representative_inputs(kind=kind)
+            converter.representative_dataset = lambda samples=samples: ([sample[np.newaxis]] for sample in samples)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        with open(model_file_for(output_path, kind), 'wb') as f:
+            f.write(converter.convert())
+    return output_path
+
+
+# Convert the classifier's Keras models to ONNX, each with a dynamic batch axis and its fixed width
+def export_onnx(model, output_path, opset=13):
+    import tensorflow as tf
+    import tf2onnx
+
+    for kind, keras_model in model.models.items():
+        input_signature = [tf.TensorSpec((None,) + INPUT_SHAPES[kind], tf.float32, name='input')]
+        tf2onnx.convert.from_keras(keras_model, input_signature=input_signature, opset=opset,
+                                   output_path=model_file_for(output_path, kind))
+    return output_path
+
+
+# Float32 model inputs with the channel count of an exported model (older exports take 3 copies)
+def _with_channels(inputs, channels):
+    inputs = np.asarray(inputs, dtype=np.float32)
+    if inputs.shape[-1] != channels:
+        inputs = np.repeat(inputs[..., :1], channels, axis=-1)
+    return inputs
+
+
+# Input kind of a batch, with a hint to re-export models that lack it
+def _exported_kind(models, inputs, model_path):
+    kind = input_kind(inputs)
+    if kind not in models:
+        raise ValueError(f"{model_path} has no {kind} model ({model_file_for(model_path, kind)}); "
+                         f"export it again with python -m capuchin.backends")
+    return kind
+
+
+class TFLiteModel:
+    """
+    A TFLite classifier: one interpreter per exported input kind, fed batches of its own
+    width. Only the batch dimension of an input tensor is resized; calls are serialized
+    because an interpreter cannot run two batches at once. Single-channel inputs are
+    copied into the 3 channels of models exported before the model took one channel.
+    """
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        Interpreter = _tflite_interpreter_class()
+        self.models = {kind: Interpreter(model_path=model_file_for(model_path, kind), num_threads=num_threads)
+                       for kind in INPUT_SHAPES if os.path.exists(model_file_for(model_path, kind))}
+        if 'window' not in self.models:
+            raise FileNotFoundError(model_path)
+        self.input_shapes = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, inputs, training=False):
+        kind = _exported_kind(self.models, inputs, self.model_path)
+        interpreter = self.models[kind]
+        input_details = interpreter.get_input_details()[0]
+        inputs = _with_channels(inputs, int(input_details['shape'][-1]))
+        with self._lock:
+            if self.input_shapes.get(kind) != inputs.shape:
+                interpreter.resize_tensor_input(input_details['index'], inputs.shape, strict=True)
+                interpreter.allocate_tensors()
+                self.input_shapes[kind] = inputs.shape
+            interpreter.set_tensor(input_details['index'], inputs)
+            interpreter.invoke()
+            return interpreter.get_tensor(interpreter.get_output_details()[0]['index']).copy()
+
+
+class OnnxModel:
+    """
+    An ONNX Runtime classifier using num_threads intra-op and inter_op_threads (default 1)
+    inter-op threads, with one session per exported input kind. Like TFLiteModel, it
+    accepts single-channel inputs for older exports.
+    """
+    def __init__(self, model_path, num_threads=None, inter_op_threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        self.model_path = model_path
+        self.models = {kind: onnxruntime.InferenceSession(model_file_for(model_path, kind), sess_options=options,
+                                                          providers=['CPUExecutionProvider'])
+                       for kind in INPUT_SHAPES if os.path.exists(model_file_for(model_path, kind))}
+        if 'window' not in self.models:
+            raise FileNotFoundError(model_path)
+
+    def __call__(self, inputs, training=False):
+        session = self.models[_exported_kind(self.models, inputs, self.model_path)]
+        model_input = session.get_inputs()[0]
+        channels = model_input.shape[-1] if isinstance(model_input.shape[-1], int) else 1
+        return session.run(None, {model_input.name: _with_channels(inputs, channels)})[0]
+
+
+# Model file whose content identifies the backend's results (used for result cache keys)
+def backend_model_file(backend='keras', model_path=None, weights_file=MODEL_WEIGHTS_FILE):
+    if backend == 'keras':
+        return weights_file
+    return model_path or EXPORT_PATHS[backend]
+
+
+# Load the classifier for the given backend; num_threads are intra-op threads (TFLite has no inter-op pool)
+def load_inference_model(backend='keras', model_path=None, weights_file=MODEL_WEIGHTS_FILE, num_threads=None,
+                         inter_op_threads=None):
+    if backend == 'keras':
+        from capuchin.model import configure_tensorflow_threads, load_capuchin_model, load_saved_model
+        configure_tensorflow_threads(num_threads, inter_op_threads)
+        return load_saved_model(weights_file) or load_capuchin_model(weights_file)
+    if backend == 'tflite':
+        return TFLiteModel(backend_model_file(backend, model_path), num_threads)
+    if backend == 'onnx':
+        return OnnxModel(backend_model_file(backend, model_path), num_threads, inter_op_threads)
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+# Models being loaded and warmed up in the background, by backend and load options
+_warm_models = {}
+_warm_models_lock = threading.Lock()
+_warmup_executor = None
+
+
+def _load_warm_model(backend, model_options):
+    from capuchin.model import warm_up_model
+    return warm_up_model(load_inference_model(backend, **model_options))
+
+
+# Start loading a model (load_inference_model) and its warm-up inferences in a background thread
+def start_model_warmup(backend='keras', retry_failed=False, **model_options):
+    """
+    Returns a Future of the warmed-up model. Every process loads a backend's model once:
+    later calls with the same options return the same Future. A failed load is only
+    started again with retry_failed.
+    """
+    global _warmup_executor
+    key = (backend, tuple(sorted(model_options.items())))
+    with _warm_models_lock:
+        future = _warm_models.get(key)
+        if future is None or (retry_failed and future.done() and future.exception() is not None):
+            if _warmup_executor is None:
+                _warmup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capuchin-warmup")
+            future = _warm_models[key] = _warmup_executor.submit(_load_warm_model, backend, model_options)
+        return future
+
+
+# The model started by start_model_warmup, once it is loaded and warmed up; a failed load is retried
+def get_warm_model(backend='keras', **model_options):
+    return start_model_warmup(backend, retry_failed=True, **model_options).result()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m capuchin.backends",
+                                     description="Export the capuchin classifier to TFLite, ONNX or a SavedModel.")
+    parser.add_argument("--format", choices=('tflite', 'onnx', 'savedmodel'), default='tflite')
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default='dynamic',
+                        help="TFLite quantization (ignored for ONNX)")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE, help="Keras model weights file")
+    parser.add_argument("--output", help="Exported model path (default: next to the weights)")
+    parser.add_argument("--calibration-audio", nargs="*", default=[],
+                        help="Recordings, directories or globs used to calibrate int8 quantization")
+    parser.add_argument("--calibration-samples", type=int, default=100)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    from capuchin.cli import find_audio_files
+    from capuchin.model import export_saved_model, load_capuchin_model
+
+    if args.format == 'savedmodel':
+        output_path = export_saved_model(args.weights, args.output or SAVED_MODEL_DIR)
+        size = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(output_path) for name in names)
+        print(f"Exported SavedModel to {output_path} ({size / 1e6:.1f} MB)")
+        return 0
+    model = load_capuchin_model(args.weights)
+    output_path = args.output or EXPORT_PATHS[args.format]
+    if args.format == 'tflite':
+        representative_data = None
+        if args.quantization == 'int8':
+            audio_paths = find_audio_files(args.calibration_audio)
+            if not audio_paths:
+                print("No calibration audio given; calibrating int8 quantization on random inputs")
+            representative_data = {kind: representative_inputs(audio_paths, args.calibration_samples, kind=kind)
+                                   for kind in model.models}
+        export_tflite(model, output_path, args.quantization, representative_data)
+    else:
+        export_onnx(model, output_path)
+    for kind in model.models:
+        path = model_file_for(output_path, kind)
+        print(f"Exported {args.format} {kind} model to {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,198 @@
+"""
+On-disk cache of detection results, keyed by audio content, model weights and detector
+parameters, plus content-addressed storage for uploaded audio files.
+
+Results live in a small SQLite database; when the stored results exceed ``max_bytes``
+the least recently used entries are evicted. Uploads are shared by every session that
+uploads the same content, so they are never deleted for one session; uploads not used
+for UPLOAD_RETENTION_SECONDS are deleted when a new upload is stored.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from capuchin.detection import (
+    GATE_BAND_HZ,
+    MIN_EVENT_GAP,
+    OVERLAP_INNER,
+    RESAMPLE_TYPE,
+    STEP_DURATION_INNER,
+    THRESHOLD_STAGE1,
+    THRESHOLD_STAGE2,
+    WINDOW_DURATION_OUTER,
+)
+from capuchin.hashing import hash_bytes, hash_file  # noqa: F401 (re-exported)
+
+DEFAULT_CACHE_DIR = os.environ.get("CAPUCHIN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "capuchin"))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Unused uploads are kept as long as finished jobs, which reload their recording from the upload
+UPLOAD_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+# Cache key for one detection run: audio content, model weights and every parameter that affects the result
+def make_cache_key(audio_hash, weights_hash, params):
+    payload = json.dumps({'audio': audio_hash, 'weights': weights_hash, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# Cache key for a detect_capuchin_calls run with the given options on top of the detector defaults
+def detection_cache_key(audio_hash, weights_file, **options):
+    params = {
+        'threshold_stage1': THRESHOLD_STAGE1,
+        'threshold_stage2': THRESHOLD_STAGE2,
+        'window_duration_outer': WINDOW_DURATION_OUTER,
+        'step_duration_inner': STEP_DURATION_INNER,
+        'overlap_inner': OVERLAP_INNER,
+        'spectrogram_cache': False,
+        'streaming': False,
+        'res_type': RESAMPLE_TYPE,
+        'gate_threshold': None,
+        'gate_band': GATE_BAND_HZ,
+        'window_hop_outer': None,
+        'min_event_gap': MIN_EVENT_GAP,
+        'stage2_search': 'exhaustive',
+    }
+    params.update(options)
+    # Batch size only changes how the work is split, not the result
+    params.pop('max_batch_size', None)
+    # The band only matters when the gate is on
+    if params['gate_threshold'] is None:
+        params.pop('gate_band')
+    # So does the event gap when windows do not overlap
+    if params['window_hop_outer'] is None:
+        params.pop('min_event_gap')
+    # The adaptive search only changes the result of event counting; keys of exhaustive runs stay as before
+    if params['window_hop_outer'] is None or params['stage2_search'] == 'exhaustive':
+        params.pop('stage2_search')
+    return make_cache_key(audio_hash, hash_file(weights_file), params)
+
+
+# Key of the model weights and detector parameters alone, e.g. to tell whether two batch runs give the same results
+def detection_settings_key(weights_file, **options):
+    return detection_cache_key(None, weights_file, **options)
+
+
+def _encode(value):
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _decode(obj):
+    if '__ndarray__' in obj:
+        return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+    return obj
+
+
+# JSON text of a detection result, keeping numpy arrays as arrays
+def dumps_result(result):
+    return json.dumps(result, default=_encode)
+
+
+def loads_result(text):
+    return json.loads(text, object_hook=_decode)
+
+
+# SQLite connection that commits on success and is always closed
+@contextlib.contextmanager
+def sqlite_connection(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+class ResultCache:
+    """
+    SQLite-backed detection result cache with size-based LRU eviction.
+
+    Each operation opens its own connection, so one instance can be shared between
+    Streamlit sessions (threads) and several processes can use the same cache directory.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.upload_dir = os.path.join(cache_dir, "uploads")
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "results.sqlite")
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite_connection(self.db_path)
+
+    # Cached result for key, or None; a hit refreshes the entry's LRU position
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        return loads_result(row[0])
+
+    def put(self, key, result):
+        value = dumps_result(result)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO results (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                         (key, value, len(value), now, now))
+        self.evict()
+
+    # Drop least recently used entries until the stored results fit in max_bytes
+    def evict(self):
+        with self._connect() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_access").fetchall():
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM results")
+
+    # Write uploaded audio to a content-addressed file, reusing it if the same content was stored before
+    def store_upload(self, data, suffix, content_hash=None):
+        content_hash = content_hash or hash_bytes(data)
+        path = os.path.join(self.upload_dir, content_hash + suffix)
+        if os.path.exists(path):
+            # The file time marks the upload as in use for prune_uploads
+            os.utime(path)
+            return path
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.prune_uploads()
+        return path
+
+    # Delete uploads that have not been stored or reused for max_age seconds
+    def prune_uploads(self, max_age=UPLOAD_RETENTION_SECONDS):
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
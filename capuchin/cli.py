@@ -0,0 +1,335 @@
+"""
+Headless batch runner: count capuchin calls in every recording of a directory or glob.
+
+Example:
+    python -m capuchin recordings/ --output results.csv --workers 4
+
+Each worker process loads the classifier once. With fewer files than workers, files are
+processed one at a time, each split into shards of outer windows that all workers
+process in parallel (capuchin.parallel). Finished files are appended to
+``<output>.progress.jsonl`` as they complete, so an interrupted run started again with
+the same output path skips the files that were already processed. Each record has the
+key of the model weights and detector options it was made with; files processed with
+other settings are processed again. The output table
+(CSV, or Parquet for a .parquet path) is rewritten from the progress file at the end.
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from capuchin.backends import BACKENDS, backend_model_file
+from capuchin.cache import DEFAULT_CACHE_DIR, ResultCache, detection_cache_key, detection_settings_key, hash_file
+from capuchin.detection import (
+    EVENT_WINDOW_HOP,
+    MAX_BATCH_SIZE,
+    MIN_EVENT_GAP,
+    RESAMPLE_TYPE,
+    RESAMPLE_TYPES,
+    STAGE2_SEARCHES,
+    THRESHOLD_STAGE1,
+    THRESHOLD_STAGE2,
+    detect_capuchin_calls,
+)
+from capuchin.instrumentation import Instrumentation
+from capuchin.model import MODEL_WEIGHTS_FILE
+from capuchin.parallel import ShardedDetector, default_threads
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".ogg", ".flac")
+
+# Per-process model and result cache, created once by the pool initializer
+_worker_model = None
+_worker_options = None
+_worker_model_file = None
+_worker_cache = None
+_worker_profile_dir = None
+_worker_sharded = None
+
+
+# Expand directories (recursively) and glob patterns into a sorted list of audio files
+def find_audio_files(inputs):
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                files.update(os.path.join(root, name) for name in names if name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            files.update(path for path in glob.glob(item, recursive=True)
+                         if os.path.isfile(path) and path.lower().endswith(AUDIO_EXTENSIONS))
+    return sorted(os.path.abspath(path) for path in files)
+
+
+# Latest record of every file in the progress file (a crash can leave a truncated last line)
+def read_progress(progress_path):
+    records = {}
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['file']] = record
+    return records
+
+
+def _configure_logging(level):
+    logging.basicConfig(level=level, format="%(processName)s %(levelname)s %(name)s: %(message)s")
+
+
+# Set up a worker process, or the parent process with a ShardedDetector that runs every detection
+def _init_worker(model_options, options, cache_dir, log_level=logging.WARNING, profile_dir=None, sharded=None):
+    global _worker_model, _worker_options, _worker_model_file, _worker_cache, _worker_profile_dir, _worker_sharded
+    _configure_logging(log_level)
+    if sharded is None:
+        # Imported here so the parent process never initializes TensorFlow
+        from capuchin.backends import load_inference_model
+        _worker_model = load_inference_model(**model_options)
+    _worker_sharded = sharded
+    _worker_options = options
+    _worker_model_file = backend_model_file(model_options['backend'], model_options['model_path'],
+                                            model_options['weights_file'])
+    _worker_cache = ResultCache(cache_dir) if cache_dir else None
+    _worker_profile_dir = profile_dir
+
+
+# Run the detector; with a profile directory its cProfile stats are written there per file
+def _run_detection(audio_path):
+    instrumentation = Instrumentation(profile=True) if _worker_profile_dir is not None else None
+    if _worker_sharded is not None:
+        result = _worker_sharded.detect(audio_path, instrumentation=instrumentation, **_worker_options)
+    else:
+        result = detect_capuchin_calls(audio_path, _worker_model, instrumentation=instrumentation, **_worker_options)
+    if instrumentation is not None:
+        instrumentation.dump_profile(os.path.join(_worker_profile_dir, os.path.basename(audio_path) + ".prof"))
+    return result
+
+
+# Run detection on one file, reusing a cached result for identical audio, model file and options
+def _detect(audio_path):
+    if _worker_cache is None:
+        return _run_detection(audio_path)
+    cache_key = detection_cache_key(hash_file(audio_path), _worker_model_file, **_worker_options)
+    result = _worker_cache.get(cache_key)
+    if result is None:
+        result = _run_detection(audio_path)
+        if result is not None:
+            _worker_cache.put(cache_key, result)
+    return result
+
+
+def _process_file(audio_path):
+    start_time = time.time()
+    record = {'file': audio_path, 'status': 'ok', 'error': None}
+    try:
+        result = _detect(audio_path)
+    except Exception as e:
+        result = None
+        record['error'] = str(e)
+    if result is None:
+        record.update(status='error', call_count=None, duration=None, call_timestamps=[])
+        record['error'] = record['error'] or "detection failed"
+    else:
+        load_timings = result.get('load_timings', {})
+        # Results cached before instrumentation was added have no stage timings
+        instrumentation = result.get('instrumentation') or {'timings': {}, 'counters': {}}
+        record.update(call_count=result['call_count'], duration=float(result['duration']),
+                      call_timestamps=result['call_timestamps'],
+                      load_seconds=load_timings.get('decode_seconds', 0.0) + load_timings.get('resample_seconds', 0.0),
+                      resample_seconds=load_timings.get('resample_seconds', 0.0),
+                      windows_skipped=result.get('windows_skipped', 0),
+                      windows=len(result['window_start_times']),
+                      windows_escalated=instrumentation['counters'].get('windows_escalated'),
+                      stage2_chunks_saved=instrumentation['counters'].get('stage2_chunks_saved'),
+                      mel_seconds=instrumentation['timings'].get('mel'),
+                      stage1_seconds=instrumentation['timings'].get('stage1_inference'),
+                      stage2_seconds=instrumentation['timings'].get('stage2_inference'))
+    record['elapsed'] = time.time() - start_time
+    return record
+
+
+# Records of the files, processed in parallel by worker processes that take one file each
+def process_files(paths, workers, model_options, options, cache_dir, log_level=logging.WARNING, profile_dir=None):
+    # 'spawn' so every worker starts with a fresh TensorFlow runtime
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(model_options, options, cache_dir, log_level, profile_dir)) as pool:
+        for future in as_completed([pool.submit(_process_file, path) for path in paths]):
+            yield future.result()
+
+
+# Records of the files, processed one at a time, each split into shards that all workers process
+def process_files_sharded(paths, workers, model_options, options, cache_dir, log_level=logging.WARNING,
+                          profile_dir=None):
+    with ShardedDetector(model_options, workers, log_level) as sharded:
+        _init_worker(model_options, options, cache_dir, log_level, profile_dir, sharded=sharded)
+        for path in paths:
+            yield _process_file(path)
+
+
+# Whether pandas can write Parquet files
+def parquet_engine_available():
+    return any(importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet'))
+
+
+# Write the per-file table; call timestamps are stored as a JSON list per file
+def write_results(records, output_path):
+    rows = [{
+        'file': record['file'],
+        'status': record['status'],
+        'call_count': record['call_count'],
+        'duration': record['duration'],
+        'elapsed': record['elapsed'],
+        'load_seconds': record.get('load_seconds'),
+        'resample_seconds': record.get('resample_seconds'),
+        'windows': record.get('windows'),
+        'windows_skipped': record.get('windows_skipped'),
+        'windows_escalated': record.get('windows_escalated'),
+        'stage2_chunks_saved': record.get('stage2_chunks_saved'),
+        'mel_seconds': record.get('mel_seconds'),
+        'stage1_seconds': record.get('stage1_seconds'),
+        'stage2_seconds': record.get('stage2_seconds'),
+        'call_timestamps': json.dumps(record['call_timestamps']),
+        'error': record['error'],
+    } for record in sorted(records, key=lambda record: record['file'])]
+    df = pd.DataFrame(rows, columns=['file', 'status', 'call_count', 'duration', 'elapsed', 'load_seconds',
+                                     'resample_seconds', 'windows', 'windows_skipped', 'windows_escalated',
+                                     'stage2_chunks_saved', 'mel_seconds', 'stage1_seconds', 'stage2_seconds', 'call_timestamps', 'error'])
+    if output_path.lower().endswith('.parquet'):
+        df.to_parquet(output_path, index=False)
+    else:
+        df.to_csv(output_path, index=False)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m capuchin",
+                                     description="Count capuchin calls in a batch of recordings.")
+    parser.add_argument("inputs", nargs="+", help="Audio files, directories or glob patterns")
+    parser.add_argument("-o", "--output", default="capuchin_results.csv",
+                        help="Output table (.csv or .parquet)")
+    parser.add_argument("-w", "--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Number of worker processes; with fewer files than workers, every file is split "
+                             "into shards processed by all workers")
+    parser.add_argument("--weights", default=MODEL_WEIGHTS_FILE, help="Model weights file")
+    parser.add_argument("--backend", default='keras', choices=BACKENDS,
+                        help="Inference backend; tflite and onnx run a model exported with python -m capuchin.backends")
+    parser.add_argument("--backend-model", default=None, metavar="PATH",
+                        help="Exported TFLite/ONNX model (default: next to the weights)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Intra-op threads of each worker's model (default: CPU count / workers)")
+    parser.add_argument("--inter-op-threads", type=int, default=1,
+                        help="Inter-op threads of each worker's model (keras and onnx)")
+    parser.add_argument("--threshold-stage1", type=float, default=THRESHOLD_STAGE1)
+    parser.add_argument("--threshold-stage2", type=float, default=THRESHOLD_STAGE2)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--res-type", default=RESAMPLE_TYPE, choices=RESAMPLE_TYPES,
+                        help="Resampler used when a file is not at the detector sample rate; the soxr_* "
+                             "resamplers are faster but not yet validated on labelled recordings")
+    parser.add_argument("--spectrogram-cache", action="store_true",
+                        help="Slice detector inputs from one full-file mel spectrogram")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Decode files block by block (bounded memory); formats soundfile cannot "
+                             "read are loaded whole")
+    parser.add_argument("--gate-threshold", type=float, default=None, metavar="DBFS",
+                        help="Skip windows whose call-band level stays below this many dBFS "
+                             "(calibrate with benchmarks/calibrate_gate.py; off by default)")
+    parser.add_argument("--window-hop", type=float, nargs="?", const=EVENT_WINDOW_HOP, default=None,
+                        metavar="SECONDS",
+                        help=f"Overlap outer windows with this hop (default {EVENT_WINDOW_HOP}) and count merged "
+                             f"call events instead of windows; not combinable with --streaming")
+    parser.add_argument("--min-event-gap", type=float, default=MIN_EVENT_GAP, metavar="SECONDS",
+                        help="Detections closer than this are merged into one call event")
+    parser.add_argument("--stage2-search", default='exhaustive', choices=STAGE2_SEARCHES,
+                        help="Score every Stage-2 chunk, or stop at a window's first positive chunk and, with "
+                             "--window-hop, refine call events coarse-to-fine ('adaptive')")
+    parser.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_DIR, default=None, metavar="DIR",
+                        help=f"Reuse results of identical files from a result cache (default dir: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--profile", metavar="DIR", default=None,
+                        help="Write a cProfile stats file per processed recording to DIR")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="Log detector progress (-v) or every outer window (-vv)")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the progress file and process every file again")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    log_level = (logging.WARNING, logging.INFO, logging.DEBUG)[min(args.verbose, 2)]
+    _configure_logging(log_level)
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    options = {
+        'threshold_stage1': args.threshold_stage1,
+        'threshold_stage2': args.threshold_stage2,
+        'max_batch_size': args.max_batch_size,
+        'spectrogram_cache': args.spectrogram_cache,
+        'streaming': args.streaming,
+        'res_type': args.res_type,
+        'gate_threshold': args.gate_threshold,
+        'stage2_search': args.stage2_search,
+    }
+    # Checked before any file is processed rather than when the table is written at the end
+    if args.output.lower().endswith('.parquet') and not parquet_engine_available():
+        build_parser().error("writing a .parquet table needs pyarrow or fastparquet (pip install pyarrow)")
+    if args.window_hop is not None:
+        if args.streaming:
+            build_parser().error("--window-hop cannot be combined with --streaming")
+        options['window_hop_outer'] = args.window_hop
+        options['min_event_gap'] = args.min_event_gap
+    model_options = {
+        'backend': args.backend,
+        'model_path': args.backend_model,
+        'weights_file': args.weights,
+        'num_threads': args.threads or default_threads(args.workers),
+        'inter_op_threads': args.inter_op_threads,
+    }
+
+    progress_path = args.output + ".progress.jsonl"
+    if args.restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    # Files that finished in an earlier run with the same model and options are skipped; failed files are retried
+    settings = detection_settings_key(backend_model_file(args.backend, args.backend_model, args.weights), **options)
+    previous = read_progress(progress_path)
+    done = {path for path, record in previous.items() if record['status'] == 'ok' and record.get('settings') == settings}
+    files = find_audio_files(args.inputs)
+    pending = [path for path in files if path not in done]
+    changed = sum(path in previous and previous[path]['status'] == 'ok' for path in pending)
+    print(f"{len(files)} files found, {len(files) - len(pending)} already processed, {len(pending)} to go"
+          + (f" ({changed} processed before with other settings)" if changed else ""))
+
+    if pending:
+        process = process_files_sharded if len(pending) < args.workers else process_files
+        with open(progress_path, "a") as progress:
+            records = process(pending, args.workers, model_options, options, args.cache, log_level, args.profile)
+            for i, record in enumerate(records, start=1):
+                record['settings'] = settings
+                progress.write(json.dumps(record) + "\n")
+                progress.flush()
+                if record['status'] == 'ok':
+                    print(f"[{i}/{len(pending)}] {os.path.basename(record['file'])}: "
+                          f"{record['call_count']} calls ({record['elapsed']:.1f}s, load {record['load_seconds']:.1f}s)")
+                else:
+                    print(f"[{i}/{len(pending)}] {os.path.basename(record['file'])}: ERROR {record['error']}")
+
+    records = read_progress(progress_path)
+    records = [records[path] for path in files if path in records]
+    failed = sum(record['status'] != 'ok' for record in records)
+    write_results(records, args.output)
+    if args.gate_threshold is not None:
+        total_windows = sum(record.get('windows') or 0 for record in records)
+        skipped = sum(record.get('windows_skipped') or 0 for record in records)
+        print(f"Stage 0 gate skipped {skipped} of {total_windows} windows ({skipped / max(total_windows, 1):.0%})")
+    if args.stage2_search == 'adaptive':
+        saved = sum(record.get('stage2_chunks_saved') or 0 for record in records)
+        print(f"Adaptive Stage-2 search saved {saved} chunk model inputs")
+    print(f"Results written to {args.output} ({len(records) - failed} ok, {failed} failed)")
+    return 0 if not failed else 1
+
@@ -0,0 +1,1102 @@
+"""
+Two-stage capuchin call detection: mel spectrogram features, the sliding window
+detector and its batched, cached and streaming variants.
+
+This module has no Streamlit or TensorFlow dependency; ``model`` arguments are any
+callable Keras-style model (see capuchin.model.load_capuchin_model) that takes 157-frame
+Stage-1 windows and CHUNK_INPUT_SHAPE-wide Stage-2 chunks.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import librosa
+import scipy.fft
+import scipy.signal
+import soundfile as sf
+import soxr
+
+from capuchin.instrumentation import Instrumentation, count, timed
+from capuchin.model import CHUNK_INPUT_SHAPE
+
+logger = logging.getLogger(__name__)
+
+# Global constants for capuchin detection
+TARGET_SR = 16000
+THRESHOLD_STAGE1 = 0.5
+THRESHOLD_STAGE2 = 0.6
+WINDOW_DURATION_OUTER = 6.0
+STEP_DURATION_INNER = 0.3
+OVERLAP_INNER = 0.0
+MAX_BATCH_SIZE = 64
+STREAM_BLOCK_DURATION = 10.0
+STREAM_WINDOWS_PER_BLOCK = 16
+
+# Resampler used when loading audio at TARGET_SR. 'kaiser_best' is the resampler the
+# detector has always used; the faster soxr_* resamplers are opt-in until
+# benchmarks/bench_resampling.py has compared them on a labelled reference set.
+RESAMPLE_TYPE = 'kaiser_best'
+RESAMPLE_TYPES = ('soxr_vhq', 'soxr_hq', 'soxr_mq', 'soxr_lq', 'polyphase', 'kaiser_best', 'kaiser_fast', 'fft')
+SOXR_QUALITIES = {'soxr_vhq': 'VHQ', 'soxr_hq': 'HQ', 'soxr_mq': 'MQ', 'soxr_lq': 'LQ', 'soxr_qq': 'QQ'}
+
+# Stage-0 gate: outer windows whose loudest GATE_FRAME_DURATION frame in the call band stays
+# below the gate threshold (dBFS) skip both model stages. The gate is off by default;
+# GATE_THRESHOLD_DB is only a starting point, calibrate it per recorder and site with
+# benchmarks/calibrate_gate.py.
+GATE_BAND_HZ = (300.0, 3000.0)
+GATE_FRAME_DURATION = 0.1
+GATE_THRESHOLD_DB = -50.0
+
+# Adaptive Stage-2 search (stage2_search='adaptive'): chunks are probed every
+# STAGE2_COARSE_STRIDE chunks first, then at half the stride, down to every chunk. When
+# counting windows, a window stops at its first chunk above the Stage-2 threshold. When
+# locating call events, a finer chunk is only scored if a coarser neighbour reached
+# STAGE2_REFINE_RATIO times the threshold, so calls shorter than the coarse stride
+# (1.2 s) can be missed.
+STAGE2_SEARCHES = ('exhaustive', 'adaptive')
+STAGE2_COARSE_STRIDE = 4
+STAGE2_REFINE_RATIO = 0.5
+
+# MelExtractor: frames per rfft and matrix product, which bounds its buffers to about 16 MB
+# per buffer with n_fft=2048, and the number of batch shapes whose buffers are kept
+MEL_BLOCK_FRAMES = 2048
+MEL_BUFFER_SHAPES = 4
+
+# Call events: with an outer-window hop set, outer windows may overlap and Stage-2 chunk
+# probabilities are merged into one probability track, which is cut into call events.
+# Runs of the track above the Stage-2 threshold that are at most MIN_EVENT_GAP seconds
+# apart count as one call. EVENT_WINDOW_HOP is the hop offered by the CLI and the app.
+EVENT_WINDOW_HOP = 3.0
+MIN_EVENT_GAP = 0.3
+
+# Raised from a progress callback to stop a running detection
+class DetectionCancelled(Exception):
+    pass
+
+# Load audio as mono at target_sr, timing the decode and resample steps separately
+def load_audio(audio_path, target_sr=TARGET_SR, res_type=RESAMPLE_TYPE):
+    """
+    Returns (y, sr, load_timings) where load_timings holds 'decode_seconds' and
+    'resample_seconds'. Resampling is skipped when the file is already at target_sr.
+    """
+    start_time = time.perf_counter()
+    y, native_sr = librosa.load(audio_path, sr=None)
+    decoded_time = time.perf_counter()
+    if native_sr != target_sr:
+        y = librosa.resample(y, orig_sr=native_sr, target_sr=target_sr, res_type=res_type)
+    load_timings = {
+        'native_sr': native_sr,
+        'res_type': res_type if native_sr != target_sr else None,
+        'decode_seconds': decoded_time - start_time,
+        'resample_seconds': time.perf_counter() - decoded_time,
+    }
+    return y, target_sr, load_timings
+
+# Function to extract mel spectrogram
+def extract_mel_spectrogram(audio_path=None,target_sr=TARGET_SR, y=None, sr=None, n_mels=128, n_fft=2048, hop_length=512, target_time_frames=None, res_type=RESAMPLE_TYPE):
+    if y is None or sr is None:
+        try:
+            y, sr = librosa.load(audio_path, sr=target_sr, res_type=res_type)
+        except Exception as e:
+            logger.error("Error loading audio file: %s, %s", audio_path, e)
+            return None
+    return mel_extractor(sr, n_mels, n_fft, hop_length).mel_db(y, target_time_frames)[0]
+
+# Single-channel mel spectrograms as a contiguous float32 (N, n_mels, frames, 1) model input batch
+def to_model_input(mel_specs, out=None):
+    """
+    A contiguous float32 (N, n_mels, frames) array, as returned by the extractors, becomes
+    the batch without a copy. Other inputs are written once into out, which is allocated
+    if not given. The model copies the channel for its 3-channel classifier itself.
+    """
+    if out is None and isinstance(mel_specs, np.ndarray) and mel_specs.dtype == np.float32 \
+            and mel_specs.flags.c_contiguous:
+        return mel_specs[..., np.newaxis]
+    if out is None:
+        out = np.empty((len(mel_specs),) + np.shape(mel_specs[0]) + (1,), dtype=np.float32)
+    for i, mel_spec in enumerate(mel_specs):
+        out[i, ..., 0] = mel_spec
+    return out
+
+# Run the model on a batch of inputs, splitting it into calls of at most max_batch_size samples
+def predict_in_batches(model, inputs, max_batch_size=MAX_BATCH_SIZE):
+    probs = []
+    for start in range(0, len(inputs), max_batch_size):
+        batch = inputs[start:start + max_batch_size]
+        probs.append(np.asarray(model(batch, training=False)).reshape(-1))
+    if not probs:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(probs)
+
+# Convert a batch of mel power spectrograms to dB, each relative to its own maximum
+# (the batched equivalent of librosa.power_to_db(S, ref=np.max) per spectrogram); out may be S itself
+def power_to_db_batch(S, amin=1e-10, top_db=80.0, out=None):
+    ref_value = np.max(S, axis=(-2, -1), keepdims=True)
+    log_spec = np.maximum(amin, S, out=out)
+    np.log10(log_spec, out=log_spec)
+    log_spec *= 10.0
+    log_spec -= 10.0 * np.log10(np.maximum(amin, ref_value))
+    return np.maximum(log_spec, np.max(log_spec, axis=(-2, -1), keepdims=True) - top_db, out=log_spec)
+
+# Mel spectrograms (dB) of many equal-length windows computed as one vectorized array
+def extract_mel_spectrogram_batch(windows, sr, n_mels=128, n_fft=2048, hop_length=512, target_time_frames=None):
+    return mel_extractor(sr, n_mels, n_fft, hop_length).mel_db(windows, target_time_frames)
+
+# Mel spectrograms of equal-length signals with the mel basis, window and buffers built once
+class MelExtractor:
+    """
+    Computes what librosa.feature.melspectrogram does with its defaults (centred Hann
+    frames, zero padding, power 2, Slaney mel basis), for a whole (N, samples) batch:
+    the frames of MEL_BLOCK_FRAMES at a time go through one rfft and one matrix product
+    with the mel basis. The mel basis and window are built once per instance, and the
+    padded-signal, frame, power and mel buffers are kept per batch shape and reused, so
+    scoring thousands of equal-length chunks does not rebuild or reallocate them. The
+    result matches librosa to float32 rounding (relative error about 1e-7).
+
+    Instances are not thread-safe; mel_extractor returns one per thread.
+    """
+    def __init__(self, sr, n_mels=128, n_fft=2048, hop_length=512):
+        self.sr = sr
+        self.n_mels = n_mels
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.mel_basis_t = np.ascontiguousarray(librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels).T)
+        self.window = scipy.signal.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        self._buffers = {}
+
+    # Buffers for rows signals of n_samples samples; the padding around the signals stays zero
+    def _buffers_for(self, rows, n_samples):
+        key = (rows, n_samples)
+        if key not in self._buffers:
+            if len(self._buffers) >= MEL_BUFFER_SHAPES:
+                self._buffers.pop(next(iter(self._buffers)))
+            n_frames = 1 + n_samples // self.hop_length
+            self._buffers[key] = (np.zeros((rows, n_samples + self.n_fft), dtype=np.float32),
+                                  np.empty((rows, n_frames, self.n_fft), dtype=np.float32),
+                                  np.empty((rows, n_frames, self.n_fft // 2 + 1), dtype=np.float32),
+                                  np.empty((rows, n_frames, self.n_mels), dtype=np.float32))
+        return self._buffers[key]
+
+    # Mel power spectrograms of a signal or an (N, samples) batch, shape (N, n_mels, frames)
+    def mel_power(self, signals, out=None):
+        signals = np.atleast_2d(signals)
+        n_signals, n_samples = signals.shape
+        n_frames = 1 + n_samples // self.hop_length
+        if out is None:
+            out = np.empty((n_signals, self.n_mels, n_frames), dtype=np.float32)
+        rows = max(1, min(n_signals, MEL_BLOCK_FRAMES // n_frames))
+        offset = self.n_fft // 2
+        for first in range(0, n_signals, rows):
+            last = min(first + rows, n_signals)
+            padded, frames, power, mel = (buffer[:last - first] for buffer in self._buffers_for(rows, n_samples))
+            padded[:, offset:offset + n_samples] = signals[first:last]
+            framed = np.lib.stride_tricks.sliding_window_view(padded, self.n_fft, axis=-1)[:, ::self.hop_length]
+            np.multiply(framed[:, :n_frames], self.window, out=frames)
+            spectrum = scipy.fft.rfft(frames, axis=-1, overwrite_x=True)
+            np.abs(spectrum, out=power)
+            np.square(power, out=power)
+            np.matmul(power, self.mel_basis_t, out=mel)
+            out[first:last] = mel.transpose(0, 2, 1)
+        return out
+
+    # Mel spectrograms in dB, each relative to its own maximum (extract_mel_spectrogram), as a contiguous array
+    def mel_db(self, signals, target_time_frames=None):
+        power = self.mel_power(signals)
+        mel_spec_db = power_to_db_batch(power, out=power)
+        if target_time_frames is not None:
+            mel_spec_db = np.ascontiguousarray(librosa.util.fix_length(mel_spec_db, size=target_time_frames, axis=-1))
+        return mel_spec_db
+
+# MelExtractors of each thread, by parameters
+_mel_extractors = threading.local()
+
+# MelExtractor of the calling thread for the given parameters, created on first use
+def mel_extractor(sr, n_mels=128, n_fft=2048, hop_length=512):
+    extractors = getattr(_mel_extractors, 'extractors', None)
+    if extractors is None:
+        extractors = _mel_extractors.extractors = {}
+    key = (sr, n_mels, n_fft, hop_length)
+    if key not in extractors:
+        extractors[key] = MelExtractor(sr, n_mels, n_fft, hop_length)
+    return extractors[key]
+
+# Stage-0 score of equal-length windows: level of the loudest frame in the call band, in dBFS
+def band_energy_scores(windows, sr, band=GATE_BAND_HZ, frame_duration=GATE_FRAME_DURATION):
+    """
+    windows is a (N, samples) array. Every window is band-pass filtered on its own (4th
+    order Butterworth), so a window's score does not depend on the audio around it and
+    is the same in the streaming and whole-file detectors. Windows shorter than one
+    frame are scored over their whole length.
+    """
+    sos = scipy.signal.butter(4, band, btype='bandpass', fs=sr, output='sos')
+    filtered = scipy.signal.sosfilt(sos, windows, axis=-1)
+    frame_samples = max(1, min(int(frame_duration * sr), filtered.shape[-1]))
+    n_frames = filtered.shape[-1] // frame_samples
+    frames = filtered[:, :n_frames * frame_samples].reshape(len(filtered), n_frames, frame_samples)
+    power = np.mean(frames ** 2, axis=-1).max(axis=-1)
+    return 10.0 * np.log10(np.maximum(power, 1e-10))
+
+# Mel spectrogram of a whole recording, computed once and sliced into detector inputs by frame index
+class MelSpectrogramCache:
+    """
+    Holds the mel power spectrogram of the full signal. The STFT is computed block by
+    block (block_frames frames at a time) so only one block of linear-frequency frames is
+    in memory at once. Frame t is centred on sample t * hop_length, as with librosa's
+    center=True, so a window starting at sample s maps to frame round(s / hop_length).
+
+    Slices are converted to dB relative to their own maximum, like extract_mel_spectrogram
+    on the window audio. The result is not bit-identical to per-window extraction: frames
+    near a window edge see the neighbouring audio instead of zero padding, and window
+    starts that fall between frames are rounded to the nearest frame (at most half a hop,
+    16 ms at 16 kHz), which shifts every frame of that window by up to 256 samples.
+    Measured with benchmarks/bench_spectrogram_cache.py on 10 minutes of synthetic noise
+    with tones, the mean absolute deviation is about 0.6 dB for Stage-1 windows and
+    1.2 dB for Stage-2 chunks; single low-energy bins near the 80 dB floor can differ by
+    tens of dB. Because of this the cache mode is opt-in.
+
+    With a sample_range (first, last), only the frames needed by windows inside that
+    range are computed; they equal the same frames of the full-signal cache.
+    """
+    def __init__(self, y, sr, n_mels=128, n_fft=2048, hop_length=512, block_frames=8192, sample_range=None):
+        self.sr = sr
+        self.hop_length = hop_length
+        self.n_frames = 1 + len(y) // hop_length
+        self.first_frame, last_frame = 0, self.n_frames
+        if sample_range is not None:
+            # A window's last frame is centred up to half a hop after its end
+            self.first_frame = sample_range[0] // hop_length
+            last_frame = min(self.n_frames, sample_range[1] // hop_length + 2)
+        mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+        self.mel_power = np.empty((n_mels, last_frame - self.first_frame), dtype=np.float32)
+        for frame_start in range(self.first_frame, last_frame, block_frames):
+            frame_end = min(frame_start + block_frames, last_frame)
+            # Zero padding beyond the signal matches librosa's default center=True, pad_mode='constant'
+            first_sample = frame_start * hop_length - n_fft // 2
+            last_sample = (frame_end - 1) * hop_length + n_fft // 2
+            block = np.asarray(y[max(first_sample, 0):min(last_sample, len(y))])
+            block = np.pad(block, (max(0, -first_sample), max(0, last_sample - len(y))))
+            stft = librosa.stft(block, n_fft=n_fft, hop_length=hop_length, center=False)
+            self.mel_power[:, frame_start - self.first_frame:frame_end - self.first_frame] = mel_basis @ (np.abs(stft) ** 2)
+
+    # Frame indices covering n_samples audio samples from each start sample
+    def _frame_indices(self, start_samples, n_samples):
+        first_frames = np.rint(np.asarray(start_samples) / self.hop_length).astype(int)
+        n_frames = 1 + int(n_samples) // self.hop_length
+        indices = first_frames[:, np.newaxis] + np.arange(n_frames)
+        return np.minimum(indices, self.n_frames - 1) - self.first_frame
+
+    # Mel spectrograms (dB) of equal-length windows, shape (len(start_samples), n_mels, frames)
+    def mel_db_batch(self, start_samples, n_samples, target_time_frames=None):
+        mel_power = np.moveaxis(self.mel_power[:, self._frame_indices(start_samples, n_samples)], 0, 1)
+        mel_spec_db = power_to_db_batch(mel_power)
+        if target_time_frames is not None:
+            mel_spec_db = librosa.util.fix_length(mel_spec_db, size=target_time_frames, axis=-1)
+        return mel_spec_db
+
+# Start times and start samples of the outer windows, stepped exactly like the sliding window loop
+def outer_window_starts(total_duration_seconds, window_duration_outer, sr):
+    starts = []
+    outer_window_start_time = 0.0
+    while outer_window_start_time < total_duration_seconds:
+        starts.append((outer_window_start_time, int(outer_window_start_time * sr)))
+        outer_window_start_time += window_duration_outer
+    return starts
+
+# Stage 2 for a group of outer windows: score every inner chunk with as few model calls as possible
+def stage2_chunk_probabilities(outer_windows_audio, sr, model, step_samples_inner, hop_samples_inner,
+                               max_batch_size=MAX_BATCH_SIZE, mel_cache=None, window_start_samples=None,
+                               instrumentation=None, chunk_positions=None):
+    """
+    Returns one array per outer window with the Stage-2 call probability of every inner
+    chunk, in chunk order. Chunks from all windows are grouped by length (the last chunk
+    of a window may be shorter) so each group can be stacked into batches; every chunk
+    spectrogram is padded to the CHUNK_INPUT_SHAPE width the model takes.
+    If mel_cache is given, chunk spectrograms are sliced from it using the absolute
+    window_start_samples instead of being recomputed from the chunk audio.
+    With chunk_positions (one array of chunk indices per window), only those chunks are
+    scored and the others are NaN.
+    """
+    chunk_owner = []
+    chunk_starts = []
+    chunk_lengths = []
+    chunk_position = []
+    for window_index, outer_window_audio in enumerate(outer_windows_audio):
+        inner_start_sample = 0
+        position = 0
+        while inner_start_sample < len(outer_window_audio):
+            inner_end_sample = min(inner_start_sample + step_samples_inner, len(outer_window_audio))
+            if inner_end_sample - inner_start_sample >= step_samples_inner / 2:
+                chunk_owner.append(window_index)
+                chunk_starts.append(inner_start_sample)
+                chunk_lengths.append(inner_end_sample - inner_start_sample)
+                chunk_position.append(position)
+                position += 1
+            inner_start_sample += hop_samples_inner
+
+    chunk_owner = np.asarray(chunk_owner, dtype=int)
+    chunk_lengths = np.asarray(chunk_lengths, dtype=int)
+    probs = np.zeros(len(chunk_owner), dtype=np.float32)
+    selected = np.ones(len(chunk_owner), dtype=bool)
+    if chunk_positions is not None:
+        probs[:] = np.nan
+        selected = np.array([position in chunk_positions[owner] for owner, position in zip(chunk_owner, chunk_position)],
+                            dtype=bool)
+    # Chunks of equal length have equal spectrogram shapes and can share a batch
+    for length in np.unique(chunk_lengths[selected]):
+        indices = np.flatnonzero(selected & (chunk_lengths == length))
+        with timed(instrumentation, 'mel'):
+            if mel_cache is not None:
+                absolute_starts = [window_start_samples[chunk_owner[i]] + chunk_starts[i] for i in indices]
+                mel_specs = mel_cache.mel_db_batch(absolute_starts, length, target_time_frames=CHUNK_INPUT_SHAPE[1])
+            else:
+                chunks = np.stack([outer_windows_audio[chunk_owner[i]][chunk_starts[i]:chunk_starts[i] + length]
+                                   for i in indices])
+                mel_specs = extract_mel_spectrogram_batch(chunks, sr, target_time_frames=CHUNK_INPUT_SHAPE[1])
+            inputs = to_model_input(mel_specs)
+        with timed(instrumentation, 'stage2_inference'):
+            probs[indices] = predict_in_batches(model, inputs, max_batch_size)
+    count(instrumentation, 'stage2_chunks_scored', int(selected.sum()))
+
+    return [probs[chunk_owner == window_index] for window_index in range(len(outer_windows_audio))]
+
+# Chunk indices 0 .. n_chunks - 1 level by level: multiples of stride, then of stride / 2, ..., then the rest
+def coarse_to_fine_levels(n_chunks, stride=STAGE2_COARSE_STRIDE):
+    chunks = np.arange(n_chunks)
+    levels = [chunks[chunks % stride == 0]]
+    while stride > 1:
+        stride //= 2
+        levels.append(chunks[(chunks % stride == 0) & (chunks % (2 * stride) != 0)])
+    return levels
+
+# Count-only Stage 2: whether each outer window has a chunk above threshold_stage2, stopping at its first one
+def stage2_first_positive(outer_windows_audio, sr, model, step_samples_inner, hop_samples_inner, threshold_stage2,
+                          max_batch_size=MAX_BATCH_SIZE, mel_cache=None, window_start_samples=None,
+                          instrumentation=None, stride=STAGE2_COARSE_STRIDE):
+    """
+    Chunks are probed coarse-to-fine (coarse_to_fine_levels), batched over all windows
+    still undecided, so a call is usually found by the first, sparse level. The answer
+    equals np.any(stage2_chunk_probabilities(...) > threshold_stage2) per window; the
+    chunks never scored are counted as 'stage2_chunks_saved'.
+    """
+    n_chunks = [sum(1 for start in range(0, len(audio), hop_samples_inner)
+                    if min(step_samples_inner, len(audio) - start) >= step_samples_inner / 2)
+                for audio in outer_windows_audio]
+    has_call = np.zeros(len(outer_windows_audio), dtype=bool)
+    scored = 0
+    for positions in coarse_to_fine_levels(max(n_chunks, default=0), stride):
+        chunk_positions = [positions[positions < n] if not decided else positions[:0]
+                           for n, decided in zip(n_chunks, has_call)]
+        if not any(len(window_positions) for window_positions in chunk_positions):
+            break
+        probs = stage2_chunk_probabilities(outer_windows_audio, sr, model, step_samples_inner, hop_samples_inner,
+                                           max_batch_size, mel_cache, window_start_samples, instrumentation,
+                                           chunk_positions=chunk_positions)
+        has_call |= np.array([np.any(window_probs > threshold_stage2) for window_probs in probs])
+        scored += sum(len(window_positions) for window_positions in chunk_positions)
+    count(instrumentation, 'stage2_chunks_saved', sum(n_chunks) - scored)
+    return has_call
+
+# Stage 0 and Stage 1 for a block of outer windows (sample bounds); fills stage1_probs[block]
+def score_stage1_block(y_long, sr_long, model, bounds, block, stage1_probs, max_batch_size=MAX_BATCH_SIZE,
+                       mel_cache=None, gate_threshold=None, gate_band=GATE_BAND_HZ, instrumentation=None):
+    """
+    Windows rejected by the Stage-0 gate keep a probability of 0; returns how many
+    there were. All windows but the last have the same length and are transformed together.
+    """
+    windows_skipped = 0
+    lengths = np.array([bounds[i][1] - bounds[i][0] for i in block])
+    for length in np.unique(lengths):
+        indices = block[lengths == length]
+        windows = np.stack([y_long[bounds[i][0]:bounds[i][1]] for i in indices])
+        # Stage 0: windows with too little energy in the call band skip both model stages
+        if gate_threshold is not None:
+            with timed(instrumentation, 'stage0'):
+                audible = band_energy_scores(windows, sr_long, gate_band) >= gate_threshold
+            windows_skipped += int(np.sum(~audible))
+            indices, windows = indices[audible], windows[audible]
+            if len(indices) == 0:
+                continue
+        with timed(instrumentation, 'mel'):
+            if mel_cache is not None:
+                mel_specs = mel_cache.mel_db_batch([bounds[i][0] for i in indices], length, target_time_frames=157)
+            else:
+                mel_specs = extract_mel_spectrogram_batch(windows, sr_long, target_time_frames=157)
+            inputs = to_model_input(mel_specs)
+        with timed(instrumentation, 'stage1_inference'):
+            stage1_probs[indices] = predict_in_batches(model, inputs, max_batch_size)
+        count(instrumentation, 'windows_screened', len(indices))
+    count(instrumentation, 'windows_skipped', windows_skipped)
+    return windows_skipped
+
+# Pipelined two-pass detection: batched Stage 1, then Stage 2 on the flagged windows, block by block
+def run_two_pass_detection(y_long, sr_long, model,
+                           threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
+                           window_duration_outer=WINDOW_DURATION_OUTER,
+                           step_duration_inner=STEP_DURATION_INNER,
+                           overlap_inner=OVERLAP_INNER, max_batch_size=MAX_BATCH_SIZE,
+                           spectrogram_cache=False, gate_threshold=None, gate_band=GATE_BAND_HZ,
+                           stage2_search='exhaustive', progress_callback=None, detection_callback=None,
+                           instrumentation=None, window_range=None):
+    """
+    Outer windows are processed in blocks of max_batch_size: Stage 1 computes the mel
+    spectrograms of the whole block and scores them with batched model calls, then the
+    batched Stage-2 chunk scan runs only on the windows of the block Stage 1 flagged.
+    Detections are therefore final block by block, long before the end of the file.
+    Returns a dict with 'call_count', 'call_timestamps', 'duration', 'window_start_times',
+    'stage1_probs' (one Stage-1 probability per outer window) and 'windows_skipped'.
+    Counts and timestamps match the window-by-window sliding window loop.
+    With a gate_threshold (dBFS), windows whose band_energy_scores fall below it are
+    skipped before Stage 1; they keep a Stage-1 probability of 0 and are counted in
+    'windows_skipped'.
+    detection_callback(call) receives every call record as soon as its block is done,
+    and progress_callback(windows_done, windows_total) is called after every block.
+    Either callback may raise DetectionCancelled to stop the detection.
+    With spectrogram_cache enabled, the mel spectrogram of the whole signal is computed
+    once (MelSpectrogramCache) and both stages slice their inputs from it; see the class
+    docstring for the tolerance against per-window extraction.
+    With stage2_search='adaptive', Stage 2 stops at a window's first chunk above the
+    threshold (stage2_first_positive); counts and timestamps are unchanged.
+    If an Instrumentation is given, stage timings and window counters are added to it.
+    With a window_range (first, last), only outer windows first to last - 1 are
+    processed, and the window arrays of the result cover only them (used by the
+    parallel detector, capuchin.parallel).
+    """
+    window_samples_outer = int(window_duration_outer * sr_long)
+    step_samples_inner = int(step_duration_inner * sr_long)
+    hop_samples_inner = int(step_samples_inner * (1 - overlap_inner))
+    total_duration_seconds = librosa.get_duration(y=y_long, sr=sr_long)
+
+    starts = outer_window_starts(total_duration_seconds, window_duration_outer, sr_long)
+    bounds = [(start_sample, min(start_sample + window_samples_outer, len(y_long))) for _, start_sample in starts]
+    first, last = window_range if window_range is not None else (0, len(starts))
+    mel_cache = None
+    if spectrogram_cache and last > first:
+        with timed(instrumentation, 'mel'):
+            mel_cache = MelSpectrogramCache(y_long, sr_long, sample_range=(bounds[first][0], bounds[last - 1][1]))
+
+    stage1_probs = np.zeros(len(starts), dtype=np.float32)
+    windows_skipped = 0
+    windows_flagged = 0
+    call_timestamps = []
+    for block_start in range(first, last, max_batch_size):
+        block = np.arange(block_start, min(block_start + max_batch_size, last))
+        windows_skipped += score_stage1_block(y_long, sr_long, model, bounds, block, stage1_probs,
+                                              max_batch_size, mel_cache, gate_threshold, gate_band,
+                                              instrumentation)
+
+        # Stage 2: batched chunk scan of the block's flagged windows only
+        flagged = block[stage1_probs[block] > threshold_stage1]
+        windows_flagged += len(flagged)
+        count(instrumentation, 'windows_escalated', len(flagged))
+        has_call = np.zeros(0, dtype=bool)
+        if len(flagged) > 0:
+            windows_audio = [y_long[bounds[i][0]:bounds[i][1]] for i in flagged]
+            window_start_samples = [bounds[i][0] for i in flagged]
+            if stage2_search == 'adaptive':
+                has_call = stage2_first_positive(windows_audio, sr_long, model, step_samples_inner, hop_samples_inner,
+                                                 threshold_stage2, max_batch_size, mel_cache, window_start_samples,
+                                                 instrumentation)
+            else:
+                chunk_probs = stage2_chunk_probabilities(windows_audio, sr_long, model, step_samples_inner,
+                                                         hop_samples_inner, max_batch_size=max_batch_size,
+                                                         mel_cache=mel_cache, window_start_samples=window_start_samples,
+                                                         instrumentation=instrumentation)
+                has_call = np.array([np.any(probs > threshold_stage2) for probs in chunk_probs])
+        for i in flagged[has_call]:
+            outer_window_start_time = starts[i][0]
+            outer_window_duration = (bounds[i][1] - bounds[i][0]) / sr_long
+            call = {
+                'start_time': outer_window_start_time,
+                'end_time': outer_window_start_time + outer_window_duration,
+                'mid_time': outer_window_start_time + (outer_window_duration / 2),
+                'confidence': float(stage1_probs[i])
+            }
+            call_timestamps.append(call)
+            if detection_callback is not None:
+                detection_callback(call)
+        if progress_callback is not None:
+            progress_callback(int(block[-1]) + 1, len(starts))
+
+    if gate_threshold is not None:
+        logger.info("Stage 0 skipped %d of %d outer windows", windows_skipped, last - first)
+    logger.info("Stage 1 flagged %d of %d outer windows", windows_flagged, last - first)
+
+    return {
+        'call_count': len(call_timestamps),
+        'call_timestamps': call_timestamps,
+        'duration': total_duration_seconds,
+        'window_start_times': np.array([start_time for start_time, _ in starts[first:last]]),
+        'stage1_probs': stage1_probs[first:last],
+        'windows_skipped': windows_skipped,
+    }
+
+# Call events of a probability track: runs above threshold, merged across gaps of at most min_gap_cells
+def track_events(track, threshold, min_gap_cells=0):
+    """
+    Returns (onsets, offsets, peaks) as cell index arrays; offsets are exclusive and
+    peaks are the cells with the highest probability of each event. Merging runs that
+    are closer than the gap keeps only the strongest peak of a cluster (non-maximum
+    suppression), so one call that dips below the threshold is not counted twice.
+    """
+    above = np.concatenate([[False], track > threshold, [False]])
+    changes = np.flatnonzero(np.diff(above.astype(np.int8)))
+    onsets, offsets = changes[0::2], changes[1::2]
+    if len(onsets) == 0:
+        return onsets, offsets, onsets
+    new_event = np.concatenate([[True], onsets[1:] - offsets[:-1] > min_gap_cells])
+    onsets = onsets[new_event]
+    offsets = offsets[np.concatenate([new_event[1:], [True]])]
+    # Peak picking: sort the cells of every event by descending probability and take the first
+    lengths = offsets - onsets
+    event_ids = np.repeat(np.arange(len(onsets)), lengths)
+    cells = np.repeat(onsets - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(lengths.sum())
+    order = np.lexsort((-track[cells], event_ids))
+    peaks = cells[order][np.concatenate([[0], np.cumsum(lengths[:-1])])]
+    return onsets, offsets, peaks
+
+# Call events of track[:final_cells] that no later cell can change and that start after the calls so far
+def final_track_events(track, final_cells, threshold, min_gap_cells, cell_duration, total_duration_seconds,
+                       call_timestamps=()):
+    calls = []
+    last_start_time = call_timestamps[-1]['start_time'] if call_timestamps else None
+    onsets, offsets, peaks = track_events(track[:final_cells], threshold, min_gap_cells)
+    for onset, offset, peak in zip(onsets, offsets, peaks):
+        start_time = float(onset * cell_duration)
+        if (last_start_time is not None and start_time <= last_start_time) or \
+                (offset + min_gap_cells >= final_cells and final_cells < len(track)):
+            continue
+        calls.append({
+            'start_time': start_time,
+            'end_time': float(min(offset * cell_duration, total_duration_seconds)),
+            'mid_time': float(min((peak + 0.5) * cell_duration, total_duration_seconds)),
+            'confidence': float(track[peak])
+        })
+    return calls
+
+# Start samples of run_event_detection's outer windows, with the outer and inner hops in samples
+def event_window_starts(n_samples, sr, window_duration_outer=WINDOW_DURATION_OUTER, window_hop_outer=EVENT_WINDOW_HOP,
+                        step_duration_inner=STEP_DURATION_INNER, overlap_inner=OVERLAP_INNER):
+    window_samples_outer = int(window_duration_outer * sr)
+    step_samples_inner = int(step_duration_inner * sr)
+    hop_samples_inner = max(1, int(step_samples_inner * (1 - overlap_inner)))
+    hop_samples_outer = max(1, int(round(window_hop_outer * sr / hop_samples_inner))) * hop_samples_inner
+    # The last window reaches the end of the recording; later starts would only repeat it
+    n_windows = 1 + max(0, -(-(n_samples - window_samples_outer) // hop_samples_outer))
+    return np.arange(n_windows) * hop_samples_outer, hop_samples_outer, hop_samples_inner
+
+# Two-pass detection with overlapping outer windows, merged into call events
+def run_event_detection(y_long, sr_long, model,
+                        threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
+                        window_duration_outer=WINDOW_DURATION_OUTER, window_hop_outer=EVENT_WINDOW_HOP,
+                        step_duration_inner=STEP_DURATION_INNER, overlap_inner=OVERLAP_INNER,
+                        max_batch_size=MAX_BATCH_SIZE, min_event_gap=MIN_EVENT_GAP,
+                        spectrogram_cache=False, gate_threshold=None, gate_band=GATE_BAND_HZ,
+                        stage2_search='exhaustive', progress_callback=None, detection_callback=None,
+                        instrumentation=None, window_range=None):
+    """
+    Outer windows start every window_hop_outer seconds (rounded to a multiple of the
+    inner chunk hop) and run through Stage 0 and Stage 1 block by block as in
+    run_two_pass_detection. Stage-2 chunks lie on one grid of the whole recording, so a
+    chunk shared by overlapping flagged windows is scored once. The chunk probabilities
+    form a probability track with one cell per inner hop (a cell takes the highest
+    probability of the chunks covering it); track_events cuts it into call events.
+
+    Returns the run_two_pass_detection keys, where 'call_count' and 'call_timestamps'
+    describe events: start and end of the event, 'mid_time' at its peak and its peak
+    Stage-2 probability as 'confidence'. 'probability_track' and 'track_hop' (seconds
+    per cell) hold the track; unscored cells are 0. 'stage2_chunks_scored' and
+    'stage2_chunks_reused' count the model inputs computed and the shared ones reused.
+    With spectrogram_cache enabled, windows and chunks slice their spectrograms from a
+    MelSpectrogramCache, so the frames shared by overlapping windows are computed once.
+    An event is passed to detection_callback as soon as no
+    later window can change it.
+    With stage2_search='adaptive', the chunks of flagged windows are scored coarse-to-fine
+    over the grid (see STAGE2_COARSE_STRIDE); chunks left unscored stay 0 on the track and
+    'stage2_chunks_saved' counts them.
+    With a window_range (first, last), only outer windows first to last - 1 are
+    processed and the window arrays of the result cover only them. The track then holds
+    only their chunks, so events near the range edges are incomplete; the parallel
+    detector (capuchin.parallel) merges the tracks of all ranges and cuts events once.
+    """
+    window_samples_outer = int(window_duration_outer * sr_long)
+    step_samples_inner = int(step_duration_inner * sr_long)
+    window_starts, hop_samples_outer, hop_samples_inner = event_window_starts(
+        len(y_long), sr_long, window_duration_outer, window_hop_outer, step_duration_inner, overlap_inner)
+    n_windows = len(window_starts)
+    total_duration_seconds = librosa.get_duration(y=y_long, sr=sr_long)
+    bounds = [(start, min(start + window_samples_outer, len(y_long))) for start in window_starts]
+    first, last = window_range if window_range is not None else (0, n_windows)
+    mel_cache = None
+    if spectrogram_cache and last > first:
+        # The last chunk of a window may reach past the window's end
+        sample_range = (bounds[first][0], min(bounds[last - 1][1] + step_samples_inner, len(y_long)))
+        with timed(instrumentation, 'mel'):
+            mel_cache = MelSpectrogramCache(y_long, sr_long, sample_range=sample_range)
+
+    # Chunk k covers samples k * hop_samples_inner onwards; a short last chunk needs half a step
+    chunk_starts = np.arange(0, len(y_long), hop_samples_inner)
+    chunk_lengths = np.minimum(step_samples_inner, len(y_long) - chunk_starts)
+    n_chunks = int(np.sum(chunk_lengths >= step_samples_inner / 2))
+    chunk_probs = np.zeros(n_chunks, dtype=np.float32)
+    scored = np.zeros(n_chunks, dtype=bool)
+    cells_per_chunk = -(-step_samples_inner // hop_samples_inner)
+    track = np.zeros(len(chunk_starts), dtype=np.float32)
+    cell_duration = hop_samples_inner / sr_long
+    min_gap_cells = int(round(min_event_gap / cell_duration))
+    requested = np.zeros(n_chunks, dtype=bool)
+    refine_threshold = STAGE2_REFINE_RATIO * threshold_stage2
+
+    # Score grid chunks (sorted, not yet scored) and add them to the track
+    def score_chunks(indices):
+        lengths = chunk_lengths[indices]
+        for length in np.unique(lengths):
+            group = indices[lengths == length]
+            with timed(instrumentation, 'mel'):
+                if mel_cache is not None:
+                    mel_specs = mel_cache.mel_db_batch(chunk_starts[group], length,
+                                                       target_time_frames=CHUNK_INPUT_SHAPE[1])
+                else:
+                    mel_specs = extract_mel_spectrogram_batch(
+                        np.stack([y_long[chunk_starts[k]:chunk_starts[k] + length] for k in group]), sr_long,
+                        target_time_frames=CHUNK_INPUT_SHAPE[1])
+                inputs = to_model_input(mel_specs)
+            with timed(instrumentation, 'stage2_inference'):
+                chunk_probs[group] = predict_in_batches(model, inputs, max_batch_size)
+        scored[indices] = True
+        count(instrumentation, 'stage2_chunks_scored', len(indices))
+        for offset in range(cells_per_chunk):
+            cells = indices + offset
+            keep = cells < len(track)
+            np.maximum.at(track, cells[keep], chunk_probs[indices[keep]])
+
+    stage1_probs = np.zeros(n_windows, dtype=np.float32)
+    windows_skipped = 0
+    windows_flagged = 0
+    chunks_requested = 0
+    call_timestamps = []
+    for block_start in range(first, last, max_batch_size):
+        block = np.arange(block_start, min(block_start + max_batch_size, last))
+        windows_skipped += score_stage1_block(y_long, sr_long, model, bounds, block, stage1_probs,
+                                              max_batch_size, mel_cache, gate_threshold, gate_band,
+                                              instrumentation)
+
+        # Stage 2: grid chunks of the flagged windows that no earlier window has scored
+        flagged = block[stage1_probs[block] > threshold_stage1]
+        windows_flagged += len(flagged)
+        count(instrumentation, 'windows_escalated', len(flagged))
+        needed = [np.arange(bounds[i][0] // hop_samples_inner, min(-(-bounds[i][1] // hop_samples_inner), n_chunks))
+                  for i in flagged]
+        needed = np.concatenate(needed) if needed else np.zeros(0, dtype=int)
+        chunks_requested += len(needed)
+        count(instrumentation, 'stage2_chunks_reused', len(needed) - len(np.unique(needed[~requested[needed]])))
+        requested[needed] = True
+        new_chunks = np.unique(needed[~scored[needed]])
+        if stage2_search == 'adaptive':
+            # Coarse chunks first; a finer chunk only next to a scored coarser one with some evidence
+            score_chunks(new_chunks[new_chunks % STAGE2_COARSE_STRIDE == 0])
+            stride = STAGE2_COARSE_STRIDE
+            while stride > 1:
+                stride //= 2
+                level = new_chunks[(new_chunks % stride == 0) & (new_chunks % (2 * stride) != 0)]
+                evidence = np.zeros(len(level), dtype=bool)
+                for neighbours in (level - stride, level + stride):
+                    inside = (neighbours >= 0) & (neighbours < n_chunks)
+                    neighbours = np.clip(neighbours, 0, max(n_chunks - 1, 0))
+                    evidence |= inside & scored[neighbours] & (chunk_probs[neighbours] >= refine_threshold)
+                score_chunks(level[evidence])
+        else:
+            score_chunks(new_chunks)
+
+        # Cells before the next window's start are final; so is an event followed by a full gap of them
+        final_cells = len(track) if block[-1] + 1 == n_windows else bounds[block[-1] + 1][0] // hop_samples_inner
+        for call in final_track_events(track, final_cells, threshold_stage2, min_gap_cells, cell_duration,
+                                       total_duration_seconds, call_timestamps):
+            call_timestamps.append(call)
+            if detection_callback is not None:
+                detection_callback(call)
+        if progress_callback is not None:
+            progress_callback(int(block[-1]) + 1, n_windows)
+
+    if gate_threshold is not None:
+        logger.info("Stage 0 skipped %d of %d outer windows", windows_skipped, last - first)
+    logger.info("Stage 1 flagged %d of %d outer windows", windows_flagged, last - first)
+    # Chunks an exhaustive search would have scored but the adaptive one skipped
+    chunks_saved = int(requested.sum() - scored.sum())
+    count(instrumentation, 'stage2_chunks_saved', chunks_saved)
+    logger.info("Stage 2 scored %d chunks, reused %d from overlapping windows, skipped %d",
+                int(scored.sum()), chunks_requested - int(requested.sum()), chunks_saved)
+
+    return {
+        'call_count': len(call_timestamps),
+        'call_timestamps': call_timestamps,
+        'duration': total_duration_seconds,
+        'window_start_times': window_starts[first:last] / sr_long,
+        'stage1_probs': stage1_probs[first:last],
+        'windows_skipped': windows_skipped,
+        'probability_track': track,
+        'track_hop': cell_duration,
+        'stage2_chunks_scored': int(scored.sum()),
+        'stage2_chunks_reused': chunks_requested - int(requested.sum()),
+        'stage2_chunks_saved': chunks_saved,
+    }
+
+# Decode and resample an audio file incrementally, yielding mono float32 blocks at target_sr
+def stream_audio_blocks(audio_path, target_sr=TARGET_SR, block_duration=STREAM_BLOCK_DURATION,
+                        res_type=RESAMPLE_TYPE, load_timings=None):
+    """
+    Reads block_duration seconds of audio at a time with soundfile and resamples each
+    block with a stateful soxr stream (equivalent to librosa's soxr resamplers on the
+    whole file), so memory use does not depend on the file length. Only the soxr_*
+    res_type values can run incrementally; any other value uses soxr 'HQ'. Formats
+    soundfile cannot read are loaded whole with load_audio and yielded in blocks.
+    If a load_timings dict is given, decode and resample times are accumulated in it.
+    """
+    if load_timings is None:
+        load_timings = {}
+    load_timings.update(decode_seconds=0.0, resample_seconds=0.0)
+    try:
+        audio_file = sf.SoundFile(audio_path)
+    except RuntimeError as e:
+        logger.info("Cannot stream %s (%s); loading it whole", audio_path, e)
+        y, _, whole_file_timings = load_audio(audio_path, target_sr, res_type)
+        load_timings.update(whole_file_timings)
+        block_samples = max(1, int(block_duration * target_sr))
+        for start in range(0, len(y), block_samples):
+            yield y[start:start + block_samples]
+        return
+    with audio_file:
+        native_sr = audio_file.samplerate
+        load_timings['native_sr'] = native_sr
+        load_timings['res_type'] = None
+        resampler = None
+        if native_sr != target_sr:
+            quality = SOXR_QUALITIES.get(res_type, 'HQ')
+            load_timings['res_type'] = f"soxr_{quality.lower()}"
+            resampler = soxr.ResampleStream(native_sr, target_sr, 1, dtype='float32', quality=quality)
+        blocks = audio_file.blocks(blocksize=int(block_duration * native_sr), dtype='float32', always_2d=True)
+        while True:
+            start_time = time.perf_counter()
+            block = next(blocks, None)
+            decoded_time = time.perf_counter()
+            load_timings['decode_seconds'] += decoded_time - start_time
+            if block is None:
+                break
+            mono_block = block.mean(axis=1)
+            if resampler is not None:
+                mono_block = resampler.resample_chunk(mono_block)
+                load_timings['resample_seconds'] += time.perf_counter() - decoded_time
+            if len(mono_block) > 0:
+                yield mono_block
+        if resampler is not None:
+            tail = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+            if len(tail) > 0:
+                yield tail
+
+# Run the two-pass detector on consecutive blocks of outer windows as the audio is decoded
+def stream_two_pass_blocks(long_audio_path, model,
+                           threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
+                           window_duration_outer=WINDOW_DURATION_OUTER,
+                           step_duration_inner=STEP_DURATION_INNER,
+                           overlap_inner=OVERLAP_INNER, max_batch_size=MAX_BATCH_SIZE,
+                           spectrogram_cache=False, gate_threshold=None, gate_band=GATE_BAND_HZ,
+                           stage2_search='exhaustive', windows_per_block=STREAM_WINDOWS_PER_BLOCK,
+                           res_type=RESAMPLE_TYPE,
+                           load_timings=None, progress_callback=None, detection_callback=None,
+                           instrumentation=None):
+    """
+    Yields (block_start_time, result) for every windows_per_block outer windows, where
+    result is the run_two_pass_detection dict for that block with times relative to the
+    block start. Only one block of resampled audio is buffered, so peak memory is bounded
+    by windows_per_block * window_duration_outer seconds of audio.
+    progress_callback receives progress over the whole file, with the window total taken
+    from the file header, and detection_callback receives call records with recording
+    times.
+    """
+    block_samples = windows_per_block * int(window_duration_outer * TARGET_SR)
+    detector_kwargs = dict(threshold_stage1=threshold_stage1, threshold_stage2=threshold_stage2,
+                           window_duration_outer=window_duration_outer,
+                           step_duration_inner=step_duration_inner, overlap_inner=overlap_inner,
+                           max_batch_size=max_batch_size, spectrogram_cache=spectrogram_cache,
+                           gate_threshold=gate_threshold, gate_band=gate_band, stage2_search=stage2_search,
+                           instrumentation=instrumentation)
+    if progress_callback is not None:
+        windows_total = len(outer_window_starts(sf.info(long_audio_path).duration, window_duration_outer, TARGET_SR))
+    buffer = np.zeros(0, dtype=np.float32)
+    block_start_time = 0.0
+    block_index = 0
+
+    # Progress of one block's detection, reported relative to the whole file
+    def block_progress(windows_done, _):
+        progress_callback(block_index * windows_per_block + windows_done, windows_total)
+
+    # Call record of one block, passed on with recording times
+    def block_detection(call):
+        detection_callback(offset_call_timestamp(call, block_start_time))
+
+    if progress_callback is not None:
+        detector_kwargs['progress_callback'] = block_progress
+    if detection_callback is not None:
+        detector_kwargs['detection_callback'] = block_detection
+    for audio_block in stream_audio_blocks(long_audio_path, res_type=res_type, load_timings=load_timings):
+        buffer = np.concatenate([buffer, audio_block])
+        while len(buffer) >= block_samples:
+            yield block_start_time, run_two_pass_detection(buffer[:block_samples], TARGET_SR, model, **detector_kwargs)
+            buffer = buffer[block_samples:]
+            block_start_time += windows_per_block * window_duration_outer
+            block_index += 1
+    if len(buffer) > 0:
+        yield block_start_time, run_two_pass_detection(buffer, TARGET_SR, model, **detector_kwargs)
+
+# Shift a detection record from block-relative to recording-relative times
+def offset_call_timestamp(call, offset_time):
+    return {
+        'start_time': offset_time + call['start_time'],
+        'end_time': offset_time + call['end_time'],
+        'mid_time': offset_time + call['mid_time'],
+        'confidence': call['confidence']
+    }
+
+# Streaming detector: yields one detection record per call as soon as its window block completes
+def stream_capuchin_detections(long_audio_path, model, **kwargs):
+    for block_start_time, result in stream_two_pass_blocks(long_audio_path, model, **kwargs):
+        for call in result['call_timestamps']:
+            yield offset_call_timestamp(call, block_start_time)
+
+# Merge the per-block results of the streaming detector into one result dict
+def collect_streamed_detection(long_audio_path, model, **kwargs):
+    call_timestamps = []
+    window_start_times = []
+    stage1_probs = []
+    windows_skipped = 0
+    duration = 0.0
+    load_timings = {}
+    try:
+        for block_start_time, result in stream_two_pass_blocks(long_audio_path, model, load_timings=load_timings, **kwargs):
+            call_timestamps.extend(offset_call_timestamp(call, block_start_time) for call in result['call_timestamps'])
+            duration = block_start_time + result['duration']
+            window_start_times.append(block_start_time + result['window_start_times'])
+            stage1_probs.append(result['stage1_probs'])
+            windows_skipped += result['windows_skipped']
+    except DetectionCancelled:
+        raise
+    except Exception as e:
+        logger.error("Error streaming long audio file: %s, %s", long_audio_path, e)
+        return None
+
+    logger.info("Total Capuchin calls detected (Streaming) in %s: %d", os.path.basename(long_audio_path),
+                len(call_timestamps))
+    return {
+        'call_count': len(call_timestamps),
+        'call_timestamps': call_timestamps,
+        'duration': duration,
+        'load_timings': load_timings,
+        'window_start_times': np.concatenate(window_start_times) if window_start_times else np.zeros(0),
+        'stage1_probs': np.concatenate(stage1_probs) if stage1_probs else np.zeros(0, dtype=np.float32),
+        'windows_skipped': windows_skipped,
+    }
+
+# Load a recording and run the two-pass detector on it
+def detect_capuchin_calls(long_audio_path, model=None,
+                          threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
+                          window_duration_outer=WINDOW_DURATION_OUTER,
+                          step_duration_inner=STEP_DURATION_INNER,
+                          overlap_inner=OVERLAP_INNER, max_batch_size=MAX_BATCH_SIZE,
+                          spectrogram_cache=False, streaming=False, res_type=RESAMPLE_TYPE,
+                          gate_threshold=None, gate_band=GATE_BAND_HZ, progress_callback=None,
+                          detection_callback=None, window_hop_outer=None, min_event_gap=MIN_EVENT_GAP,
+                          stage2_search='exhaustive', instrumentation=None, profile=False):
+    """
+    Returns the run_two_pass_detection dict for the whole recording, plus the
+    'load_timings' of load_audio. With streaming enabled the file is decoded and
+    resampled block by block (stream_two_pass_blocks) instead of being loaded into
+    memory at once. gate_threshold enables the Stage-0 band energy gate; the callbacks
+    are passed on to the detector (see run_two_pass_detection), with recording times.
+    With a window_hop_outer (seconds), outer windows overlap and calls are counted as
+    merged events (run_event_detection); this mode loads the whole file.
+    stage2_search is 'exhaustive' or 'adaptive' (see STAGE2_COARSE_STRIDE).
+    The 'instrumentation' entry holds the stage timings and counters of the run
+    (Instrumentation.as_dict); with profile enabled it includes a cProfile summary.
+    Pass an Instrumentation to keep the full profile, e.g. for dump_profile.
+    """
+    if model is None:
+        logger.error("Model is not provided. Please load your trained model.")
+        return None
+    if streaming and window_hop_outer is not None:
+        raise ValueError("Overlapping outer windows are not supported by the streaming detector")
+    if stage2_search not in STAGE2_SEARCHES:
+        raise ValueError(f"Unknown Stage-2 search: {stage2_search}")
+    if instrumentation is None:
+        instrumentation = Instrumentation(profile=profile)
+
+    detector_kwargs = dict(threshold_stage1=threshold_stage1, threshold_stage2=threshold_stage2,
+                           window_duration_outer=window_duration_outer,
+                           step_duration_inner=step_duration_inner,
+                           overlap_inner=overlap_inner, max_batch_size=max_batch_size,
+                           spectrogram_cache=spectrogram_cache, gate_threshold=gate_threshold,
+                           gate_band=gate_band, stage2_search=stage2_search, progress_callback=progress_callback,
+                           detection_callback=detection_callback, instrumentation=instrumentation)
+    with instrumentation.profiling():
+        if streaming:
+            result = collect_streamed_detection(long_audio_path, model, res_type=res_type, **detector_kwargs)
+        else:
+            result = _load_and_detect(long_audio_path, model, res_type, window_hop_outer, min_event_gap,
+                                      detector_kwargs)
+    if result is None:
+        return None
+    return finish_instrumentation(result, instrumentation)
+
+# Add the load timings and totals of a finished detection to its Instrumentation and result
+def finish_instrumentation(result, instrumentation):
+    instrumentation.add_time('decode', result['load_timings']['decode_seconds'])
+    instrumentation.add_time('resample', result['load_timings']['resample_seconds'])
+    instrumentation.count('windows_total', len(result['window_start_times']))
+    instrumentation.count('calls', result['call_count'])
+    result['instrumentation'] = instrumentation.as_dict()
+    return result
+
+def _load_and_detect(long_audio_path, model, res_type, window_hop_outer, min_event_gap, detector_kwargs):
+    try:
+        y_long, sr_long, load_timings = load_audio(long_audio_path, TARGET_SR, res_type=res_type)
+    except Exception as e:
+        logger.error("Error loading long audio file: %s, %s", long_audio_path, e)
+        return None
+
+    logger.info("Processing audio file (Two-Pass): %s", os.path.basename(long_audio_path))
+    logger.info("Total duration: %.2f seconds", len(y_long) / sr_long)
+    logger.info("Loaded in %.2f seconds (resampler: %s)", load_timings['decode_seconds'] + load_timings['resample_seconds'],
+                load_timings['res_type'] or 'none, already at target rate')
+    if window_hop_outer is not None:
+        result = run_event_detection(y_long, sr_long, model, window_hop_outer=window_hop_outer,
+                                     min_event_gap=min_event_gap, **detector_kwargs)
+    else:
+        result = run_two_pass_detection(y_long, sr_long, model, **detector_kwargs)
+    logger.info("Total Capuchin calls detected (Two-Pass) in %s: %d", os.path.basename(long_audio_path),
+                result['call_count'])
+    result['load_timings'] = load_timings
+    return result
+
+# Updated two-stage sliding window function for capuchin call detection
+def count_capuchin_calls_two_stage_sliding_window(long_audio_path, model=None,
+                                                  threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
+                                                  window_duration_outer=WINDOW_DURATION_OUTER,
+                                                  step_duration_inner=STEP_DURATION_INNER,
+                                                  overlap_inner=OVERLAP_INNER,
+                                                  batch_stage2=True, max_batch_size=MAX_BATCH_SIZE,
+                                                  two_pass=True, res_type=RESAMPLE_TYPE):
+    """
+    Counts capuchin calls using a two-stage sliding window approach (LATEST VERSION).
+    With two_pass enabled the pipelined engine (run_two_pass_detection) is used.
+    Otherwise windows are processed one by one; with batch_stage2 enabled, all inner
+    chunks of a flagged window are scored in batched model calls of at most
+    max_batch_size chunks instead of one predict per chunk.
+    """
+    if model is None:
+        logger.error("Model is not provided. Please load your trained model.")
+        return None
+
+    if two_pass:
+        result = detect_capuchin_calls(long_audio_path, model, threshold_stage1=threshold_stage1,
+                                       threshold_stage2=threshold_stage2,
+                                       window_duration_outer=window_duration_outer,
+                                       step_duration_inner=step_duration_inner,
+                                       overlap_inner=overlap_inner, max_batch_size=max_batch_size,
+                                       res_type=res_type)
+        if result is None:
+            return None
+        return result['call_count'], result['call_timestamps']
+
+    try:
+        y_long, sr_long = librosa.load(long_audio_path, sr=TARGET_SR, res_type=res_type)
+    except Exception as e:
+        logger.error("Error loading long audio file: %s, %s", long_audio_path, e)
+        return None
+
+    window_samples_outer = int(window_duration_outer * sr_long)
+    step_samples_inner = int(step_duration_inner * sr_long)
+    hop_samples_inner = int(step_samples_inner * (1 - overlap_inner))
+    total_duration_seconds = librosa.get_duration(y=y_long, sr=sr_long)
+
+    capuchin_call_count = 0
+    outer_window_start_time = 0.0
+    
+    # Store timestamps of detected calls
+    call_timestamps = []
+
+    logger.info("Processing audio file (Two-Stage Sliding Window - LATEST): %s", os.path.basename(long_audio_path))
+    logger.info("Total duration: %.2f seconds", total_duration_seconds)
+
+    outer_start_sample = 0
+    while outer_window_start_time < total_duration_seconds:
+        outer_end_sample = outer_start_sample + window_samples_outer
+        if outer_end_sample > len(y_long):
+            outer_end_sample = len(y_long)
+        outer_window_audio = y_long[outer_start_sample:outer_end_sample]
+        outer_window_duration = len(outer_window_audio) / sr_long
+        outer_window_end_time = outer_window_start_time + outer_window_duration
+
+        logger.debug("Outer Window: Start Time: %.2fs, End Time: %.2fs, Duration: %.2fs",
+                     outer_window_start_time, outer_window_end_time, outer_window_duration)
+
+        # Stage 1: Quick Check - Classify Entire 6-second Segment (Option A)
+        mel_spec_outer_window = extract_mel_spectrogram(audio_path=None, y=outer_window_audio, sr=sr_long, target_time_frames=157)
+        stage1_predicted_class = 0  # Default to no call
+        if mel_spec_outer_window is not None:
+            stage1_prediction = model.predict(to_model_input([mel_spec_outer_window]), verbose=0)
+            stage1_prediction_prob = stage1_prediction[0][0]
+            stage1_predicted_class = int(stage1_prediction_prob > threshold_stage1)
+
+        if stage1_predicted_class == 0:  # No Call Indicated by Stage 1
+            logger.debug("  Stage 1: No Call Indicated - Skipping Stage 2")
+        else:  # Call Indicated by Stage 1 - Proceed to Stage 2
+            logger.debug("  Stage 1: Call Indicated - Proceeding to Stage 2 Inner Loop")
+            has_call_in_window = False
+            if batch_stage2:
+                # Stage 2: Detailed Analysis (all inner chunks scored in batched model calls)
+                chunk_probs = stage2_chunk_probabilities([outer_window_audio], sr_long, model,
+                                                         step_samples_inner, hop_samples_inner,
+                                                         max_batch_size=max_batch_size)[0]
+                has_call_in_window = bool(np.any(chunk_probs > threshold_stage2))
+            else:
+                inner_start_sample = 0
+                # Stage 2: Detailed Analysis (Inner Loop - 0.2-second Chunks)
+                while inner_start_sample < len(outer_window_audio):
+                    inner_end_sample = inner_start_sample + step_samples_inner
+                    if inner_end_sample > len(outer_window_audio):
+                        inner_end_sample = len(outer_window_audio)
+                    inner_chunk_audio = outer_window_audio[inner_start_sample:inner_end_sample]
+                    if len(inner_chunk_audio) < step_samples_inner / 2:
+                        inner_start_sample += hop_samples_inner
+                        continue
+                    mel_spec_chunk = extract_mel_spectrogram(audio_path=None, y=inner_chunk_audio, sr=sr_long,
+                                                             target_time_frames=CHUNK_INPUT_SHAPE[1])
+                    if mel_spec_chunk is not None:
+                        prediction = model.predict(to_model_input([mel_spec_chunk]), verbose=0)
+                        prediction_prob_inner = prediction[0][0]
+                        predicted_class_inner = int(prediction_prob_inner > threshold_stage2)
+                        if predicted_class_inner == 1:
+                            # One positive chunk is enough to count the window
+                            has_call_in_window = True
+                            break
+                    inner_start_sample += hop_samples_inner
+
+            if has_call_in_window:
+                capuchin_call_count += 1
+                # Store the timestamp of this call (midpoint of the window)
+                call_middle_time = outer_window_start_time + (outer_window_duration / 2)
+                call_timestamps.append({
+                    'start_time': outer_window_start_time,
+                    'end_time': outer_window_end_time,
+                    'mid_time': call_middle_time,
+                    'confidence': float(stage1_prediction_prob)
+                })
+                logger.debug("  Call Event Detected in Outer Window - Incrementing Call Count")
+            else:
+                logger.debug("  Stage 2: No Call Event Detected in Outer Window (Despite Stage 1 Indication)")
+        outer_window_start_time += window_duration_outer
+        outer_start_sample = int(outer_window_start_time * sr_long)
+
+    logger.info("Total Capuchin calls detected (Two-Stage Sliding Window - LATEST) in %s: %d",
+                os.path.basename(long_audio_path), capuchin_call_count)
+    return capuchin_call_count, call_timestamps
@@ -0,0 +1,29 @@
+"""
+Content hashes of buffers and files, shared by the result cache, the feature stores,
+the SavedModel export and the chat knowledge index. Only the standard library is
+imported, so light modules can use it.
+"""
+import hashlib
+import os
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+_file_hashes = {}
+
+
+# SHA-256 of an in-memory buffer
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# SHA-256 of a file, read in blocks; remembered per (path, size, mtime) for the process lifetime
+def hash_file(path):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
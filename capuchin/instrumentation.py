@@ -0,0 +1,111 @@
+"""
+Instrumentation of the detector: per-stage wall-clock timers, counters and an optional
+cProfile run.
+
+A detection fills one Instrumentation with the seconds spent in each of STAGES and
+counters such as the number of windows screened by Stage 1 and escalated to Stage 2.
+Its as_dict() is returned as the 'instrumentation' entry of the detection result.
+Functions that take an instrumentation argument accept None, in which case timed()
+does nothing.
+
+The cProfile hook profiles the thread running the detection; dump_profile writes the
+stats for snakeviz or pstats. For sampling profiles of a running app or batch run,
+attach py-spy from outside (``py-spy record --pid <pid>``); no code hook is needed.
+"""
+import contextlib
+import cProfile
+import io
+import logging
+import pstats
+import time
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('decode', 'resample', 'stage0', 'mel', 'stage1_inference', 'stage2_inference')
+# Functions listed in the profile summary
+PROFILE_TOP_FUNCTIONS = 25
+
+
+class Instrumentation:
+    """Stage timings (seconds) and counters of one detection, optionally with a cProfile run."""
+    def __init__(self, profile=False):
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.counters = {}
+        self.total_seconds = None
+        self._profiler = cProfile.Profile() if profile else None
+        self._profiled = False
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    # Add the timings and counters of another run's as_dict(), e.g. of a parallel worker's shard
+    def merge(self, data):
+        for stage, seconds in data['timings'].items():
+            self.add_time(stage, seconds)
+        for name, n in data['counters'].items():
+            self.count(name, n)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    # Time the whole detection and, if enabled, profile it
+    @contextlib.contextmanager
+    def profiling(self):
+        start = time.perf_counter()
+        profiler = self._profiler
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Only one profiler can be active at a time, e.g. with concurrent jobs
+                logger.warning("Profiling disabled: %s", e)
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiled = True
+            self.total_seconds = time.perf_counter() - start
+
+    # Top functions by cumulative time, or None without a profile
+    def profile_summary(self, top=PROFILE_TOP_FUNCTIONS):
+        if not self._profiled:
+            return None
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+        return stream.getvalue()
+
+    def dump_profile(self, path):
+        if self._profiled:
+            self._profiler.dump_stats(path)
+
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+            'total_seconds': self.total_seconds,
+            'profile': self.profile_summary(),
+        }
+
+
+# Timer context for a stage, or a no-op without instrumentation
+def timed(instrumentation, stage):
+    if instrumentation is None:
+        return contextlib.nullcontext()
+    return instrumentation.timer(stage)
+
+
+# Count on an optional Instrumentation
+def count(instrumentation, name, n=1):
+    if instrumentation is not None:
+        instrumentation.count(name, n)
+
@@ -0,0 +1,212 @@
+"""
+Background detection jobs, so long recordings do not block the Streamlit script thread.
+
+Jobs run detect_capuchin_calls on a pool of DEFAULT_MAX_WORKERS threads (set with
+$CAPUCHIN_JOB_WORKERS), so one long recording does not hold up the jobs of other
+sessions, and concurrent jobs' model calls are batched together by a shared
+InferenceServer. Their state (status, the recording's duration, windows processed out of
+the total, the calls detected so far, result or error) is kept in a SQLite table next to
+the result cache, so a page reload, or another page, can look a job up by its id and
+poll it. A job can be cancelled while it is queued or running, from any JobQueue on the same
+directory; a running detection stops at the end of its current block of windows.
+
+Jobs left queued or running by an earlier process cannot finish and are marked failed
+when a JobQueue is created. Finished jobs are deleted after JOB_RETENTION_SECONDS.
+"""
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import librosa
+import soundfile as sf
+
+from capuchin.analysis import LazyAnalysis
+from capuchin.cache import DEFAULT_CACHE_DIR, dumps_result, hash_file, loads_result, sqlite_connection
+from capuchin.detection import DetectionCancelled, detect_capuchin_calls
+from capuchin.store import ANALYSIS_SR, DEFAULT_STORE_DIR, FeatureStore
+
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+# Detection jobs run at the same time; their model calls share one model, so this is not tied to the CPU count
+DEFAULT_MAX_WORKERS = int(os.environ.get("CAPUCHIN_JOB_WORKERS", 4))
+# Minimum time between two progress writes of one job
+PROGRESS_INTERVAL = 0.5
+# Identifies the jobs run by this process
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+_COLUMNS = ('id', 'key', 'audio_path', 'filename', 'audio_hash', 'status', 'duration', 'windows_done',
+            'windows_total', 'result', 'error', 'detections', 'cancel_requested', 'created', 'updated')
+
+
+# Length of the recording in seconds, read from the file header where soundfile can
+def audio_duration(audio_path):
+    try:
+        return sf.info(audio_path).duration
+    except RuntimeError:
+        return librosa.get_duration(path=audio_path)
+
+
+# Analysis-result entries ('capuchin_calls', ...) of a detection result, as stored by the pages
+def detection_entries(detection):
+    return {
+        'capuchin_calls': detection['call_count'],
+        'call_timestamps': detection['call_timestamps'],
+        'window_start_times': detection['window_start_times'],
+        'stage1_probs': detection['stage1_probs'],
+        'probability_track': detection.get('probability_track'),
+        'track_hop': detection.get('track_hop'),
+        'instrumentation': detection.get('instrumentation'),
+    }
+
+
+# Rebuild the analysis results of a finished job's recording, e.g. after a browser refresh
+def load_job_analysis(job, store_root=DEFAULT_STORE_DIR):
+    store = FeatureStore(job['audio_hash'] or hash_file(job['audio_path']), store_root)
+    y = store.waveform(job['audio_path'])
+    results = LazyAnalysis(job['filename'], y, ANALYSIS_SR, len(y) / ANALYSIS_SR, store=store,
+                           audio_hash=job['audio_hash'])
+    if job['result'] is not None:
+        results.update(detection_entries(job['result']))
+    return results
+
+
+# Store a finished job's detection in the session's analysis results (state is st.session_state)
+def apply_job_result(state, job):
+    results = state.get("analysis_results")
+    if results is None or results.get('audio_hash') != job['audio_hash']:
+        state["analysis_results"] = load_job_analysis(job)
+    else:
+        results.update(detection_entries(job['result']))
+    state["applied_job_id"] = job['id']
+
+
+class JobQueue:
+    """
+    SQLite-backed queue of detection jobs run by max_workers background threads. If a
+    result_cache is given, finished results are also stored in it under the job's key.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_workers=DEFAULT_MAX_WORKERS, result_cache=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, "jobs.sqlite")
+        self.result_cache = result_cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="capuchin-job")
+        with sqlite_connection(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    key TEXT,
+                    audio_path TEXT NOT NULL,
+                    filename TEXT,
+                    audio_hash TEXT,
+                    status TEXT NOT NULL,
+                    duration REAL,
+                    windows_done INTEGER NOT NULL DEFAULT 0,
+                    windows_total INTEGER,
+                    result TEXT,
+                    error TEXT,
+                    detections TEXT,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            # Databases created before partial detections and durations were stored lack their columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'detections' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN detections TEXT")
+            if 'duration' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN duration REAL")
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'interrupted by a restart', updated = ? "
+                         "WHERE status IN ('queued', 'running') AND (owner IS NULL OR owner != ?)",
+                         (time.time(), _PROCESS_TOKEN))
+            conn.execute("DELETE FROM jobs WHERE updated < ?", (time.time() - JOB_RETENTION_SECONDS,))
+
+    # Queue a detection of audio_path and return its job id
+    def submit(self, audio_path, model, options=None, key=None, filename=None, audio_hash=None):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with sqlite_connection(self.db_path) as conn:
+            conn.execute("INSERT INTO jobs (id, key, audio_path, filename, audio_hash, status, owner, created, updated) "
+                         "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)",
+                         (job_id, key, audio_path, filename or os.path.basename(audio_path), audio_hash,
+                          _PROCESS_TOKEN, now, now))
+        self._executor.submit(self._run, job_id, audio_path, model, dict(options or {}), key)
+        return job_id
+
+    # Job state as a dict (with the decoded result once done), or None for an unknown id
+    def get(self, job_id):
+        with sqlite_connection(self.db_path) as conn:
+            row = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row)
+
+    # Most recent job for a cache key that is still queued or running
+    def find_active(self, key):
+        with sqlite_connection(self.db_path) as conn:
+            row = conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE key = ? AND status IN "
+                               f"('queued', 'running') ORDER BY created DESC LIMIT 1", (key,)).fetchone()
+        return self._to_job(row)
+
+    def cancel(self, job_id):
+        with sqlite_connection(self.db_path) as conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+
+    def _is_cancelled(self, job_id):
+        with sqlite_connection(self.db_path) as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def _to_job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        if job['result'] is not None:
+            job['result'] = loads_result(job['result'])
+        job['detections'] = loads_result(job['detections']) if job['detections'] is not None else []
+        return job
+
+    def _update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with sqlite_connection(self.db_path) as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def _run(self, job_id, audio_path, model, options, key):
+        if self._is_cancelled(job_id):
+            self._update(job_id, status='cancelled')
+            return
+        self._update(job_id, status='running')
+        detections = []
+        last_write = 0.0
+        written_detections = 0
+
+        # New detections are written right away, plain progress at most every PROGRESS_INTERVAL
+        def progress(windows_done, windows_total):
+            nonlocal last_write, written_detections
+            if self._is_cancelled(job_id):
+                raise DetectionCancelled()
+            if len(detections) > written_detections or time.monotonic() - last_write >= PROGRESS_INTERVAL:
+                last_write = time.monotonic()
+                written_detections = len(detections)
+                self._update(job_id, windows_done=min(windows_done, windows_total), windows_total=windows_total,
+                             detections=dumps_result(detections))
+
+        try:
+            # Stored first, so the progress view can place partial detections on the recording's time axis
+            self._update(job_id, duration=audio_duration(audio_path))
+            result = detect_capuchin_calls(audio_path, model, progress_callback=progress,
+                                           detection_callback=detections.append, **options)
+        except DetectionCancelled:
+            self._update(job_id, status='cancelled')
+            return
+        except Exception as e:
+            self._update(job_id, status='failed', error=str(e))
+            return
+        if result is None:
+            self._update(job_id, status='failed', error="detection failed")
+            return
+        if self.result_cache is not None and key is not None:
+            self.result_cache.put(key, result)
+        n_windows = len(result['window_start_times'])
+        self._update(job_id, status='done', result=dumps_result(result), windows_done=n_windows, windows_total=n_windows,
+                     detections=dumps_result(result['call_timestamps']))
@@ -0,0 +1,129 @@
+"""
+Persistent vector index of the Chat Assistant's knowledge base.
+
+The PDF and text files in KNOWLEDGE_DIR are split into chunks, embedded with
+EMBEDDING_MODEL and stored in a Chroma collection persisted under INDEX_DIR. A manifest
+next to the collection records the content hash of every indexed file and the ids of
+its chunks. sync_index compares the files with the manifest and only loads, splits and
+embeds files that are new or changed; the chunks of changed and deleted files are
+removed by id. A change of the embedding model or the splitter settings rebuilds the
+whole index.
+
+LangChain, Chroma and sentence-transformers are imported when an index is opened, so
+the manifest helpers work without them.
+"""
+import json
+import logging
+import os
+import threading
+
+from capuchin.hashing import hash_file
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_DIR = "docs"
+INDEX_DIR = "chroma_db"
+COLLECTION_NAME = "knowledge_base"
+MANIFEST_FILE = "manifest.json"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+KNOWLEDGE_EXTENSIONS = ('.pdf', '.txt')
+
+# Serialises index updates of the sessions sharing one index
+_sync_lock = threading.Lock()
+
+
+# Settings that change every chunk or embedding when they change
+def index_settings():
+    return {'embedding_model': EMBEDDING_MODEL, 'chunk_size': CHUNK_SIZE, 'chunk_overlap': CHUNK_OVERLAP}
+
+
+def read_manifest(index_dir=INDEX_DIR):
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'settings': None, 'files': {}}
+
+
+# Written to a temporary file first, so a crash never leaves a partial manifest
+def write_manifest(manifest, index_dir=INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# Content hash of every knowledge file, by file name
+def knowledge_files(knowledge_dir=KNOWLEDGE_DIR):
+    return {
+        name: hash_file(os.path.join(knowledge_dir, name))
+        for name in sorted(os.listdir(knowledge_dir))
+        if name.lower().endswith(KNOWLEDGE_EXTENSIONS)
+    }
+
+
+def load_embeddings(model_name=EMBEDDING_MODEL):
+    from langchain.embeddings import SentenceTransformerEmbeddings
+
+    return SentenceTransformerEmbeddings(model_name=model_name)
+
+
+# Chroma collection persisted in index_dir (created empty if missing)
+def open_index(embeddings, index_dir=INDEX_DIR):
+    from langchain.vectorstores import Chroma
+
+    return Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, persist_directory=index_dir)
+
+
+# Chunks of one knowledge file
+def split_file(file_path):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
+    loader = PyPDFLoader(file_path) if file_path.lower().endswith('.pdf') else TextLoader(file_path)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return text_splitter.split_documents(loader.load())
+
+
+def sync_index(vectorstore, knowledge_dir=KNOWLEDGE_DIR, index_dir=INDEX_DIR, split=split_file):
+    """
+    Brings the index up to date with knowledge_dir and returns the file names added,
+    updated and removed. Only new and changed files are embedded.
+    """
+    with _sync_lock:
+        manifest = read_manifest(index_dir)
+        indexed = manifest['files']
+        if manifest['settings'] != index_settings():
+            stale_ids = [chunk_id for entry in indexed.values() for chunk_id in entry['ids']]
+            if stale_ids:
+                vectorstore.delete(ids=stale_ids)
+            indexed = {}
+        current = knowledge_files(knowledge_dir)
+        changes = {'added': [], 'updated': [], 'removed': []}
+        for name in [name for name in indexed if name not in current]:
+            vectorstore.delete(ids=indexed.pop(name)['ids'])
+            changes['removed'].append(name)
+        for name, content_hash in current.items():
+            entry = indexed.get(name)
+            if entry is not None and entry['hash'] == content_hash:
+                continue
+            if entry is not None:
+                vectorstore.delete(ids=entry['ids'])
+            splits = split(os.path.join(knowledge_dir, name))
+            # Ids derived from the file and its content, so re-adding a file never duplicates its chunks
+            ids = [f"{name}:{content_hash[:16]}:{i}" for i in range(len(splits))]
+            if splits:
+                vectorstore.add_documents(splits, ids=ids)
+            indexed[name] = {'hash': content_hash, 'ids': ids}
+            changes['updated' if entry is not None else 'added'].append(name)
+            # Recorded after every file, so an interrupted sync resumes with the next one
+            write_manifest({'settings': index_settings(), 'files': indexed}, index_dir)
+        write_manifest({'settings': index_settings(), 'files': indexed}, index_dir)
+    logger.info("Knowledge index: %d added, %d updated, %d removed, %d unchanged",
+                len(changes['added']), len(changes['updated']), len(changes['removed']),
+                len(current) - len(changes['added']) - len(changes['updated']))
+    return changes
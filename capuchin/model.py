@@ -0,0 +1,219 @@
+"""
+EfficientNetB0 capuchin call classifier.
+
+TensorFlow is imported when a model is built, so importing this module (for example
+from the batch runner's parent process or an app page) stays cheap.
+"""
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# MODEL_WEIGHTS_FILE = r'weights\capuchin_bird_classifier.weights.h5'
+MODEL_WEIGHTS_FILE = 'weights/capuchin_bird_classifier.weights.h5'
+# Stage-1 model input: one mel spectrogram channel, 157 frames for a 6 s window
+INPUT_SHAPE = (128, 157, 1)
+# Stage-2 model input: 10 frames for a 0.3 s chunk (shorter last chunks are padded to it)
+CHUNK_INPUT_SHAPE = (128, 10, 1)
+# The classifier is built once per input width, named after the detector input it takes
+INPUT_SHAPES = {'window': INPUT_SHAPE, 'chunk': CHUNK_INPUT_SHAPE}
+# The EfficientNetB0 classifier was trained on the spectrogram copied into 3 channels
+CLASSIFIER_CHANNELS = 3
+# Pre-traced SavedModel of the classifier (python -m capuchin.backends --format savedmodel)
+SAVED_MODEL_DIR = 'weights/capuchin_bird_classifier_savedmodel'
+SAVED_MODEL_WEIGHTS_HASH = 'weights.sha256'
+
+
+# Size TensorFlow's thread pools, e.g. so parallel worker processes do not oversubscribe the CPU
+def configure_tensorflow_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    intra_op_threads parallelize a single operation (a convolution), inter_op_threads run
+    independent operations concurrently. This only works before TensorFlow runs its first
+    operation in the process; later calls log a warning and change nothing.
+    """
+    import tensorflow as tf
+
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        logger.warning("Could not set TensorFlow threads: %s", e)
+
+
+# Name of the model input ('window' or 'chunk') a batch of inputs is shaped for
+def input_kind(inputs):
+    width = np.shape(inputs)[2]
+    for kind, shape in INPUT_SHAPES.items():
+        if shape[1] == width:
+            return kind
+    raise ValueError(f"The classifier takes {INPUT_SHAPE[1]}-frame windows or {CHUNK_INPUT_SHAPE[1]}-frame "
+                     f"chunks, not {width}-frame inputs")
+
+
+# The classifier architecture for 3-channel inputs of one fixed width
+def build_classifier(frames):
+    """
+    EfficientNetB0 pads its strided convolutions for the width it is built for, so a
+    model built for 157 frames gives wrong results (or fails) on narrower inputs. Every
+    width has the same weights, though, so one set of weights loads into each.
+    """
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Input
+    from tensorflow.keras.applications import EfficientNetB0
+
+    input_tensor = Input(shape=(INPUT_SHAPE[0], frames, CLASSIFIER_CHANNELS))
+    base_model = EfficientNetB0(include_top=False, weights=None, input_tensor=input_tensor)
+    x = base_model.output
+    x = GlobalAveragePooling2D()(x)
+    x = Dense(128, activation='relu')(x)
+    output_tensor = Dense(1, activation='sigmoid')(x)
+    return Model(inputs=input_tensor, outputs=output_tensor)
+
+
+# Model taking single-channel spectrograms that copies the channel CLASSIFIER_CHANNELS times inside the graph
+def single_channel_model(classifier):
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import Concatenate, Input
+
+    spectrogram = Input(shape=classifier.input_shape[1:3] + (1,))
+    channels = Concatenate(axis=-1)([spectrogram] * CLASSIFIER_CHANNELS)
+    return Model(inputs=spectrogram, outputs=classifier(channels))
+
+
+class CapuchinClassifier:
+    """
+    The Keras classifier for Stage-1 windows (INPUT_SHAPE) and Stage-2 chunks
+    (CHUNK_INPUT_SHAPE), called like a Keras model (``model(batch, training=False)``).
+    Each batch goes to the model built for its width; both models take single-channel
+    spectrograms and have the same weights.
+    """
+    def __init__(self, models):
+        self.models = models
+
+    def __call__(self, inputs, training=False):
+        return self.models[input_kind(inputs)](inputs, training=training)
+
+    def predict(self, inputs, verbose=0):
+        return self.models[input_kind(inputs)].predict(inputs, verbose=verbose)
+
+
+# Build the classifier for every input width and load the trained weights
+def load_capuchin_model(weights_file=MODEL_WEIGHTS_FILE):
+    """
+    The weights are loaded into the 157-frame classifier, which has the architecture they
+    were saved from, and copied into the chunk-width classifier. Callers pass
+    (N, 128, frames, 1) spectrograms and never build 3-channel copies of their inputs.
+    """
+    window_classifier = build_classifier(INPUT_SHAPE[1])
+    window_classifier.load_weights(weights_file)
+    models = {'window': single_channel_model(window_classifier)}
+    for kind, shape in INPUT_SHAPES.items():
+        if kind != 'window':
+            classifier = build_classifier(shape[1])
+            classifier.set_weights(window_classifier.get_weights())
+            models[kind] = single_channel_model(classifier)
+    return CapuchinClassifier(models)
+
+
+# Largest difference between SavedModel and Keras probabilities that check_saved_model accepts
+SAVED_MODEL_TOLERANCE = 1e-4
+
+
+# Save the classifier built from weights_file as a pre-traced SavedModel that loads without rebuilding it
+def export_saved_model(weights_file=MODEL_WEIGHTS_FILE, export_dir=SAVED_MODEL_DIR):
+    """
+    The SavedModel has one function per input kind ('window' and 'chunk'), each traced
+    for (N, 128, frames, 1) float32 inputs of any batch size and the kind's fixed width.
+    The export is checked against the Keras model (check_saved_model) before the hash of
+    the weights is written next to it, so load_saved_model never loads an export that
+    failed the check, or one made from other weights.
+    """
+    import tensorflow as tf
+
+    from capuchin.hashing import hash_file
+
+    model = load_capuchin_model(weights_file)
+    hash_path = os.path.join(export_dir, SAVED_MODEL_WEIGHTS_HASH)
+    if os.path.exists(hash_path):
+        os.remove(hash_path)
+    module = tf.Module()
+    module.keras_models = list(model.models.values())
+    for kind, keras_model in model.models.items():
+        setattr(module, kind, _inference_function(keras_model, INPUT_SHAPES[kind]))
+    tf.saved_model.save(module, export_dir, signatures={kind: getattr(module, kind) for kind in model.models})
+    check_saved_model(model, SavedModelClassifier(export_dir))
+    with open(hash_path, "w") as f:
+        f.write(hash_file(weights_file))
+    return export_dir
+
+
+# tf.function running keras_model in inference mode on (N,) + input_shape float32 batches
+def _inference_function(keras_model, input_shape):
+    import tensorflow as tf
+
+    input_signature = [tf.TensorSpec((None,) + input_shape, tf.float32, name='inputs')]
+    return tf.function(lambda inputs: keras_model(inputs, training=False), input_signature=input_signature)
+
+
+# Raise if the SavedModel's probabilities for any input kind differ from the Keras model's
+def check_saved_model(keras_model, saved_model, n_inputs=8, seed=0):
+    rng = np.random.default_rng(seed)
+    for kind, shape in INPUT_SHAPES.items():
+        inputs = rng.uniform(-80.0, 0.0, size=(n_inputs,) + shape).astype(np.float32)
+        difference = np.max(np.abs(np.asarray(saved_model(inputs)) - np.asarray(keras_model(inputs))))
+        if not difference <= SAVED_MODEL_TOLERANCE:
+            raise RuntimeError(f"The SavedModel in {saved_model.export_dir} differs from the Keras model on {kind} "
+                               f"inputs by {difference:.3g}")
+
+
+class SavedModelClassifier:
+    """
+    The exported classifier, called like the Keras model (``model(batch, training=False)``):
+    each batch goes to the function traced for its input kind.
+    """
+    def __init__(self, export_dir=SAVED_MODEL_DIR):
+        import tensorflow as tf
+
+        self.export_dir = export_dir
+        # The loaded object owns the variables, so it is kept alongside its functions
+        self.saved_model = tf.saved_model.load(export_dir)
+        missing = [kind for kind in INPUT_SHAPES if not hasattr(self.saved_model, kind)]
+        if missing:
+            raise ValueError(f"The SavedModel in {export_dir} has no {', '.join(missing)} function")
+        self.models = {kind: getattr(self.saved_model, kind) for kind in INPUT_SHAPES}
+
+    def __call__(self, inputs, training=False):
+        return self.models[input_kind(inputs)](np.asarray(inputs, dtype=np.float32)).numpy()
+
+    def predict(self, inputs, verbose=0):
+        return self(inputs)
+
+
+# SavedModel exported from weights_file, or None if there is none, it is outdated or the weights have changed since
+def load_saved_model(weights_file=MODEL_WEIGHTS_FILE, export_dir=SAVED_MODEL_DIR):
+    from capuchin.hashing import hash_file
+
+    hash_path = os.path.join(export_dir, SAVED_MODEL_WEIGHTS_HASH)
+    if not os.path.exists(hash_path) or not os.path.exists(weights_file):
+        return None
+    with open(hash_path) as f:
+        if f.read().strip() != hash_file(weights_file):
+            logger.info("Ignoring the SavedModel in %s: it was exported from other weights", export_dir)
+            return None
+    try:
+        return SavedModelClassifier(export_dir)
+    except ValueError as e:
+        # Exported before the model had a function per input width
+        logger.info("Ignoring the SavedModel in %s: %s", export_dir, e)
+        return None
+
+
+# Run the model once per input kind it has, so the first detection does not pay for tracing
+def warm_up_model(model):
+    for kind in getattr(model, 'models', INPUT_SHAPES):
+        model(np.zeros((1,) + INPUT_SHAPES[kind], dtype=np.float32), training=False)
+    return model
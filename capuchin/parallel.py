@@ -0,0 +1,257 @@
+"""
+Parallel detection of one long recording: the outer windows are split into shards that
+worker processes run through the detector at the same time.
+
+The parent decodes and resamples the file once (block by block with streaming) into a
+raw float32 file in a temporary directory. Every worker loads its own model in the
+pool initializer and opens that file as a read-only np.memmap, so all shards share one
+copy of the audio through the page cache. A shard runs run_two_pass_detection, or
+run_event_detection with a window hop, with a window_range. The detectors read the
+audio around the shard's windows from the memory map, so the spectrogram frames at a
+shard edge see the same neighbouring samples as in a sequential run.
+
+Shards are merged in window order, whatever order they finish in. Without a window hop
+the windows are independent and the merged result is the sequential one (up to the
+model's results depending on batch composition, which is usually bit-exact on CPU).
+With a window hop, windows at a shard edge overlap the previous shard: the shards'
+probability tracks are merged by their maximum and cut into call events once, so a call
+across a shard boundary is counted once. Chunks shared by two shards are scored by both.
+With the adaptive Stage-2 search, a shard only refines around evidence it scored itself,
+so chunks at a shard edge can be refined differently than in a sequential run.
+
+Stage timings in the instrumentation are summed over the workers. To keep the workers
+from oversubscribing the CPU, give each model default_threads(workers) intra-op threads
+and a single inter-op thread (load_inference_model's num_threads and inter_op_threads).
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from capuchin.detection import (
+    MAX_BATCH_SIZE,
+    MIN_EVENT_GAP,
+    OVERLAP_INNER,
+    RESAMPLE_TYPE,
+    STEP_DURATION_INNER,
+    TARGET_SR,
+    THRESHOLD_STAGE2,
+    WINDOW_DURATION_OUTER,
+    event_window_starts,
+    final_track_events,
+    finish_instrumentation,
+    load_audio,
+    outer_window_starts,
+    run_event_detection,
+    run_two_pass_detection,
+    stream_audio_blocks,
+)
+from capuchin.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Shards per worker; more, smaller shards even out workers whose windows escalate more often
+SHARDS_PER_WORKER = 4
+
+# Model of a worker process, loaded once by the pool initializer
+_shard_model = None
+
+
+# Intra-op threads per worker so that workers * threads does not exceed the CPU count
+def default_threads(workers):
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def _init_shard_worker(model_options, log_level=logging.WARNING):
+    global _shard_model
+    logging.basicConfig(level=log_level, format="%(processName)s %(levelname)s %(name)s: %(message)s")
+    # Imported here so the parent process never initializes TensorFlow
+    from capuchin.backends import load_inference_model
+    _shard_model = load_inference_model(**model_options)
+
+
+# Run the detector on the windows first to last - 1 of the decoded recording
+def _detect_shard(audio_file, n_samples, window_range, window_hop_outer, min_event_gap, detector_kwargs):
+    y_long = np.zeros(0, dtype=np.float32)
+    # An empty file cannot be memory-mapped
+    if n_samples:
+        y_long = np.memmap(audio_file, dtype=np.float32, mode='r', shape=(n_samples,))
+    instrumentation = Instrumentation()
+    if window_hop_outer is not None:
+        result = run_event_detection(y_long, TARGET_SR, _shard_model, window_hop_outer=window_hop_outer,
+                                     min_event_gap=min_event_gap, window_range=window_range,
+                                     instrumentation=instrumentation, **detector_kwargs)
+    else:
+        result = run_two_pass_detection(y_long, TARGET_SR, _shard_model, window_range=window_range,
+                                        instrumentation=instrumentation, **detector_kwargs)
+    result['instrumentation'] = instrumentation.as_dict()
+    return result
+
+
+# Process id of a worker, returned after a pause so concurrent calls land on different workers
+def _worker_pid():
+    time.sleep(0.05)
+    return os.getpid()
+
+
+# Decode and resample a recording into a raw float32 file; returns (n_samples, load_timings)
+def decode_to_file(audio_path, output_path, streaming=False, res_type=RESAMPLE_TYPE):
+    load_timings = {}
+    if streaming:
+        n_samples = 0
+        with open(output_path, "wb") as f:
+            for block in stream_audio_blocks(audio_path, res_type=res_type, load_timings=load_timings):
+                np.asarray(block, dtype=np.float32).tofile(f)
+                n_samples += len(block)
+        return n_samples, load_timings
+    y_long, _, load_timings = load_audio(audio_path, TARGET_SR, res_type=res_type)
+    np.asarray(y_long, dtype=np.float32).tofile(output_path)
+    return len(y_long), load_timings
+
+
+class ShardedDetector:
+    """
+    Pool of worker processes, each with its own model (load_inference_model(**model_options)),
+    that detect calls in one recording at a time, split into shards (see the module
+    docstring). Use it as a context manager or call close().
+    """
+    def __init__(self, model_options, workers=None, log_level=logging.WARNING, tmp_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.tmp_dir = tmp_dir
+        # 'spawn' so every worker starts with a fresh TensorFlow runtime
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=_init_shard_worker, initargs=(model_options, log_level))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+
+    # Start every worker and wait until each has loaded its model (workers start lazily otherwise)
+    def wait_ready(self):
+        pids = set()
+        while len(pids) < self.workers:
+            pids.update(future.result() for future in [self._pool.submit(_worker_pid) for _ in range(self.workers)])
+
+    # Outer window ranges of the shards; every shard has at least one batch of windows
+    def shard_ranges(self, n_windows, max_batch_size=MAX_BATCH_SIZE):
+        windows_per_shard = max(max_batch_size, -(-n_windows // (self.workers * SHARDS_PER_WORKER)))
+        return [(first, min(first + windows_per_shard, n_windows)) for first in range(0, n_windows, windows_per_shard)]
+
+    def detect(self, long_audio_path, streaming=False, res_type=RESAMPLE_TYPE, window_hop_outer=None,
+               min_event_gap=MIN_EVENT_GAP, progress_callback=None, detection_callback=None,
+               instrumentation=None, profile=False, **detector_kwargs):
+        """
+        Returns the detect_capuchin_calls result for the recording. detector_kwargs are
+        the detector options (thresholds, max_batch_size, spectrogram_cache, gate_threshold,
+        ...). streaming only bounds the memory used for decoding; shards are always run
+        on the whole decoded file. The callbacks run in this process: detection_callback
+        receives calls as soon as all shards before them are merged, and
+        progress_callback(windows_done, windows_total) is called as shards finish.
+        """
+        if instrumentation is None:
+            instrumentation = Instrumentation(profile=profile)
+        with instrumentation.profiling(), tempfile.TemporaryDirectory(dir=self.tmp_dir) as tmp_dir:
+            audio_file = os.path.join(tmp_dir, "audio.f32")
+            try:
+                n_samples, load_timings = decode_to_file(long_audio_path, audio_file, streaming, res_type)
+            except Exception as e:
+                logger.error("Error loading long audio file: %s, %s", long_audio_path, e)
+                return None
+            logger.info("Processing audio file (%d workers): %s, %.2f seconds", self.workers,
+                        os.path.basename(long_audio_path), n_samples / TARGET_SR)
+            result = self._detect_shards(audio_file, n_samples, window_hop_outer, min_event_gap,
+                                         progress_callback, detection_callback, instrumentation, detector_kwargs)
+        result['load_timings'] = load_timings
+        logger.info("Total Capuchin calls detected (%d workers) in %s: %d", self.workers,
+                    os.path.basename(long_audio_path), result['call_count'])
+        return finish_instrumentation(result, instrumentation)
+
+    def _detect_shards(self, audio_file, n_samples, window_hop_outer, min_event_gap, progress_callback,
+                       detection_callback, instrumentation, detector_kwargs):
+        window_duration_outer = detector_kwargs.get('window_duration_outer', WINDOW_DURATION_OUTER)
+        if window_hop_outer is not None:
+            window_starts, _, hop_samples_inner = event_window_starts(
+                n_samples, TARGET_SR, window_duration_outer, window_hop_outer,
+                detector_kwargs.get('step_duration_inner', STEP_DURATION_INNER),
+                detector_kwargs.get('overlap_inner', OVERLAP_INNER))
+        else:
+            window_starts = [start for _, start in outer_window_starts(n_samples / TARGET_SR, window_duration_outer,
+                                                                       TARGET_SR)]
+        n_windows = len(window_starts)
+        threshold_stage2 = detector_kwargs.get('threshold_stage2', THRESHOLD_STAGE2)
+        ranges = self.shard_ranges(n_windows, detector_kwargs.get('max_batch_size', MAX_BATCH_SIZE))
+        instrumentation.count('shards', len(ranges))
+        futures = {self._pool.submit(_detect_shard, audio_file, n_samples, window_range, window_hop_outer,
+                                     min_event_gap, detector_kwargs): index
+                   for index, window_range in enumerate(ranges)}
+
+        shard_results = [None] * len(ranges)
+        call_timestamps = []
+        track = None
+        merged = 0
+        windows_done = 0
+        try:
+            for future in as_completed(futures):
+                shard = future.result()
+                shard_results[futures[future]] = shard
+                instrumentation.merge(shard['instrumentation'])
+                windows_done += len(shard['window_start_times'])
+                if window_hop_outer is not None:
+                    track = shard['probability_track'] if track is None else np.maximum(track, shard['probability_track'])
+                # Calls are passed on in recording order, once every earlier shard is merged
+                new_calls = []
+                while merged < len(ranges) and shard_results[merged] is not None:
+                    merged += 1
+                    if window_hop_outer is None:
+                        new_calls.extend(shard_results[merged - 1]['call_timestamps'])
+                if window_hop_outer is not None and merged > 0:
+                    # Cells before the next unmerged shard's first window are final
+                    final_cells = len(track)
+                    if merged < len(ranges):
+                        final_cells = window_starts[ranges[merged][0]] // hop_samples_inner
+                    cell_duration = shard['track_hop']
+                    new_calls = final_track_events(track, final_cells, threshold_stage2,
+                                                   int(round(min_event_gap / cell_duration)), cell_duration,
+                                                   n_samples / TARGET_SR, call_timestamps)
+                for call in new_calls:
+                    call_timestamps.append(call)
+                    if detection_callback is not None:
+                        detection_callback(call)
+                if progress_callback is not None:
+                    progress_callback(windows_done, n_windows)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+        result = {
+            'call_count': len(call_timestamps),
+            'call_timestamps': call_timestamps,
+            'duration': n_samples / TARGET_SR,
+            'window_start_times': np.concatenate([shard['window_start_times'] for shard in shard_results])
+                                  if shard_results else np.zeros(0),
+            'stage1_probs': np.concatenate([shard['stage1_probs'] for shard in shard_results])
+                            if shard_results else np.zeros(0, dtype=np.float32),
+            'windows_skipped': sum(shard['windows_skipped'] for shard in shard_results),
+        }
+        if window_hop_outer is not None:
+            result.update(probability_track=track, track_hop=shard_results[0]['track_hop'] if shard_results else None,
+                          stage2_chunks_scored=sum(shard['stage2_chunks_scored'] for shard in shard_results),
+                          stage2_chunks_reused=sum(shard['stage2_chunks_reused'] for shard in shard_results),
+                          stage2_chunks_saved=sum(shard['stage2_chunks_saved'] for shard in shard_results))
+        return result
+
+
+# Detect calls in one recording with a pool of worker processes created for this call
+def detect_capuchin_calls_parallel(long_audio_path, model_options, workers=None, **kwargs):
+    with ShardedDetector(model_options, workers) as detector:
+        return detector.detect(long_audio_path, **kwargs)
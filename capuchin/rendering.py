@@ -0,0 +1,102 @@
+"""
+Plotting helpers that keep waveform and spectrogram rendering time independent of the
+recording length.
+
+Waveforms are reduced to a min/max envelope with about one bin per horizontal pixel,
+and spectrograms are drawn from a pyramid of time-downsampled copies, picking the
+finest level that still fits the viewport width.
+"""
+import numpy as np
+import librosa.display
+
+# Default figures are 10 inches wide at matplotlib's 100 dpi
+DEFAULT_WIDTH_PX = 1000
+
+
+# Min/max envelope of y[start:stop] with at most n_bins bins
+def minmax_envelope(y, n_bins=DEFAULT_WIDTH_PX, start=0, stop=None):
+    """
+    Returns (bin_starts, mins, maxs), with bin_starts as sample indices into y. Every
+    bin keeps the extreme values of its samples, so peaks stay visible at any zoom
+    level. Ranges with no more than 2 * n_bins samples are returned as they are.
+    """
+    stop = len(y) if stop is None else min(stop, len(y))
+    start = max(0, min(start, stop))
+    segment = np.asarray(y[start:stop])
+    if len(segment) <= 2 * n_bins:
+        indices = np.arange(start, stop)
+        return indices, segment, segment
+    bin_size = int(np.ceil(len(segment) / n_bins))
+    n_full = len(segment) // bin_size
+    full = segment[:n_full * bin_size].reshape(n_full, bin_size)
+    mins = full.min(axis=1)
+    maxs = full.max(axis=1)
+    if n_full * bin_size < len(segment):
+        tail = segment[n_full * bin_size:]
+        mins = np.append(mins, tail.min())
+        maxs = np.append(maxs, tail.max())
+    bin_starts = start + np.arange(len(mins)) * bin_size
+    return bin_starts, mins, maxs
+
+
+# Draw a waveform (or any 1-D frame series) as a filled min/max envelope
+def plot_envelope(ax, y, rate, time_range=None, n_bins=DEFAULT_WIDTH_PX, color='#1976D2', alpha=0.8):
+    start, stop = 0, len(y)
+    if time_range is not None:
+        start, stop = int(time_range[0] * rate), int(np.ceil(time_range[1] * rate))
+    bin_starts, mins, maxs = minmax_envelope(y, n_bins, start, stop)
+    times = bin_starts / rate
+    # Short ranges come back as raw samples (mins and maxs are the same array)
+    if mins is maxs:
+        ax.plot(times, mins, color=color, alpha=alpha)
+    else:
+        ax.fill_between(times, mins, maxs, color=color, alpha=alpha, linewidth=0, step='post')
+    if len(times) > 0:
+        ax.set_xlim(times[0], stop / rate)
+
+
+class SpectrogramPyramid:
+    """
+    A spectrogram plus copies downsampled by 2, 4, 8, ... along time. Each level keeps
+    the maximum of every pair of frames from the level below, so short calls remain
+    visible. Levels are built until one has at most min_frames frames.
+
+    With a store (capuchin.store.FeatureStore) the coarser levels are written to it as
+    '<name>_level<index>' and kept as memory maps, and levels already there are reused.
+    """
+    def __init__(self, S, hop_length=512, min_frames=DEFAULT_WIDTH_PX, store=None, name=None):
+        self.hop_length = hop_length
+        self.levels = [S]
+        while self.levels[-1].shape[-1] > min_frames:
+            level_name = f"{name}_level{len(self.levels)}"
+            if store is not None and level_name in store:
+                self.levels.append(store.get(level_name))
+                continue
+            level = self.levels[-1]
+            n_pairs = level.shape[-1] // 2
+            pairs = level[..., :2 * n_pairs].reshape(level.shape[:-1] + (n_pairs, 2))
+            coarser = pairs.max(axis=-1)
+            if level.shape[-1] % 2:
+                coarser = np.concatenate([coarser, level[..., -1:]], axis=-1)
+            self.levels.append(coarser if store is None else store.put(level_name, coarser))
+
+    # (level index, first frame, last frame) of the finest level with at most max_columns frames in range
+    def select(self, sr, time_range=None, max_columns=DEFAULT_WIDTH_PX):
+        n_frames = self.levels[0].shape[-1]
+        start, stop = 0, n_frames
+        if time_range is not None:
+            start = int(time_range[0] * sr / self.hop_length)
+            stop = min(n_frames, int(np.ceil(time_range[1] * sr / self.hop_length)) + 1)
+        for index, level in enumerate(self.levels):
+            factor = 2 ** index
+            if (stop - start) / factor <= max_columns or index == len(self.levels) - 1:
+                return index, start // factor, min(level.shape[-1], int(np.ceil(stop / factor)))
+
+    # Draw the viewport with librosa.display.specshow; returns the image for a colorbar
+    def specshow(self, ax, sr, time_range=None, max_columns=DEFAULT_WIDTH_PX, **kwargs):
+        index, first, last = self.select(sr, time_range, max_columns)
+        factor = 2 ** index
+        S = self.levels[index][..., first:last]
+        x_coords = np.arange(first, last) * factor * self.hop_length / sr
+        return librosa.display.specshow(S, sr=sr, hop_length=self.hop_length * factor,
+                                        x_coords=x_coords, x_axis='time', ax=ax, **kwargs)
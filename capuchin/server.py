@@ -0,0 +1,194 @@
+"""
+In-process inference server: one worker thread owns the loaded models and serves the
+spectrogram batches of many concurrent detection jobs.
+
+Jobs submit model inputs through an InferenceClient, which is called like a Keras model
+and can be passed to the detectors in capuchin.detection. Pending inputs are grouped
+into dynamic batches of at most max_batch_size samples with the same model and input
+shape. A batch is run as soon as it is full, or when its oldest request has waited
+max_latency seconds. Batches are filled round-robin over the jobs with pending inputs,
+so one long recording cannot starve the others, and only one model call runs at a time,
+so concurrent sessions do not oversubscribe the CPU with parallel TensorFlow runtimes.
+"""
+import collections
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from capuchin.detection import MAX_BATCH_SIZE
+
+DEFAULT_MAX_LATENCY = 0.01
+
+
+class _Request:
+    def __init__(self, job_id, model_name, inputs):
+        self.job_id = job_id
+        self.model_name = model_name
+        self.inputs = inputs
+        self.key = (model_name, inputs.shape[1:])
+        self.enqueued = time.monotonic()
+        self.offset = 0
+        self.completed = 0
+        self.probs = np.zeros(len(inputs), dtype=np.float32)
+        self.future = Future()
+
+
+class InferenceClient:
+    """Model-like handle that sends every call to the server as part of job_id."""
+    def __init__(self, server, job_id, model_name):
+        self.server = server
+        self.job_id = job_id
+        self.model_name = model_name
+
+    def __call__(self, inputs, training=False):
+        return self.server.submit(inputs, self.job_id, self.model_name).result()
+
+
+class InferenceServer:
+    """
+    Dynamic batching server for named models (see the module docstring). Models are
+    added with add_model; submit returns a Future with the (N, 1) probabilities.
+    """
+    def __init__(self, models=None, max_batch_size=MAX_BATCH_SIZE, max_latency=DEFAULT_MAX_LATENCY):
+        self.models = dict(models or {})
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        # job_id -> pending requests; the order of the jobs is the round-robin order
+        self._jobs = collections.OrderedDict()
+        self._job_ids = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._batches = 0
+        self._samples = 0
+        self._worker = threading.Thread(target=self._run, name="capuchin-inference", daemon=True)
+        self._worker.start()
+
+    def add_model(self, name, model):
+        with self._condition:
+            self.models[name] = model
+
+    # A client for one detection job; each job gets its own share of every batch
+    def client(self, job_id=None, model_name='keras'):
+        if job_id is None:
+            job_id = f"job-{next(self._job_ids)}"
+        return InferenceClient(self, job_id, model_name)
+
+    def submit(self, inputs, job_id, model_name='keras'):
+        request = _Request(job_id, model_name, np.asarray(inputs, dtype=np.float32))
+        if len(request.inputs) == 0:
+            request.future.set_result(np.zeros((0, 1), dtype=np.float32))
+            return request.future
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Inference server is closed")
+            if model_name not in self.models:
+                raise KeyError(f"Unknown model: {model_name}")
+            self._jobs.setdefault(job_id, collections.deque()).append(request)
+            self._condition.notify_all()
+        return request.future
+
+    # Number of input samples waiting to be scored, in total or for one job
+    def queue_depth(self, job_id=None):
+        with self._condition:
+            jobs = [self._jobs.get(job_id, ())] if job_id is not None else self._jobs.values()
+            return sum(len(request.inputs) - request.offset for requests in jobs for request in requests)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queue_depth': self.queue_depth(),
+                'jobs': {job_id: self.queue_depth(job_id) for job_id in self._jobs},
+                'batches': self._batches,
+                'mean_batch_size': self._samples / self._batches if self._batches else 0.0,
+            }
+
+    # Stop the worker after the pending requests are served
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+
+    def _pending(self, key):
+        return sum(len(r.inputs) - r.offset for requests in self._jobs.values() for r in requests if r.key == key)
+
+    # Take up to max_batch_size samples of one key into parts, in equal turns from every job that has some
+    def _take_batch(self, key, parts):
+        size = 0
+        active = [job_id for job_id, requests in self._jobs.items() if any(r.key == key for r in requests)]
+        if active:
+            # The next batch starts with the next job
+            self._jobs.move_to_end(active[0])
+        while size < self.max_batch_size and active:
+            quantum = max(1, (self.max_batch_size - size) // len(active))
+            for job_id in list(active):
+                requests = self._jobs[job_id]
+                request = next((r for r in requests if r.key == key), None)
+                if request is None:
+                    active.remove(job_id)
+                    continue
+                n = min(quantum, len(request.inputs) - request.offset, self.max_batch_size - size)
+                parts.append((request, request.offset, n))
+                request.offset += n
+                size += n
+                if request.offset == len(request.inputs):
+                    requests.remove(request)
+                    if not requests:
+                        del self._jobs[job_id]
+                        active.remove(job_id)
+                if size >= self.max_batch_size:
+                    break
+
+    # Fail the requests with error and drop any parts of them that are still queued
+    def _fail(self, failed, error):
+        with self._condition:
+            for request in failed:
+                requests = self._jobs.get(request.job_id)
+                if requests is not None and request in requests:
+                    requests.remove(request)
+                    if not requests:
+                        del self._jobs[request.job_id]
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+    def _run(self):
+        while True:
+            oldest = None
+            parts = []
+            try:
+                with self._condition:
+                    while not self._jobs and not self._closed:
+                        self._condition.wait()
+                    if not self._jobs:
+                        return
+                    oldest = min((requests[0] for requests in self._jobs.values()), key=lambda r: r.enqueued)
+                    # Wait for a full batch, but no longer than the oldest request's deadline
+                    deadline = oldest.enqueued + self.max_latency
+                    while not self._closed and self._pending(oldest.key) < self.max_batch_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    self._take_batch(oldest.key, parts)
+                    model = self.models[oldest.model_name]
+                    self._batches += 1
+                    self._samples += sum(n for _, _, n in parts)
+                batch = np.concatenate([request.inputs[offset:offset + n] for request, offset, n in parts])
+                probs = np.asarray(model(batch, training=False), dtype=np.float32).reshape(-1)
+                position = 0
+                for request, offset, n in parts:
+                    request.probs[offset:offset + n] = probs[position:position + n]
+                    position += n
+                    request.completed += n
+                    if request.completed == len(request.inputs) and not request.future.done():
+                        request.future.set_result(request.probs.reshape(-1, 1))
+            except Exception as e:
+                # Any error, in the model or in building the batch, fails the batch's requests rather than
+                # the worker, so the clients waiting on them get the error and later batches still run
+                failed = [request for request, _, _ in parts]
+                if oldest is not None:
+                    failed.append(oldest)
+                self._fail(dict.fromkeys(failed), e)
@@ -0,0 +1,232 @@
+"""
+Disk-backed store of a recording's decoded audio and derived features.
+
+Each recording gets a directory named after its content hash under DEFAULT_STORE_DIR.
+The decoded waveform and every feature array are written there once as .npy files and
+reopened read-only with np.load(mmap_mode='r'), so a session only holds memory-mapped
+handles. The operating system pages the data in when a view reads it and can evict it
+again. Sessions working on the same recording share one copy in the page cache.
+
+The waveform is decoded and resampled block by block (stream_audio_blocks). The large
+features (STFT dB, mel power, MFCC, RMS, ZCR) are computed block by block straight
+into np.lib.format.open_memmap files. Their values equal the in-memory functions in
+capuchin.analysis: frames are independent, and the global references of the dB
+conversions are applied in a second pass over the file. Other features (tempo, HPSS)
+are computed in memory from the memory-mapped waveform and then stored.
+
+Stores not used for STORE_RETENTION_SECONDS are deleted by prune_stores.
+"""
+import contextlib
+import os
+import shutil
+import time
+
+import numpy as np
+import librosa
+import scipy.fft
+
+from capuchin.analysis import FEATURES
+from capuchin.cache import DEFAULT_CACHE_DIR
+from capuchin.detection import RESAMPLE_TYPE, stream_audio_blocks
+
+DEFAULT_STORE_DIR = os.path.join(DEFAULT_CACHE_DIR, "features")
+# Sample rate of the analysis waveform (librosa.load's default)
+ANALYSIS_SR = 22050
+STORE_RETENTION_SECONDS = 24 * 3600
+# Frames per block of the blockwise feature computations
+BLOCK_FRAMES = 8192
+
+
+class FeatureStore:
+    """.npy files of one recording (see the module docstring), opened as read-only memory maps."""
+    def __init__(self, audio_hash, root=DEFAULT_STORE_DIR):
+        self.audio_hash = audio_hash
+        self.path = os.path.join(root, audio_hash)
+        os.makedirs(self.path, exist_ok=True)
+        # The directory time marks the store as in use for prune_stores
+        os.utime(self.path)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def __contains__(self, name):
+        return os.path.exists(self._file(name))
+
+    def get(self, name):
+        return np.load(self._file(name), mmap_mode='r')
+
+    # Writable .npy memory map that becomes visible under name only once the block completes
+    @contextlib.contextmanager
+    def writing(self, name, shape, dtype=np.float32):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self._file(name)}.{os.getpid()}.{id(self)}.tmp"
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+        try:
+            yield array
+            array.flush()
+            del array
+            os.replace(tmp_path, self._file(name))
+        except BaseException:
+            del array
+            os.remove(tmp_path)
+            raise
+
+    def put(self, name, value):
+        value = np.asarray(value)
+        with self.writing(name, value.shape, value.dtype) as array:
+            array[...] = value
+        return self.get(name)
+
+    # Memory-mapped mono waveform at sr, decoded into the store on first use
+    def waveform(self, audio_path, sr=ANALYSIS_SR, res_type=RESAMPLE_TYPE):
+        if 'waveform' not in self:
+            write_waveform(self, audio_path, sr, res_type)
+        return self.get('waveform')
+
+    # Entries for a feature (and those computed alongside it), computed into the store on first use
+    def feature(self, name, y, sr):
+        names = [other for other, compute in FEATURES.items() if compute is FEATURES[name]]
+        if not all(other in self for other in names):
+            if name in BLOCKWISE_FEATURES:
+                BLOCKWISE_FEATURES[name](self, y, sr)
+            else:
+                for other, value in FEATURES[name](y, sr).items():
+                    self.put(other, value)
+        entries = {}
+        for other in names:
+            value = self.get(other)
+            entries[other] = float(value) if value.ndim == 0 else value
+        return entries
+
+
+# Delete stores that have not been used for max_age seconds
+def prune_stores(root=DEFAULT_STORE_DIR, max_age=STORE_RETENTION_SECONDS):
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# Decode a recording block by block into the store's 'waveform' array
+def write_waveform(store, audio_path, sr=ANALYSIS_SR, res_type=RESAMPLE_TYPE):
+    """
+    The resampled blocks are appended to a raw float32 file, which is then copied into
+    the .npy array once its length is known, so memory use does not depend on the
+    recording length. Formats soundfile cannot read are decoded with librosa.load.
+    """
+    raw_path = os.path.join(store.path, f"waveform.{os.getpid()}.raw")
+    try:
+        n_samples = 0
+        with open(raw_path, "wb") as raw:
+            for block in stream_audio_blocks(audio_path, target_sr=sr, res_type=res_type):
+                raw.write(np.ascontiguousarray(block, dtype=np.float32).tobytes())
+                n_samples += len(block)
+    except Exception:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        y, _ = librosa.load(audio_path, sr=sr, res_type=res_type)
+        return store.put('waveform', y.astype(np.float32))
+    try:
+        decoded = np.memmap(raw_path, dtype=np.float32, mode='r', shape=(n_samples,)) if n_samples else np.zeros(0)
+        with store.writing('waveform', (n_samples,)) as waveform:
+            for start in range(0, n_samples, BLOCK_FRAMES * 512):
+                waveform[start:start + BLOCK_FRAMES * 512] = decoded[start:start + BLOCK_FRAMES * 512]
+        del decoded
+    finally:
+        os.remove(raw_path)
+    return store.get('waveform')
+
+
+# Samples start:stop of y padded with pad samples on both sides ('constant' zeros or 'edge' values)
+def _padded_slice(y, start, stop, pad, mode='constant'):
+    first, last = start - pad, stop - pad
+    segment = np.asarray(y[max(first, 0):min(last, len(y))], dtype=np.float32)
+    before, after = max(0, -first), max(0, last - len(y))
+    if before or after:
+        segment = np.pad(segment, (before, after), mode=mode)
+    return segment
+
+
+# Frames of y (centred like librosa's center=True), block_frames at a time: yields (first frame, frames)
+def _frame_blocks(y, frame_length, hop_length, pad_mode='constant', block_frames=BLOCK_FRAMES):
+    n_frames = 1 + len(y) // hop_length
+    for first in range(0, n_frames, block_frames):
+        last = min(first + block_frames, n_frames)
+        segment = _padded_slice(y, first * hop_length, (last - 1) * hop_length + frame_length,
+                                frame_length // 2, pad_mode)
+        frames = np.lib.stride_tricks.sliding_window_view(segment, frame_length)[::hop_length]
+        yield first, frames[:last - first]
+
+
+# |STFT| of y (centred like librosa.stft), block_frames frames at a time: yields (first frame, magnitude)
+def _stft_magnitude_blocks(y, n_fft=2048, hop_length=512, block_frames=BLOCK_FRAMES):
+    n_frames = 1 + len(y) // hop_length
+    for first in range(0, n_frames, block_frames):
+        last = min(first + block_frames, n_frames)
+        segment = _padded_slice(y, first * hop_length, (last - 1) * hop_length + n_fft, n_fft // 2)
+        yield first, np.abs(librosa.stft(segment, n_fft=n_fft, hop_length=hop_length, center=False))
+
+
+# STFT in dB relative to the loudest bin (analysis.compute_spectrogram)
+def write_spectrogram(store, y, sr, n_fft=2048, hop_length=512, amin=1e-5, top_db=80.0):
+    shape = (1 + n_fft // 2, 1 + len(y) // hop_length)
+    with store.writing('spectrogram', shape) as spectrogram:
+        peak = 0.0
+        for first, magnitude in _stft_magnitude_blocks(y, n_fft, hop_length):
+            spectrogram[:, first:first + magnitude.shape[1]] = magnitude
+            peak = max(peak, float(magnitude.max(initial=0.0)))
+        floor_db = -top_db
+        reference_db = 20.0 * np.log10(max(amin, peak))
+        for first in range(0, shape[1], BLOCK_FRAMES):
+            block = spectrogram[:, first:first + BLOCK_FRAMES]
+            block_db = 20.0 * np.log10(np.maximum(amin, block)) - reference_db
+            spectrogram[:, first:first + BLOCK_FRAMES] = np.maximum(block_db, floor_db)
+
+
+# Mel power spectrogram (analysis.compute_mel)
+def write_mel(store, y, sr, n_mels=128, n_fft=2048, hop_length=512):
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+    with store.writing('mel', (n_mels, 1 + len(y) // hop_length)) as mel:
+        for first, magnitude in _stft_magnitude_blocks(y, n_fft, hop_length):
+            mel[:, first:first + magnitude.shape[1]] = mel_basis @ magnitude ** 2
+
+
+# MFCCs from the stored mel power spectrogram (analysis.compute_mfccs)
+def write_mfccs(store, y, sr, n_mfcc=13, amin=1e-10, top_db=80.0):
+    if 'mel' not in store:
+        write_mel(store, y, sr)
+    mel = store.get('mel')
+    max_db = max(10.0 * np.log10(max(amin, float(mel[:, first:first + BLOCK_FRAMES].max(initial=0.0))))
+                 for first in range(0, mel.shape[1], BLOCK_FRAMES))
+    with store.writing('mfccs', (n_mfcc, mel.shape[1])) as mfccs:
+        for first in range(0, mel.shape[1], BLOCK_FRAMES):
+            mel_db = np.maximum(10.0 * np.log10(np.maximum(amin, mel[:, first:first + BLOCK_FRAMES])), max_db - top_db)
+            mfccs[:, first:first + BLOCK_FRAMES] = scipy.fft.dct(mel_db, axis=0, type=2, norm='ortho')[:n_mfcc]
+
+
+# Frame RMS energy (analysis.compute_rms)
+def write_rms(store, y, sr, frame_length=2048, hop_length=512):
+    with store.writing('rms', (1 + len(y) // hop_length,)) as rms:
+        for first, frames in _frame_blocks(y, frame_length, hop_length):
+            rms[first:first + len(frames)] = np.sqrt(np.mean(np.abs(frames) ** 2, axis=1))
+
+
+# Frame zero crossing rate (analysis.compute_zcr); samples within threshold of zero count as positive
+def write_zcr(store, y, sr, frame_length=2048, hop_length=512, threshold=1e-10):
+    with store.writing('zcr', (1 + len(y) // hop_length,)) as zcr:
+        for first, frames in _frame_blocks(y, frame_length, hop_length, pad_mode='edge'):
+            negative = frames < -threshold
+            zcr[first:first + len(frames)] = np.sum(negative[:, 1:] != negative[:, :-1], axis=1) / frame_length
+
+
+# Features computed block by block into the store; the others go through analysis.FEATURES
+BLOCKWISE_FEATURES = {
+    'spectrogram': write_spectrogram,
+    'mel': write_mel,
+    'mfccs': write_mfccs,
+    'rms': write_rms,
+    'zcr': write_zcr,
+}
@@ -1,17 +1,137 @@
 # pages/2_Audio_Results.py
+import json
+
 import streamlit as st
 import numpy as np
 import pandas as pd
-import librosa
-import librosa.display
 import matplotlib.pyplot as plt
 
+from capuchin.app_resources import get_job_queue
+from capuchin.detection import THRESHOLD_STAGE2
+from capuchin.jobs import apply_job_result
+from capuchin.rendering import SpectrogramPyramid, plot_envelope
+
+# Hop length of the STFT-based features in capuchin.analysis (librosa's default)
+HOP_LENGTH = 512
+
 st.set_page_config(page_title="Audio Analysis Results", page_icon="📊")
 st.title("Audio Analysis Results")
 st.sidebar.header("Results Options")
 
+# Background detection jobs started on the Upload page
+job_queue = get_job_queue()
+if "detection_job_id" not in st.session_state and "job" in st.query_params:
+    st.session_state.detection_job_id = st.query_params["job"]
+detection_job = None
+if "detection_job_id" in st.session_state:
+    st.query_params["job"] = st.session_state.detection_job_id
+    detection_job = job_queue.get(st.session_state.detection_job_id)
+# Pick up a detection that finished since the results were last shown
+if (detection_job is not None and detection_job['status'] == 'done'
+        and st.session_state.get("applied_job_id") != detection_job['id']):
+    apply_job_result(st.session_state, detection_job)
+detection_running = detection_job is not None and detection_job['status'] in ('queued', 'running')
+
+# Table, timeline and CSV download of detected calls; a running detection passes the time
+# processed so far, and the rest of the timeline is greyed out
+def show_call_detections(call_timestamps, duration, filename, processed_until=None):
+    st.subheader("Detected Call Timestamps")
+
+    # Create a dataframe of call timestamps
+    call_data = []
+    for i, call in enumerate(call_timestamps):
+        call_data.append({
+            "Call #": i + 1,
+            "Start Time (s)": f"{call['start_time']:.2f}",
+            "End Time (s)": f"{call['end_time']:.2f}",
+            "Duration (s)": f"{call['end_time'] - call['start_time']:.2f}",
+            "Confidence": f"{call['confidence']:.2%}"
+        })
+
+    # Display as a table
+    st.dataframe(pd.DataFrame(call_data))
+
+    # Visualize calls on the audio timeline
+    st.subheader("Call Visualization")
+    fig, ax = plt.subplots(figsize=(10, 3))
+
+    # Draw timeline
+    ax.plot([0, duration], [0, 0], 'k-', linewidth=2)
+    if processed_until is not None and processed_until < duration:
+        ax.axvspan(processed_until, duration, alpha=0.15, color='grey')
+
+    # Mark call locations
+    for call in call_timestamps:
+        # Draw a vertical line at the middle of each call
+        ax.plot([call['mid_time'], call['mid_time']], [-0.1, 0.1], 'r-', linewidth=2)
+        # Draw the call window
+        ax.axvspan(call['start_time'], call['end_time'], alpha=0.3, color='orange')
+
+    # Add labels and styling
+    ax.set_xlabel('Time (seconds)')
+    ax.set_title('Capuchin Call Locations')
+    ax.set_yticks([])
+    ax.set_xlim(0, duration)
+    ax.grid(axis='x', linestyle='--', alpha=0.7)
+
+    st.pyplot(fig)
+    plt.close(fig)
+
+    # Add download button for call data once the detection is complete
+    if processed_until is None:
+        csv = pd.DataFrame(call_data).to_csv(index=False)
+        st.download_button(
+            label="Download Call Data (CSV)",
+            data=csv,
+            file_name=f"capuchin_calls_{filename.split('.')[0]}.csv",
+            mime="text/csv"
+        )
+
+# Collapsible per-stage timings and counters of the detection, with a JSON export
+def show_instrumentation(instrumentation, filename):
+    with st.expander("Detection Timing"):
+        timings = instrumentation['timings']
+        total = instrumentation.get('total_seconds')
+        if total:
+            st.write(f"**Total detection time:** {total:.2f} seconds")
+        st.dataframe(pd.DataFrame({
+            "Stage": list(timings),
+            "Seconds": [f"{seconds:.3f}" for seconds in timings.values()],
+            "Share": [f"{seconds / total:.1%}" if total else "" for seconds in timings.values()],
+        }), hide_index=True)
+        st.dataframe(pd.DataFrame({"Counter": list(instrumentation['counters']),
+                                   "Value": list(instrumentation['counters'].values())}), hide_index=True)
+        if instrumentation.get('profile'):
+            st.code(instrumentation['profile'], language=None)
+        st.download_button(
+            label="Download Timing Data (JSON)",
+            data=json.dumps(instrumentation, indent=2),
+            file_name=f"capuchin_timing_{filename.split('.')[0]}.json",
+            mime="application/json"
+        )
+
+# Progress and calls found so far of the running detection, polled every second; the page
+# reruns when it finishes
+def show_job_progress():
+    job = job_queue.get(st.session_state.detection_job_id)
+    if job is None or job['status'] not in ('queued', 'running'):
+        st.rerun()
+    total = job['windows_total'] or 0
+    st.progress(job['windows_done'] / total if total else 0.0,
+                text=f"Counting capuchin calls in {job['filename']}: "
+                     f"{job['windows_done']} of {total or '?'} windows processed")
+    st.write(f"**Capuchin calls found so far:** {len(job['detections'])}")
+    if job['detections']:
+        results = st.session_state.get("analysis_results")
+        duration = results['duration'] if results is not None else job['duration']
+        show_call_detections(job['detections'], duration, job['filename'],
+                             processed_until=duration * job['windows_done'] / total)
+
 if st.session_state.get("analysis_results") is None:
-    st.warning("No audio analysis results found. Please upload and process an audio file first.")
+    if detection_running:
+        st.fragment(show_job_progress, run_every=1.0)()
+    else:
+        st.warning("No audio analysis results found. Please upload and process an audio file first.")
 else:
     results = st.session_state.analysis_results
 
@@ -23,6 +143,10 @@ else:
         st.write(f"**Filename:** {results['filename']}")
         st.write(f"**Duration:** {results['duration']:.2f} seconds")
         st.write(f"**Sample Rate:** {results['sample_rate']} Hz")
+        # Tempo needs beat tracking over the whole file, so it is only estimated on request
+        if 'tempo' not in results and st.button("Estimate Tempo"):
+            with st.spinner("Estimating tempo..."):
+                results['tempo']
         if 'tempo' in results and results['tempo'] > 0:
             st.write(f"**Estimated Tempo:** {results['tempo']:.2f} BPM")
         else:
@@ -31,48 +155,72 @@ else:
         st.subheader("Audio Visualization")
         visualization_type = st.sidebar.selectbox(
             "Select Visualization",
-            ["Spectrogram", "MFCC", "Energy", "Zero Crossing Rate"],
+            ["Spectrogram", "Waveform", "MFCC", "Energy", "Zero Crossing Rate"],
             key="viz_select_results"
         )
+        sr = results['sample_rate']
+        frame_rate = sr / HOP_LENGTH
+        # Zooming selects a time range; plots are decimated to the figure width at any zoom level.
+        # A slider needs a non-empty range, so an empty recording is shown without one
+        duration = float(results['duration'])
+        if duration > 0:
+            time_range = st.slider(
+                "Time Range (seconds)",
+                min_value=0.0,
+                max_value=duration,
+                value=(0.0, duration),
+                key="viz_time_range"
+            )
+        else:
+            time_range = (0.0, 0.0)
 
+        # Each feature is computed the first time its view is opened, then reused
         if visualization_type == "Spectrogram":
+            with st.spinner("Computing spectrogram..."):
+                if 'spectrogram_pyramid' not in results:
+                    results['spectrogram_pyramid'] = SpectrogramPyramid(results['spectrogram'], hop_length=HOP_LENGTH,
+                                                                     store=results.store, name='spectrogram')
             fig, ax = plt.subplots(figsize=(10, 4))
-            img = librosa.display.specshow(
-                results['spectrogram'],
-                x_axis='time',
-                y_axis='log',
-                sr=results['sample_rate'],
-                ax=ax
-            )
+            img = results['spectrogram_pyramid'].specshow(ax, sr, time_range, y_axis='log')
             ax.set_title("Spectrogram")
             fig.colorbar(img, ax=ax, format="%+2.0f dB")
             st.pyplot(fig)
             st.write("The spectrogram shows frequency content over time.")
+        elif visualization_type == "Waveform":
+            fig, ax = plt.subplots(figsize=(10, 4))
+            plot_envelope(ax, results['waveform'], sr, time_range)
+            ax.set_title("Audio Waveform")
+            ax.set_xlabel("Time (seconds)")
+            ax.set_ylabel("Amplitude")
+            ax.grid(alpha=0.3)
+            st.pyplot(fig)
+            st.write("The waveform shows the amplitude of the signal over time.")
         elif visualization_type == "MFCC":
+            with st.spinner("Computing MFCCs..."):
+                if 'mfcc_pyramid' not in results:
+                    results['mfcc_pyramid'] = SpectrogramPyramid(results['mfccs'], hop_length=HOP_LENGTH,
+                                                               store=results.store, name='mfccs')
             fig, ax = plt.subplots(figsize=(10, 4))
-            img = librosa.display.specshow(
-                results['mfccs'],
-                x_axis='time',
-                sr=results['sample_rate'],
-                ax=ax
-            )
+            img = results['mfcc_pyramid'].specshow(ax, sr, time_range)
             ax.set_title("MFCC")
             fig.colorbar(img, ax=ax)
             st.pyplot(fig)
             st.write("MFCC features capture the spectral properties used for audio analysis.")
         elif visualization_type == "Energy":
+            with st.spinner("Computing RMS energy..."):
+                rms = results['rms']
             fig, ax = plt.subplots(figsize=(10, 4))
-            times = librosa.times_like(results['rms'], sr=results['sample_rate'])
-            ax.plot(times, results['rms'])
+            plot_envelope(ax, rms, frame_rate, time_range)
             ax.set_title("RMS Energy")
             ax.set_xlabel("Time (s)")
             ax.set_ylabel("Energy")
             st.pyplot(fig)
             st.write("RMS Energy indicates how loud the audio signal is over time.")
         elif visualization_type == "Zero Crossing Rate":
+            with st.spinner("Computing zero crossing rate..."):
+                zcr = results['zcr']
             fig, ax = plt.subplots(figsize=(10, 4))
-            times = librosa.times_like(results['zcr'], sr=results['sample_rate'])
-            ax.plot(times, results['zcr'])
+            plot_envelope(ax, zcr, frame_rate, time_range)
             ax.set_title("Zero Crossing Rate")
             ax.set_xlabel("Time (s)")
             ax.set_ylabel("ZCR")
@@ -81,88 +229,52 @@ else:
 
         st.subheader("Audio Segments Analysis")
         segment_length = st.slider("Segment Length (seconds)", min_value=1, max_value=10, value=3, key="seg_slider")
-        samples_per_segment = segment_length * results['sample_rate']
-        num_segments = int(len(results['waveform']) / samples_per_segment)
+        # Computed for all segments at once and cached per segment length
+        with st.spinner("Computing segment statistics..."):
+            segment_rms, segment_zcr = results.segment_stats(segment_length)
+        num_segments = len(segment_rms)
 
         if num_segments > 0:
-            segment_data = []
-            for i in range(num_segments):
-                start_sample = int(i * samples_per_segment)
-                end_sample = int(min(start_sample + samples_per_segment, len(results['waveform'])))
-                segment = results['waveform'][start_sample:end_sample]
-                try:
-                    segment_rms = float(np.mean(librosa.feature.rms(y=segment)[0]))
-                    segment_zcr = float(np.mean(librosa.feature.zero_crossing_rate(y=segment)[0]))
-                except Exception:
-                    segment_rms = 0.0
-                    segment_zcr = 0.0
-                segment_data.append({
-                    "Segment": i + 1,
-                    "Time (s)": f"{i * segment_length:.1f} - {min((i + 1) * segment_length, results['duration']):.1f}",
-                    "Energy": f"{segment_rms:.4f}",
-                    "ZCR": f"{segment_zcr:.4f}"
-                })
-            st.dataframe(pd.DataFrame(segment_data))
+            segment_starts = np.arange(num_segments) * segment_length
+            segment_ends = np.minimum(segment_starts + segment_length, results['duration'])
+            st.dataframe(pd.DataFrame({
+                "Segment": np.arange(1, num_segments + 1),
+                "Time (s)": [f"{start:.1f} - {end:.1f}" for start, end in zip(segment_starts, segment_ends)],
+                "Energy": [f"{value:.4f}" for value in segment_rms],
+                "ZCR": [f"{value:.4f}" for value in segment_zcr]
+            }))
         else:
             st.info("Audio is too short to segment with the current settings.")
 
     with tab2:
         st.subheader("Capuchin Call Detection Results")
-        if 'capuchin_calls' in results:
+        if detection_running:
+            st.fragment(show_job_progress, run_every=1.0)()
+        elif 'capuchin_calls' in results:
             st.write(f"**Capuchin Call Count:** {results['capuchin_calls']}")
             
             # If we have call timestamps, display them
             if 'call_timestamps' in results and results['call_timestamps']:
-                st.subheader("Detected Call Timestamps")
-                
-                # Create a dataframe of call timestamps
-                call_data = []
-                for i, call in enumerate(results['call_timestamps']):
-                    call_data.append({
-                        "Call #": i + 1,
-                        "Start Time (s)": f"{call['start_time']:.2f}",
-                        "End Time (s)": f"{call['end_time']:.2f}",
-                        "Duration (s)": f"{call['end_time'] - call['start_time']:.2f}",
-                        "Confidence": f"{call['confidence']:.2%}"
-                    })
-                
-                # Display as a table
-                st.dataframe(pd.DataFrame(call_data))
-                
-                # Visualize calls on the audio timeline
-                if call_data:
-                    st.subheader("Call Visualization")
-                    fig, ax = plt.subplots(figsize=(10, 3))
-                    
-                    # Draw timeline
-                    ax.plot([0, results['duration']], [0, 0], 'k-', linewidth=2)
-                    
-                    # Mark call locations
-                    for call in results['call_timestamps']:
-                        # Draw a vertical line at the middle of each call
-                        ax.plot([call['mid_time'], call['mid_time']], [-0.1, 0.1], 'r-', linewidth=2)
-                        # Draw the call window
-                        ax.axvspan(call['start_time'], call['end_time'], alpha=0.3, color='orange')
-                    
-                    # Add labels and styling
-                    ax.set_xlabel('Time (seconds)')
-                    ax.set_title('Capuchin Call Locations')
-                    ax.set_yticks([])
-                    ax.set_xlim(0, results['duration'])
-                    ax.grid(axis='x', linestyle='--', alpha=0.7)
-                    
-                    st.pyplot(fig)
-                    
-                    # Add download button for call data
-                    csv = pd.DataFrame(call_data).to_csv(index=False)
-                    st.download_button(
-                        label="Download Call Data (CSV)",
-                        data=csv,
-                        file_name=f"capuchin_calls_{results['filename'].split('.')[0]}.csv",
-                        mime="text/csv"
-                    )
+                show_call_detections(results['call_timestamps'], results['duration'], results['filename'])
             else:
                 st.info("No detailed call timing information available.")
+
+            # Detections with overlapping windows keep the Stage-2 probability track behind the events
+            if results.get('probability_track') is not None:
+                st.subheader("Call Probability")
+                track = np.asarray(results['probability_track'])
+                fig, ax = plt.subplots(figsize=(10, 3))
+                ax.plot(np.arange(len(track)) * results['track_hop'], track, linewidth=1)
+                ax.axhline(THRESHOLD_STAGE2, color='r', linestyle='--', linewidth=1)
+                ax.set_xlabel('Time (seconds)')
+                ax.set_ylabel('Probability')
+                ax.set_xlim(0, results['duration'])
+                ax.set_ylim(0, 1)
+                st.pyplot(fig)
+                plt.close(fig)
+
+            if results.get('instrumentation') is not None:
+                show_instrumentation(results['instrumentation'], results['filename'])
         else:
             st.write("**Capuchin Call Count:** Not available")
             st.info("Run the Capuchin call detection on the Upload Audio page to see results here.")
@@ -3,15 +3,12 @@ import streamlit as st
 import time
 import os
 from dotenv import load_dotenv
-import gc
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.embeddings import SentenceTransformerEmbeddings
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
+from capuchin.knowledge import KNOWLEDGE_DIR, load_embeddings, open_index, sync_index
 
 # Load environment variables
 load_dotenv()
@@ -39,38 +36,30 @@ api_key = os.getenv("GROQ_API_KEY")
 if not api_key:
     st.error("GROQ_API_KEY not found in environment variables. Please set it up.")
 
-def load_documents():
+# Embedding model shared by all sessions
+@st.cache_resource
+def get_embeddings():
+    return load_embeddings()
+
+# Persistent knowledge index shared by all sessions; brought up to date with the docs folder once per process
+@st.cache_resource
+def get_knowledge_index():
+    vectorstore = open_index(get_embeddings())
+    sync_index(vectorstore)
+    return vectorstore
+
+def load_documents(reload=False):
     with st.spinner("Loading knowledge base..."):
-        st.session_state.loading_status = "Loading documents"
-        knowledge_dir = "docs"
-        documents = []
-        
-        if os.path.exists(knowledge_dir):
-            for file in os.listdir(knowledge_dir):
-                file_path = os.path.join(knowledge_dir, file)
-                if file.lower().endswith('.pdf'):
-                    loader = PyPDFLoader(file_path)
-                    loaded_docs = loader.load()
-                    documents.extend(loaded_docs)
-                elif file.lower().endswith('.txt'):
-                    loader = TextLoader(file_path)
-                    loaded_docs = loader.load()
-                    documents.extend(loaded_docs)
-        else:
-            st.error(f"Knowledge directory '{knowledge_dir}' not found. Please ensure it exists with PDF files.")
+        if not os.path.exists(KNOWLEDGE_DIR):
+            st.error(f"Knowledge directory '{KNOWLEDGE_DIR}' not found. Please ensure it exists with PDF files.")
             return False
 
-        st.session_state.loading_status = "Splitting text"
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        splits = text_splitter.split_documents(documents)
-        
-        st.session_state.loading_status = "Creating embeddings"
-        embedding_function = SentenceTransformerEmbeddings(model_name="all-MiniLM-L6-v2")
-        vectorstore = Chroma.from_documents(
-            documents=splits,
-            embedding=embedding_function,
-            persist_directory="./temp_chroma_db"
-        )
+        st.session_state.loading_status = "Loading knowledge index"
+        vectorstore = get_knowledge_index()
+        if reload:
+            # Only new and changed files are embedded again
+            st.session_state.loading_status = "Updating knowledge index"
+            sync_index(vectorstore)
         st.session_state.retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
         
         st.session_state.loading_status = "Setting up RAG chain"
@@ -93,7 +82,6 @@ def load_documents():
         
         st.session_state.documents_loaded = True
         st.session_state.loading_status = None
-        gc.collect()
         return True
 
 def generate_response(query):
@@ -130,7 +118,7 @@ if st.sidebar.button("Load Knowledge Base") and not st.session_state.documents_l
 
 if st.sidebar.button("Reload Knowledge Base"):
     st.session_state.documents_loaded = False
-    load_documents()
+    load_documents(reload=True)
 
 if st.sidebar.button("Clear Chat History"):
     st.session_state.chat_history = []
@@ -1,23 +1,25 @@
 import streamlit as st
 import numpy as np
-import librosa
-import librosa.display
 import matplotlib.pyplot as plt
-import tempfile
 import os
 import time
 import random
-import tensorflow as tf
+import uuid
 
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Input
-from tensorflow.keras.applications import EfficientNetB0
+from capuchin.analysis import LazyAnalysis
+from capuchin.app_resources import get_job_queue, get_result_cache
+from capuchin.backends import EXPORT_PATHS, backend_model_file, get_warm_model, start_model_warmup
+from capuchin.cache import detection_cache_key, hash_bytes
+from capuchin.detection import EVENT_WINDOW_HOP, GATE_THRESHOLD_DB, RESAMPLE_TYPE, RESAMPLE_TYPES
+from capuchin.jobs import apply_job_result, detection_entries
+from capuchin.rendering import plot_envelope
+from capuchin.server import InferenceServer
+from capuchin.store import ANALYSIS_SR, DEFAULT_STORE_DIR, FeatureStore, prune_stores
 
 seed_value = 42
 os.environ['PYTHONHASHSEED']=str(seed_value)
 random.seed(seed_value)
 np.random.seed(seed_value)
-tf.random.set_seed(seed_value)
 
 # Set page configuration and title
 st.set_page_config(page_title="Upload Audio", page_icon="🎤")
@@ -28,145 +30,155 @@ st.sidebar.header("Audio Upload Options")
 st.sidebar.subheader("Upload Your Audio File")
 uploaded_file = st.sidebar.file_uploader("Choose an audio file", type=["wav", "mp3", "ogg", "flac"])
 
-# Global constants for capuchin detection
-TARGET_SR = 16000
-THRESHOLD_STAGE1 = 0.5
-THRESHOLD_STAGE2 = 0.6
-WINDOW_DURATION_OUTER = 6.0
-STEP_DURATION_INNER = 0.3
-OVERLAP_INNER = 0.0
+st.sidebar.subheader("Detection Options")
+use_spectrogram_cache = st.sidebar.checkbox(
+    "Fast feature extraction",
+    value=False,
+    help="Compute the mel spectrogram of the whole file once and slice detector inputs from it. "
+         "Faster on long recordings, with small differences at window edges."
+)
+resample_type = st.sidebar.selectbox(
+    "Resampling quality",
+    RESAMPLE_TYPES,
+    index=RESAMPLE_TYPES.index(RESAMPLE_TYPE),
+    help="Resampler used to convert the recording to 16 kHz. Files already at 16 kHz are not resampled. "
+         "The soxr resamplers are much faster than the default kaiser_best, but have not yet been "
+         "validated against labelled recordings."
+)
+use_streaming = st.sidebar.checkbox(
+    "Low-memory streaming",
+    value=False,
+    help="Decode and resample the file block by block during detection instead of loading it whole. "
+         "Recommended for very long recordings. Formats soundfile cannot read are still loaded whole."
+)
+# Exported TFLite/ONNX models are offered when they exist (see python -m capuchin.backends)
+inference_backend = st.sidebar.selectbox(
+    "Inference backend",
+    ['keras'] + [backend for backend, path in EXPORT_PATHS.items() if os.path.exists(path)],
+    help="Run the classifier in TensorFlow (keras) or in a lighter runtime with an exported, "
+         "possibly quantized, copy of the model."
+)
+use_gate = st.sidebar.checkbox(
+    "Skip quiet windows",
+    value=False,
+    help="Skip 6-second windows with too little energy in the capuchin call band before running the model. "
+         "Much faster on recordings that are mostly silent."
+)
+gate_threshold = None
+if use_gate:
+    gate_threshold = st.sidebar.number_input(
+        "Quiet window threshold (dBFS)",
+        value=GATE_THRESHOLD_DB,
+        step=2.5,
+        help="Windows whose loudest 0.1 s in the call band stays below this level are skipped. "
+             "Calibrate it on labelled recordings with benchmarks/calibrate_gate.py."
+    )
+use_events = st.sidebar.checkbox(
+    "Count individual calls",
+    value=False,
+    disabled=use_streaming,
+    help=f"Scan with 6-second windows overlapping every {EVENT_WINDOW_HOP:g} seconds and count separate call "
+         "events with their start and end, instead of 6-second windows containing a call. "
+         "Not available with low-memory streaming."
+)
+window_hop_outer = EVENT_WINDOW_HOP if use_events and not use_streaming else None
+use_adaptive_search = st.sidebar.checkbox(
+    "Adaptive call search",
+    value=False,
+    help="Stop scoring a window's 0.3-second chunks at the first call and, when counting individual calls, "
+         "score chunks coarse-to-fine around likely calls only. Faster on busy recordings; very short "
+         "individual calls can be missed."
+)
 
-# Function to extract mel spectrogram
-def extract_mel_spectrogram(audio_path=None,target_sr=TARGET_SR, y=None, sr=None, n_mels=128, n_fft=2048, hop_length=512, target_time_frames=None):
-    if y is None or sr is None:
-        try:
-            y, sr = librosa.load(audio_path, sr=target_sr, res_type='kaiser_best')
-        except Exception as e:
-            st.error(f"Error loading audio file: {audio_path}, {e}")
-            return None
-    mel_spec = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=n_mels, n_fft=n_fft, hop_length=hop_length)
-    mel_spec_db = librosa.power_to_db(mel_spec, ref=np.max)
-    if target_time_frames is not None:
-        mel_spec_db = librosa.util.fix_length(mel_spec_db, size=target_time_frames, axis=1)
-    return mel_spec_db
-
-# Updated two-stage sliding window function for capuchin call detection
-def count_capuchin_calls_two_stage_sliding_window(long_audio_path, model=None,
-                                                  threshold_stage1=THRESHOLD_STAGE1, threshold_stage2=THRESHOLD_STAGE2,
-                                                  window_duration_outer=WINDOW_DURATION_OUTER,
-                                                  step_duration_inner=STEP_DURATION_INNER,
-                                                  overlap_inner=OVERLAP_INNER):
-    """
-    Counts capuchin calls using a two-stage sliding window approach (LATEST VERSION).
-    """
-    if model is None:
-        print("Model is not provided. Please load your trained model.")
-        return None
-
-    try:
-        y_long, sr_long = librosa.load(long_audio_path, sr=TARGET_SR, res_type='kaiser_best')
-    except Exception as e:
-        print(f"Error loading long audio file: {long_audio_path}, {e}")
-        return None
-        
-    log_msgs = []
-    def log(msg):
-        log_msgs.append(msg)
-    window_samples_outer = int(window_duration_outer * sr_long)
-    step_samples_inner = int(step_duration_inner * sr_long)
-    hop_samples_inner = int(step_samples_inner * (1 - overlap_inner))
-    total_duration_seconds = librosa.get_duration(y=y_long, sr=sr_long)
-
-    capuchin_call_count = 0
-    outer_window_start_time = 0.0
-    
-    # Store timestamps of detected calls
-    call_timestamps = []
-
-    print(f"Processing audio file (Two-Stage Sliding Window - LATEST): {os.path.basename(long_audio_path)}")
-    print(f"Total duration: {total_duration_seconds:.2f} seconds")
+# Load the capuchin model once per backend; it is loaded and warmed up in the background
+# from app start (Keras) or from when the backend is selected here
+@st.cache_resource
+def load_capuchin_model(backend='keras'):
+    return get_warm_model(backend)
 
-    outer_start_sample = 0
-    while outer_window_start_time < total_duration_seconds:
-        outer_end_sample = outer_start_sample + window_samples_outer
-        if outer_end_sample > len(y_long):
-            outer_end_sample = len(y_long)
-        outer_window_audio = y_long[outer_start_sample:outer_end_sample]
-        outer_window_duration = len(outer_window_audio) / sr_long
-        outer_window_end_time = outer_window_start_time + outer_window_duration
+# TensorFlow is only imported by this background load, so the page renders without waiting for it
+if not start_model_warmup(inference_backend).done():
+    st.sidebar.caption("Loading the detection model in the background...")
 
-        print(f"\nOuter Window: Start Time: {outer_window_start_time:.2f}s, End Time: {outer_window_end_time:.2f}s, Duration: {outer_window_duration:.2f}s")
+# Inference server shared by all sessions: batches the model calls of concurrent detections
+@st.cache_resource
+def get_inference_server():
+    return InferenceServer()
 
-        # Stage 1: Quick Check - Classify Entire 6-second Segment (Option A)
-        mel_spec_outer_window = extract_mel_spectrogram(audio_path=None, y=outer_window_audio, sr=sr_long, target_time_frames=157)
-        stage1_predicted_class = 0  # Default to no call
-        if mel_spec_outer_window is not None:
-            mel_spec_outer_window_rgb = np.stack([mel_spec_outer_window] * 3, axis=-1)
-            mel_spec_outer_window_reshaped = mel_spec_outer_window_rgb[np.newaxis, ...]
-            stage1_prediction = model.predict(mel_spec_outer_window_reshaped, verbose=0)
-            stage1_prediction_prob = stage1_prediction[0][0]
-            stage1_predicted_class = int(stage1_prediction_prob > threshold_stage1)
+# Model handle for this session's detection job, served by the shared inference server
+def get_session_model(backend):
+    server = get_inference_server()
+    if backend not in server.models:
+        server.add_model(backend, load_capuchin_model(backend))
+    if "inference_job_id" not in st.session_state:
+        st.session_state.inference_job_id = uuid.uuid4().hex
+    return server.client(st.session_state.inference_job_id, backend)
 
-        if stage1_predicted_class == 0:  # No Call Indicated by Stage 1
-            print("  Stage 1: No Call Indicated - Skipping Stage 2")
-        else:  # Call Indicated by Stage 1 - Proceed to Stage 2
-            print("  Stage 1: Call Indicated - Proceeding to Stage 2 Inner Loop")
-            has_call_in_window = False
-            inner_start_sample = 0
-            # Stage 2: Detailed Analysis (Inner Loop - 0.2-second Chunks)
-            while inner_start_sample < len(outer_window_audio):
-                inner_end_sample = inner_start_sample + step_samples_inner
-                if inner_end_sample > len(outer_window_audio):
-                    inner_end_sample = len(outer_window_audio)
-                inner_chunk_audio = outer_window_audio[inner_start_sample:inner_end_sample]
-                if len(inner_chunk_audio) < step_samples_inner / 2:
-                    inner_start_sample += hop_samples_inner
-                    continue
-                mel_spec_chunk = extract_mel_spectrogram(audio_path=None, y=inner_chunk_audio, sr=sr_long)
-                if mel_spec_chunk is not None:
-                    mel_spec_chunk_rgb = np.stack([mel_spec_chunk] * 3, axis=-1)
-                    mel_spec_chunk_reshaped = mel_spec_chunk_rgb[np.newaxis, ...]
-                    prediction = model.predict(mel_spec_chunk_reshaped, verbose=0)
-                    prediction_prob_inner = prediction[0][0]
-                    predicted_class_inner = int(prediction_prob_inner > threshold_stage2)
-                    if predicted_class_inner == 1:
-                        has_call_in_window = True
-                inner_start_sample += hop_samples_inner
+# Load on the shared model from other sessions' detections
+server_stats = get_inference_server().stats()
+st.sidebar.caption(f"Inference queue: {server_stats['queue_depth']} windows pending "
+                   f"from {len(server_stats['jobs'])} detection jobs")
 
-            if has_call_in_window:
-                capuchin_call_count += 1
-                # Store the timestamp of this call (midpoint of the window)
-                call_middle_time = outer_window_start_time + (outer_window_duration / 2)
-                call_timestamps.append({
-                    'start_time': outer_window_start_time,
-                    'end_time': outer_window_end_time,
-                    'mid_time': call_middle_time,
-                    'confidence': float(stage1_prediction_prob)
-                })
-                print("  Call Event Detected in Outer Window - Incrementing Call Count")
-            else:
-                print("  Stage 2: No Call Event Detected in Outer Window (Despite Stage 1 Indication)")
-        outer_window_start_time += window_duration_outer
-        outer_start_sample = int(outer_window_start_time * sr_long)
+# Directory of the memory-mapped audio and feature stores; stale stores are pruned once per process
+@st.cache_resource
+def get_feature_store_root():
+    prune_stores(DEFAULT_STORE_DIR)
+    return DEFAULT_STORE_DIR
 
-    print(f"\nTotal Capuchin calls detected (Two-Stage Sliding Window - LATEST) in {os.path.basename(long_audio_path)}: {capuchin_call_count}\n")
-    return capuchin_call_count, call_timestamps
+job_queue = get_job_queue()
+# The job id is kept in the URL so a browser refresh reconnects to a running detection
+if "detection_job_id" not in st.session_state and "job" in st.query_params:
+    st.session_state.detection_job_id = st.query_params["job"]
 
-# Load the capuchin model (cached to load only once)
-@st.cache_resource
-def load_capuchin_model():
-    # MODEL_WEIGHTS_FILE = r'weights\capuchin_bird_classifier.weights.h5'
-    MODEL_WEIGHTS_FILE = 'weights/capuchin_bird_classifier.weights.h5'
-    input_shape = (128, 157, 3)
-    input_tensor = Input(shape=input_shape)
-    base_model = EfficientNetB0(include_top=False, weights=None, input_tensor=input_tensor)
-    x = base_model.output
-    x = GlobalAveragePooling2D()(x)
-    x = Dense(128, activation='relu')(x)
-    output_tensor = Dense(1, activation='sigmoid')(x)
-    model = Model(inputs=input_tensor, outputs=output_tensor)
-    model.load_weights(MODEL_WEIGHTS_FILE)
-    return model
+# Progress of the session's detection job, polled every second while it is queued or running
+def show_detection_job():
+    job = job_queue.get(st.session_state.detection_job_id)
+    if job is None:
+        return
+    if job['status'] in ('queued', 'running'):
+        if job['status'] == 'queued':
+            st.info(f"Detection of {job['filename']} is queued...")
+        else:
+            total = job['windows_total'] or 0
+            st.progress(job['windows_done'] / total if total else 0.0,
+                        text=f"Counting capuchin calls in {job['filename']}: "
+                             f"{job['windows_done']} of {total or '?'} windows processed, "
+                             f"{len(job['detections'])} calls found so far")
+            if job['detections']:
+                st.caption("Calls found so far are shown on the Results page while the detection continues.")
+        if st.button("Cancel detection", key="cancel_detection"):
+            job_queue.cancel(job['id'])
+        return
+    # The job just finished: rerun the whole page once to stop polling
+    if st.session_state.get("polling_job_id") == job['id']:
+        st.session_state.polling_job_id = None
+        st.rerun()
+    if job['status'] == 'done':
+        detection = job['result']
+        if st.session_state.get("applied_job_id") != job['id']:
+            apply_job_result(st.session_state, job)
+        st.success(f"Capuchin call detection finished in {job['updated'] - job['created']:.2f} seconds: "
+                   f"{detection['call_count']} calls in {job['filename']}")
+        load_timings = detection.get('load_timings')
+        if load_timings:
+            st.caption(f"Audio decoding: {load_timings['decode_seconds']:.2f} s | "
+                       f"Resampling ({load_timings['res_type'] or 'not needed'}): "
+                       f"{load_timings['resample_seconds']:.2f} s")
+        if detection.get('windows_skipped'):
+            n_windows = len(detection['window_start_times'])
+            st.caption(f"Quiet windows skipped: {detection['windows_skipped']} of {n_windows} "
+                       f"({detection['windows_skipped'] / n_windows:.0%})")
+        saved = (detection.get('instrumentation') or {}).get('counters', {}).get('stage2_chunks_saved')
+        if saved:
+            st.caption(f"Chunk predictions skipped by the adaptive search: {saved}")
+        if detection.get('stage2_chunks_reused'):
+            st.caption(f"Chunk predictions reused across overlapping windows: {detection['stage2_chunks_reused']} "
+                       f"({detection['stage2_chunks_scored']} computed)")
+        st.info("Capuchin call results have been saved. Please visit the Results page to view detailed output.")
+    elif job['status'] == 'cancelled':
+        st.warning("Capuchin call detection was cancelled.")
+    else:
+        st.error(f"An error occurred during capuchin call detection: {job['error']}")
 
 # Main section: Instructions for the user
 st.markdown("""
@@ -179,22 +191,36 @@ if uploaded_file is not None:
     st.session_state.audio_file = uploaded_file
     st.audio(uploaded_file, format=f"audio/{uploaded_file.name.split('.')[-1]}")
     
-    # Create a temporary file to process the uploaded audio
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        temp_audio_path = tmp_file.name
+    # Store the upload under its content hash so re-uploads reuse the same file and cached results;
+    # uploads are shared between sessions and deleted once unused for a week
+    result_cache = get_result_cache()
+    # getbuffer() is a view of the upload, not another copy of it
+    audio_bytes = uploaded_file.getbuffer()
+    if st.session_state.get("audio_file_id") != uploaded_file.file_id:
+        st.session_state.audio_file_id = uploaded_file.file_id
+        st.session_state.audio_hash = hash_bytes(audio_bytes)
+        # A new upload replaces the detection job shown for the previous one
+        st.session_state.pop("detection_job_id", None)
+        st.query_params.pop("job", None)
+    audio_hash = st.session_state.audio_hash
+    temp_audio_path = result_cache.store_upload(audio_bytes, f".{uploaded_file.name.split('.')[-1]}", audio_hash)
     st.session_state.temp_audio_path = temp_audio_path
+    # Decoded audio and features live in .npy files; the session only holds memory-mapped handles.
+    # Stores are shared between sessions, so they are only deleted by prune_stores once unused
+    feature_store = FeatureStore(audio_hash, get_feature_store_root())
+    st.session_state.feature_store = feature_store
     
     # Immediately load and display waveform and spectrogram when file is uploaded
     with st.spinner("Loading audio visualization..."):
         try:
-            y, sr = librosa.load(temp_audio_path)
+            y = feature_store.waveform(temp_audio_path)
+            sr = ANALYSIS_SR
             
             # Just display waveform, removing the spectrogram display
             fig, ax = plt.subplots(figsize=(10, 4))
             
-            # Plot waveform with improved styling
-            librosa.display.waveshow(y, sr=sr, ax=ax, alpha=0.8, color='#1976D2')
+            # Plot waveform as a min/max envelope decimated to the figure width
+            plot_envelope(ax, y, sr, color='#1976D2', alpha=0.8)
             ax.set_title("Audio Waveform")
             ax.set_xlabel("Time (seconds)")
             ax.set_ylabel("Amplitude")
@@ -203,15 +229,16 @@ if uploaded_file is not None:
             plt.tight_layout()
             st.pyplot(fig)
             
-            # Store basic data in session
+            # Store basic data in session (y is a memory map of the store's waveform file)
+            duration = len(y) / sr
             st.session_state.basic_audio_data = {
+                'audio_hash': audio_hash,
                 'y': y,
                 'sr': sr,
-                'duration': librosa.get_duration(y=y, sr=sr)
+                'duration': duration
             }
             
             # Display file information
-            duration = librosa.get_duration(y=y, sr=sr)
             st.info(f"File: {uploaded_file.name} | Duration: {duration:.2f} seconds | Sample Rate: {sr} Hz")
             
         except Exception as e:
@@ -219,77 +246,78 @@ if uploaded_file is not None:
 
     # Two buttons: one for general audio analysis and one for capuchin call detection
     st.markdown("### Audio Analysis Options")
-    st.markdown("Choose one of the following analysis options:")
+    st.markdown("Analyze the audio to explore its features, or count Capuchin calls directly:")
     col1, col2 = st.columns(2)
     analyze_button = col1.button("Analyze Audio", type="primary")
     count_button = col2.button("Count Capuchin Calls", type="primary")
     
+    # Analysis results for the current upload; features are only computed when a view needs them
+    def get_analysis_results():
+        results = st.session_state.get("analysis_results")
+        if results is None or results.get('audio_hash') != audio_hash:
+            basic_audio_data = st.session_state.get("basic_audio_data")
+            if basic_audio_data is not None and basic_audio_data.get('audio_hash') == audio_hash:
+                y, sr, duration = basic_audio_data['y'], basic_audio_data['sr'], basic_audio_data['duration']
+            else:
+                y, sr = feature_store.waveform(temp_audio_path), ANALYSIS_SR
+                duration = len(y) / sr
+            results = LazyAnalysis(uploaded_file.name, y, sr, duration, store=feature_store, audio_hash=audio_hash)
+            st.session_state.analysis_results = results
+        return results
+
     # Audio analysis button callback
     if analyze_button:
         start_time = time.time()
-        with st.spinner("Analyzing audio..."):
+        with st.spinner("Preparing audio analysis..."):
             try:
-                # If we already loaded the basic data, use it instead of reloading
-                if hasattr(st.session_state, 'basic_audio_data'):
-                    y = st.session_state.basic_audio_data['y']
-                    sr = st.session_state.basic_audio_data['sr']
-                    duration = st.session_state.basic_audio_data['duration']
-                else:
-                    y, sr = librosa.load(temp_audio_path)
-                    duration = librosa.get_duration(y=y, sr=sr)
-                
-                analysis_results = {
-                    'filename': uploaded_file.name,
-                    'duration': duration,
-                    'sample_rate': sr,
-                    'waveform': y,
-                }
-                # Compute spectrogram
-                D = librosa.amplitude_to_db(np.abs(librosa.stft(y)), ref=np.max)
-                analysis_results['spectrogram'] = D
-                # Estimate tempo
-                try:
-                    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-                    analysis_results['tempo'] = float(tempo)
-                except Exception as e:
-                    analysis_results['tempo'] = 0.0
-                    st.warning(f"Could not extract tempo: {str(e)}")
-                # Harmonic and percussive components
-                harmonic, percussive = librosa.effects.hpss(y)
-                analysis_results['harmonic'] = harmonic
-                analysis_results['percussive'] = percussive
-                # RMS energy and ZCR
-                rms = librosa.feature.rms(y=y)[0]
-                analysis_results['rms'] = rms
-                zcr = librosa.feature.zero_crossing_rate(y)[0]
-                analysis_results['zcr'] = zcr
-                # MFCC features
-                mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-                analysis_results['mfccs'] = mfccs
-                
-                st.session_state.analysis_results = analysis_results
+                get_analysis_results()
                 elapsed = time.time() - start_time
-                st.success(f"Audio processed successfully in {elapsed:.2f} seconds!")
-                st.info("Detailed results (including capuchin call detection) will be available on the Results page.")
+                st.success(f"Audio prepared for analysis in {elapsed:.2f} seconds!")
+                st.info("Spectrogram, MFCC, energy and other features are computed on the Results page "
+                        "when you open each view.")
             except Exception as e:
                 st.error(f"Error processing audio: {str(e)}")
     
     # Capuchin call detection button callback
     if count_button:
-        if st.session_state.get("analysis_results") is None:
-            st.error("Please analyze the audio first by clicking 'Analyze Audio'.")
-        else:
-            start_time = time.time()
-            with st.spinner("Counting capuchin calls..."):
-                model = load_capuchin_model()
-                call_count, call_timestamps = count_capuchin_calls_two_stage_sliding_window(temp_audio_path, model)
-            if call_count is not None:
-                st.session_state.analysis_results['capuchin_calls'] = call_count
-                st.session_state.analysis_results['call_timestamps'] = call_timestamps
-                elapsed = time.time() - start_time
-                st.success(f"Capuchin call detection executed in {elapsed:.2f} seconds!")
+        try:
+            analysis_results = get_analysis_results()
+        except Exception as e:
+            analysis_results = None
+            st.error(f"Error processing audio: {str(e)}")
+        if analysis_results is not None:
+            detection_options = {'spectrogram_cache': use_spectrogram_cache, 'streaming': use_streaming,
+                                 'res_type': resample_type, 'gate_threshold': gate_threshold,
+                                 'window_hop_outer': window_hop_outer,
+                                 'stage2_search': 'adaptive' if use_adaptive_search else 'exhaustive'}
+            cache_key = detection_cache_key(audio_hash, backend_model_file(inference_backend), **detection_options)
+            detection = result_cache.get(cache_key)
+            if detection is not None:
+                analysis_results.update(detection_entries(detection))
+                st.session_state.pop("detection_job_id", None)
+                st.query_params.pop("job", None)
+                st.success(f"Loaded previous detection results for this file from the cache: "
+                           f"{detection['call_count']} calls.")
                 st.info("Capuchin call results have been saved. Please visit the Results page to view detailed output.")
             else:
-                st.error("An error occurred during capuchin call detection.")
+                # Detection runs in the background; an identical job that is still running is reused
+                active_job = job_queue.find_active(cache_key)
+                if active_job is not None:
+                    job_id = active_job['id']
+                else:
+                    job_id = job_queue.submit(temp_audio_path, get_session_model(inference_backend),
+                                              detection_options, key=cache_key, filename=uploaded_file.name,
+                                              audio_hash=audio_hash)
+                st.session_state.detection_job_id = job_id
+                st.query_params["job"] = job_id
 else:
     st.info("Please upload an audio file to begin processing.")
+
+# Detection job status, also shown after a browser refresh when the upload is gone
+if "detection_job_id" in st.session_state:
+    detection_job = job_queue.get(st.session_state.detection_job_id)
+    if detection_job is not None and detection_job['status'] in ('queued', 'running'):
+        st.session_state.polling_job_id = detection_job['id']
+        st.fragment(show_detection_job, run_every=1.0)()
+    else:
+        show_detection_job()